@@ -0,0 +1,307 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+'''
+Throughput benchmarks for the cipher, the upload iterator and full transfers against the local mock server, and
+the start up time of the package and the ckc command line.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --max-size 1G --compare results.json
+
+Every case runs in a fresh process, so its peak RSS is its own, transfers use a mock server in another process and
+start up cases report the peak RSS of the interpreters they time. Payloads are removed after each case.
+Results are written as JSON, --compare reports cases whose throughput dropped, or for start up cases whose median
+latency grew, by more than --threshold against an earlier run and exits non-zero if there are any.
+'''
+
+import json
+import platform
+import resource
+import sys
+from subprocess import Popen, PIPE, DEVNULL, check_call
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from multiprocessing import get_context
+from os import urandom
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+UNITS = {'K': KIB, 'M': MIB, 'G': GIB}
+CIPHER_SIZES = [KIB, 64 * KIB, MIB, 16 * MIB, 256 * MIB, GIB]
+ITERATOR_CHUNK_SIZES = [64 * KIB, MIB, 8 * MIB]
+TRANSFER_SIZES = [64 * KIB, 4 * MIB, 64 * MIB]
+# python -c statements timed in a fresh interpreter, the bare interpreter is the floor the others are measured against.
+STARTUP_COMMANDS = [
+    ('python', 'pass'),
+    ('import', 'import py_crypt_keeper_client'),
+    ('help', 'import sys; sys.argv = ["ckc", "--help"]; from py_crypt_keeper_client.command import main; main()'),
+    ('client', 'import py_crypt_keeper_client.client'),
+]
+STARTUP_CALLS = 20
+# each case repeats until at least this much data or this many calls have been timed.
+MIN_BYTES = 64 * MIB
+MIN_CALLS = 5
+MAX_CALLS = 1000
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, for RUSAGE_CHILDREN it is the largest child waited for.
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / MIB if sys.platform == 'darwin' else peak / KIB
+
+
+def calls_for(size):
+    return max(MIN_CALLS, min(MAX_CALLS, MIN_BYTES // max(size, 1)))
+
+
+def summarize(benchmark, params, size, latencies, peak_rss=None):
+    seconds = sum(latencies)
+    return {
+        'benchmark': benchmark,
+        'params': params,
+        'bytes': size,
+        'calls': len(latencies),
+        'seconds': seconds,
+        'mb_per_s': size * len(latencies) / MIB / seconds if seconds else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p90': percentile(latencies, 0.9) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies) * 1000,
+        },
+        'peak_rss_mb': peak_rss_mb() if peak_rss is None else peak_rss,
+    }
+
+
+def random_file(size, filename):
+    # written a chunk at a time so the payload does not count towards the case's peak RSS.
+    with open(filename, 'wb') as file:
+        for offset in range(0, size, MIB):
+            file.write(urandom(min(MIB, size - offset)))
+    return filename
+
+
+def time_calls(func, calls):
+    latencies = []
+    for _ in range(calls):
+        start = perf_counter()
+        func()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def cipher_case(operation, encryption_type, engine, size):
+    from py_crypt_keeper_client.cipher import Cipher
+    from py_crypt_keeper_client.utility import encode_key
+    key = encode_key(urandom(32))
+    data = urandom(size)
+    output = bytearray(size)
+    if operation == 'decrypt':
+        data = Cipher(encryption_type, key, engine=engine).encrypt(data)
+    cipher = Cipher(encryption_type, key, engine=engine)
+    func = getattr(cipher, operation)
+    latencies = time_calls(lambda: func(data, output=output), calls_for(size))
+    params = {'operation': operation, 'encryption_type': encryption_type, 'engine': engine}
+    return summarize('cipher', params, size, latencies)
+
+
+def chunked_case(operation, engine, size, jobs):
+    from py_crypt_keeper_client.chunked import ChunkedCipher, ChunkedDecryptingFileWriter
+    from py_crypt_keeper_client.engines import AES_GCM
+    from py_crypt_keeper_client.utility import encode_key
+    key = encode_key(urandom(32))
+    data = urandom(size)
+    cipher = ChunkedCipher(AES_GCM, key, engine=engine)
+    encrypted = b''.join(cipher.encrypted_chunks(BytesIO(data), jobs))
+
+    def encrypt():
+        for _ in cipher.encrypted_chunks(BytesIO(data), jobs):
+            pass
+
+    def decrypt():
+        writer = ChunkedDecryptingFileWriter(
+            NullWriter(), lambda header: ChunkedCipher(AES_GCM, key, header, engine=engine), jobs)
+        writer.write(encrypted)
+        writer.close()
+    latencies = time_calls(encrypt if operation == 'encrypt' else decrypt, calls_for(size))
+    params = {'operation': operation, 'encryption_type': AES_GCM, 'engine': engine, 'jobs': jobs}
+    return summarize('chunked_cipher', params, size, latencies)
+
+
+class NullWriter(object):
+    def write(self, data):
+        return len(data)
+
+
+def iterator_case(size, chunk_size):
+    from py_crypt_keeper_client.cipher import Cipher, AES_CBC
+    from py_crypt_keeper_client.utility import encode_key, EncryptingFileIterator
+    key = encode_key(urandom(32))
+    with TemporaryDirectory() as path:
+        filename = random_file(size, join(path, 'iterator.bin'))
+
+        def iterate():
+            with open(filename, 'rb') as file:
+                for _ in EncryptingFileIterator(file, Cipher(AES_CBC, key, size), chunk_size):
+                    pass
+        latencies = time_calls(iterate, calls_for(size))
+    return summarize('iterator', {'chunk_size': chunk_size}, size, latencies)
+
+
+def transfer_case(operation, encryption_type, size):
+    from py_crypt_keeper_client.client import SimpleClient
+    from py_crypt_keeper_client.mock_server import DEFAULT_USER, DEFAULT_API_KEY
+    with TemporaryDirectory() as path:
+        filename = random_file(size, join(path, 'upload.bin'))
+        server = Popen([sys.executable, '-m', 'py_crypt_keeper_client.mock_server', '--port', '0'], stdout=PIPE,
+                       universal_newlines=True)
+        try:
+            url = server.stdout.readline().strip()
+            client = SimpleClient.create(url, DEFAULT_USER, DEFAULT_API_KEY, encryption_type=encryption_type)
+            document_id = client.upload_file(filename)
+            if operation == 'upload':
+                func = lambda: client.upload_file(filename)
+            else:
+                func = lambda: client.download_file(document_id, 'download.bin', path)
+            latencies = time_calls(func, max(MIN_CALLS, min(100, 4 * MIN_BYTES // max(size, 1) // 16)))
+            client.close()
+        finally:
+            server.terminate()
+            server.wait()
+    return summarize('transfer', {'operation': operation, 'encryption_type': encryption_type}, size, latencies)
+
+
+def startup_case(name, statement):
+    command = [sys.executable, '-c', statement]
+    # the first run warms the file system cache and writes the byte code.
+    check_call(command, stdout=DEVNULL)
+    latencies = time_calls(lambda: check_call(command, stdout=DEVNULL), STARTUP_CALLS)
+    # the case runs in a fresh process whose only children are these interpreters.
+    return summarize('startup', {'command': name}, 0, latencies, peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+
+def cases(args):
+    from py_crypt_keeper_client.engines import available_engines, AES_CBC, AES_GCM
+    suites = set(args.suite)
+    if 'cipher' in suites:
+        for size in [s for s in CIPHER_SIZES if s <= args.max_size]:
+            for engine in available_engines(AES_CBC):
+                for operation in ['encrypt', 'decrypt']:
+                    yield cipher_case, (operation, AES_CBC, engine, size)
+            for engine in available_engines(AES_GCM):
+                for operation in ['encrypt', 'decrypt']:
+                    yield chunked_case, (operation, engine, size, args.jobs)
+    if 'iterator' in suites:
+        for chunk_size in ITERATOR_CHUNK_SIZES:
+            yield iterator_case, (min(args.max_size, 64 * MIB), chunk_size)
+    if 'transfer' in suites:
+        for size in [s for s in TRANSFER_SIZES if s <= args.max_size]:
+            for encryption_type in [AES_CBC, AES_GCM]:
+                for operation in ['upload', 'download']:
+                    yield transfer_case, (operation, encryption_type, size)
+    if 'startup' in suites:
+        for name, statement in STARTUP_COMMANDS:
+            yield startup_case, (name, statement)
+
+
+def case_key(result):
+    return json.dumps([result['benchmark'], result['params'], result['bytes']], sort_keys=True)
+
+
+def compare(results, baseline, threshold):
+    # returns the cases whose throughput fell, or whose median latency grew when they move no data, by more than
+    # threshold, as (key, baseline, result, unit).
+    previous = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if before and before['mb_per_s'] and result['mb_per_s'] is not None:
+            if result['mb_per_s'] < before['mb_per_s'] * (1 - threshold):
+                regressions.append((case_key(result), before['mb_per_s'], result['mb_per_s'], 'MB/s'))
+        elif before and not before['bytes']:
+            if result['latency_ms']['p50'] > before['latency_ms']['p50'] * (1 + threshold):
+                regressions.append((case_key(result), before['latency_ms']['p50'], result['latency_ms']['p50'], 'ms'))
+    return regressions
+
+
+def environment():
+    from py_crypt_keeper_client.engines import available_engines, select_engine, AES_CBC, AES_GCM
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'engines': {cipher_type: {
+            'available': available_engines(cipher_type),
+            'selected': select_engine(cipher_type),
+        } for cipher_type in [AES_CBC, AES_GCM]},
+        'started': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def main():
+    parser = ArgumentParser(description='Measure py_crypt_keeper_client throughput.')
+    suites = ['cipher', 'iterator', 'transfer', 'startup']
+    parser.add_argument('--suite', nargs='+', choices=suites, default=suites, help='The suites to run, all by default.')
+    parser.add_argument('--max-size', type=parse_size, default=64 * MIB,
+                        help='The largest payload measured, e.g. 1G, defaults to 64M.')
+    parser.add_argument('--jobs', type=int, default=4, help='Threads used by chunked AES-GCM cases.')
+    parser.add_argument('--output', help='Write the JSON results to this file rather than stdout.')
+    parser.add_argument('--compare', metavar='BASELINE', help='Report regressions against an earlier JSON result.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='The fraction of throughput lost that counts as a regression, defaults to 0.1.')
+    args = parser.parse_args()
+    results = []
+    for case, case_args in cases(args):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(case, *case_args).result()
+        print('{benchmark} {params} {bytes} bytes: {mb_per_s:.1f} MB/s, p50 {p50:.3f} ms, {peak_rss_mb:.0f} MB RSS'
+              .format(p50=result['latency_ms']['p50'], **result), file=sys.stderr)
+        results.append(result)
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for key, before, after, unit in regressions:
+            print('REGRESSION {key}: {before:.1f} -> {after:.1f} {unit}'.format(
+                key=key, before=before, after=after, unit=unit), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
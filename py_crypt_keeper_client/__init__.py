@@ -1,9 +1,33 @@
-from logging import getLogger, StreamHandler, Formatter, DEBUG, WARN
-from .client import CryptKeeperClient, SimpleClient
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
 
-console_handler = StreamHandler()
-console_handler.setLevel(WARN)
 
+# the clients pull in requests and the cipher libraries, so they are only imported when first used, which keeps
+# `import py_crypt_keeper_client` and the ckc command line quick to start.
+LAZY_ATTRIBUTES = {
+    'CryptKeeperClient': 'client',
+    'SimpleClient': 'client',
+}
 
-__log = getLogger()
-__log.addHandler(console_handler)
+
+def __getattr__(name):
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError('module {module!r} has no attribute {name!r}'.format(module=__name__, name=name))
+    from importlib import import_module
+    return getattr(import_module('.' + LAZY_ATTRIBUTES[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_ATTRIBUTES))
@@ -0,0 +1,388 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import asyncio
+import aiohttp
+import json
+from os.path import getsize, basename
+from logging import getLogger
+from .chunked import ChunkedCipher, ChunkedDecryptingFileWriter, is_chunked
+from .cipher import Cipher
+from .compression import compress_file, DecompressingFileWriter
+from .exceptions import CryptKeeperError, CryptKeeperHTTPError, CircuitOpenError
+from .retry import RetryPolicy, parse_retry_after
+from .client import (
+    SimpleClient,
+    UploadResult,
+    DownloadResult,
+    URL_V1,
+    DEFAULT_ENCRYPTION_TYPE,
+    DEFAULT_POOL_SIZE,
+)
+from .utility import DecryptingFileWriter, read_fully, DEFAULT_CHUNK_SIZE, DEFAULT_JOBS
+
+log = getLogger(__name__)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    # must be called with a running event loop.
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+
+
+class AsyncCryptKeeperClient(object):
+    def __init__(self, url, user, api_key, session=None, pool_size=DEFAULT_POOL_SIZE, retry_policy=None,
+                 raise_errors=False):
+        self.url = URL_V1.format(base_url=url)
+        self.user = user
+        self.api_key = api_key
+        if not all([url, user, api_key]):
+            raise ValueError('Must initialize url, user, and api_key. (%s, %s, %s)' % (url, user, api_key))
+        self.pool_size = pool_size
+        self.session = session
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.raise_errors = raise_errors
+        # only touched from the event loop, so no lock is needed.
+        self.circuit_breakers = {}
+
+    def get_session(self):
+        # aiohttp sessions are bound to the loop they are created on, so create on first use.
+        if self.session is None:
+            self.session = create_session(self.pool_size)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def get_circuit_breaker(self, endpoint):
+        if endpoint not in self.circuit_breakers:
+            self.circuit_breakers[endpoint] = self.retry_policy.new_circuit_breaker(endpoint)
+        return self.circuit_breakers[endpoint]
+
+    def failed(self, error, cause=None):
+        if self.raise_errors:
+            raise error from cause
+        return None
+
+    async def request(self, method, url, expected_status, data=None, endpoint=None):
+        # the same retry policy and per endpoint circuit breakers as CryptKeeperClient.request.
+        headers = {
+            'Accept': 'application/json',
+            'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
+        }
+        if data is not None:
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+            data = json.dumps(data)
+        circuit_breaker = self.get_circuit_breaker(endpoint or url)
+        attempt = 0
+        while True:
+            try:
+                trial = circuit_breaker.before_call()
+            except CircuitOpenError as e:
+                log.error('Crypt-Keeper %s %s skipped: %s', method, url, e)
+                return self.failed(e)
+            try:
+                try:
+                    async with self.get_session().request(method, url, headers=headers, data=data) as response:
+                        status_code = response.status
+                        content = await response.read()
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    circuit_breaker.record_failure()
+                    transient = isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+                    if transient and self.retry_policy.should_retry(method, attempt):
+                        delay = self.retry_policy.delay(attempt)
+                        log.warning('Crypt-Keeper %s %s failed, retrying in %.1fs: %s', method, url, delay, e)
+                        await asyncio.sleep(delay)
+                        attempt += 1
+                        continue
+                    log.exception('Crypt-Keeper HTTP %s %s Request failed: %s', method, url, e)
+                    return self.failed(CryptKeeperError('Crypt-Keeper %s %s failed: %s' % (method, url, e)), e)
+                except Exception:
+                    circuit_breaker.record_failure()
+                    raise
+                log.debug('Crypt-Keeper %s %s Response HTTP Status Code: %s', method, url, status_code)
+                if status_code == expected_status:
+                    circuit_breaker.record_success()
+                    return json.loads(content.decode('utf-8'))
+                if status_code == 429 or status_code >= 500:
+                    circuit_breaker.record_failure()
+                    if self.retry_policy.should_retry(method, attempt, status_code, retry_after):
+                        delay = self.retry_policy.delay(attempt, retry_after)
+                        log.warning('Crypt-Keeper %s %s returned %d, retrying in %.1fs.', method, url, status_code,
+                                    delay)
+                        await asyncio.sleep(delay)
+                        attempt += 1
+                        continue
+                else:
+                    circuit_breaker.record_success()
+                    retry_after = None
+                log.error('Crypt-Keeper %s %s returned HTTP %d.', method, url, status_code)
+                return self.failed(CryptKeeperHTTPError(
+                    'Crypt-Keeper %s %s returned HTTP %d.' % (method, url, status_code),
+                    status_code,
+                    retry_after,
+                    url,
+                ))
+            finally:
+                # cancelled trial calls end here.
+                if trial:
+                    circuit_breaker.end_trial()
+
+    async def get_upload_url(self, document_metadata):
+        data = {
+            'document_metadata': document_metadata,
+        }
+        return await self.request('POST', '%s/upload_url/' % self.url, 201, data, endpoint='upload_url')
+
+    async def get_download_url(self, document_id):
+        return await self.request('GET', '%s/download_url/%s/' % (self.url, document_id), 200, endpoint='download_url')
+
+    async def get_share(self, document_id):
+        return await self.request('GET', '%s/share/%s/' % (self.url, document_id), 200, endpoint='share')
+
+    async def post_share(self, document_id, username):
+        data = {
+            'document_id': document_id,
+            'username': username,
+        }
+        return await self.request('POST', '%s/share/' % self.url, 201, data, endpoint='share')
+
+
+class AsyncEncryptingS3Client(object):
+    def __init__(self, encryption_type, key, file_size, session, block_size=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 executor=None, cipher_jobs=DEFAULT_JOBS):
+        self.encryption_type = encryption_type
+        self.key = key
+        self.file_size = file_size
+        self.session = session
+        self.block_size = block_size or Cipher.get_block_size(encryption_type)
+        self.chunk_size = chunk_size
+        # None runs encryption and file io on the loop's default executor.
+        self.executor = executor
+        self.chunked = is_chunked(encryption_type)
+        self.cipher_jobs = cipher_jobs
+
+    def read_and_encrypt(self, file, cipher):
+        read = read_fully(file, self.chunk_size)
+        return cipher.encrypt(read) if read else read
+
+    async def encrypted_body(self, file, cipher):
+        loop = asyncio.get_running_loop()
+        yield cipher.get_iv()
+        while True:
+            chunk = await loop.run_in_executor(self.executor, self.read_and_encrypt, file, cipher)
+            if not chunk:
+                break
+            yield chunk
+
+    async def chunked_body(self, chunks):
+        # chunks is a blocking generator, each chunk is pulled on the executor.
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    async def upload(self, file, url):
+        if self.chunked:
+            cipher = ChunkedCipher(self.encryption_type, self.key, chunk_size=self.chunk_size)
+            body = self.chunked_body(cipher.encrypted_chunks(file, self.cipher_jobs))
+            content_length = cipher.get_encrypted_file_size(self.file_size)
+        else:
+            cipher = Cipher(self.encryption_type, self.key, self.file_size)
+            body = self.encrypted_body(file, cipher)
+            content_length = cipher.get_encrypted_file_size()
+        try:
+            # an explicit Content-Length keeps aiohttp from switching to chunked encoding, which S3 rejects.
+            async with self.session.put(
+                url,
+                data=body,
+                headers={'Content-Length': str(content_length)},
+            ) as response:
+                log.debug('S3 Upload Response HTTP Status Code: %s', response.status)
+                return 200 <= response.status < 300
+        except aiohttp.ClientError as e:
+            log.exception('S3 HTTP Request failed: %s', e)
+        return False
+
+    def get_cipher_for_iv(self, iv):
+        return Cipher(self.encryption_type, self.key, self.file_size, iv=iv)
+
+    def get_chunked_cipher(self, header):
+        return ChunkedCipher(self.encryption_type, self.key, header)
+
+    async def download(self, file, url):
+        loop = asyncio.get_running_loop()
+        if self.chunked:
+            writer = ChunkedDecryptingFileWriter(file, self.get_chunked_cipher, self.cipher_jobs)
+        else:
+            writer = DecryptingFileWriter(file, self.get_cipher_for_iv, self.block_size)
+        try:
+            async with self.session.get(url, headers={'Content-Type': 'application/octet-stream'}) as response:
+                log.debug('S3 Download Response HTTP Status Code: %s', response.status)
+                response.raise_for_status()
+                # network reads are small, batch them so each executor call decrypts a full chunk.
+                batch = bytearray()
+                async for data in response.content.iter_any():
+                    batch += data
+                    if len(batch) >= self.chunk_size:
+                        await loop.run_in_executor(self.executor, writer.write, batch)
+                        batch = bytearray()
+                if batch:
+                    await loop.run_in_executor(self.executor, writer.write, batch)
+            # closing waits for the last chunks to be decrypted and written.
+            await loop.run_in_executor(self.executor, writer.close)
+        finally:
+            if self.chunked:
+                await loop.run_in_executor(self.executor, writer.shutdown)
+        return True
+
+
+class AsyncSimpleClient(object):
+    def __init__(self, crypt_keeper_client, content_type='text/plain', chunk_size=DEFAULT_CHUNK_SIZE, executor=None,
+                 compression=None, encryption_type=DEFAULT_ENCRYPTION_TYPE, cipher_jobs=DEFAULT_JOBS):
+        self.crypt_keeper_client = crypt_keeper_client
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.compression = compression
+        self.encryption_type = encryption_type
+        self.cipher_jobs = cipher_jobs
+
+    @classmethod
+    def create(cls, url, user, api_key, content_type='text/plain', chunk_size=DEFAULT_CHUNK_SIZE, session=None,
+               pool_size=DEFAULT_POOL_SIZE, executor=None, compression=None, retry_policy=None, raise_errors=False,
+               encryption_type=DEFAULT_ENCRYPTION_TYPE, cipher_jobs=DEFAULT_JOBS):
+        crypt_keeper_client = AsyncCryptKeeperClient(url, user, api_key, session, pool_size, retry_policy, raise_errors)
+        return cls(crypt_keeper_client, content_type, chunk_size, executor, compression, encryption_type, cipher_jobs)
+
+    async def close(self):
+        await self.crypt_keeper_client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def s3_client(self, encryption_type, key, file_size):
+        return AsyncEncryptingS3Client(
+            encryption_type,
+            key,
+            file_size,
+            self.crypt_keeper_client.get_session(),
+            chunk_size=self.chunk_size,
+            executor=self.executor,
+            cipher_jobs=self.cipher_jobs,
+        )
+
+    async def upload_file(self, filename):
+        with open(filename, 'rb') as file:
+            if self.compression is None:
+                return await self.upload_fileobj(file, getsize(filename), basename(filename))
+            spool, file_size = await asyncio.get_running_loop().run_in_executor(
+                self.executor, compress_file, file, self.compression, self.chunk_size)
+        with spool:
+            return await self.upload_fileobj(spool, file_size, basename(filename), compressed=True)
+
+    async def upload_fileobj(self, file, file_size, name, compressed=False):
+        document_metadata = {
+            'content_length': file_size,
+            'content_type': self.content_type,
+            'name': name,
+            'compressed': compressed,
+            'encryption_type': self.encryption_type,
+        }
+        upload_info = await self.crypt_keeper_client.get_upload_url(document_metadata)
+        if not upload_info:
+            return None
+        key = upload_info.get('symmetric_key')
+        encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
+        s3_client = self.s3_client(encryption_type, key, file_size)
+        if await s3_client.upload(file, upload_info.get('single_use_url')):
+            return upload_info.get('document_id')
+        return None
+
+    async def download_file(self, document_id, file_name=None, file_path=None):
+        download_info = await self.crypt_keeper_client.get_download_url(document_id)
+        if download_info is None:
+            return False
+        document_metadata = download_info.get('document_metadata', {})
+        encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
+        key = download_info.get('symmetric_key')
+        file_size = int(document_metadata.get('content_length'))
+        filename = SimpleClient.generate_file_name(document_id, document_metadata, file_name, file_path)
+        s3_client = self.s3_client(encryption_type, key, file_size)
+        with open(filename, 'wb') as file:
+            if document_metadata.get('compressed', False):
+                decompressing_file = DecompressingFileWriter(file)
+                await s3_client.download(decompressing_file, download_info.get('single_use_url'))
+                await asyncio.get_running_loop().run_in_executor(self.executor, decompressing_file.close)
+            else:
+                await s3_client.download(file, download_info.get('single_use_url'))
+        return True
+
+    @staticmethod
+    async def run_concurrently(func, items, jobs):
+        # yields (item, result, exception) as each call finishes with at most jobs calls in flight.
+        items = iter(items)
+        pending = {}
+        while True:
+            for item in items:
+                pending[asyncio.ensure_future(func(item))] = item
+                if len(pending) >= jobs:
+                    break
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+    async def upload_files(self, filenames, jobs=DEFAULT_JOBS):
+        async for filename, document_id, error in self.run_concurrently(self.upload_file, filenames, jobs):
+            if error is not None:
+                log.error('Upload of %s failed: %s', filename, error)
+                error = str(error) or error.__class__.__name__
+            elif document_id is None:
+                error = 'Upload failed, see logs.'
+            yield UploadResult(filename, document_id, error)
+
+    async def download_files(self, document_ids, file_path=None, jobs=DEFAULT_JOBS):
+        async def download(document_id):
+            return await self.download_file(document_id, file_path=file_path)
+        async for document_id, downloaded, error in self.run_concurrently(download, document_ids, jobs):
+            if error is not None:
+                log.error('Download of %s failed: %s', document_id, error)
+                error = str(error) or error.__class__.__name__
+            elif not downloaded:
+                error = 'Download failed, see logs.'
+            yield DownloadResult(document_id, bool(downloaded), error)
+
+    async def get_share(self, document_id):
+        users = []
+        share_info = await self.crypt_keeper_client.get_share(document_id)
+        if share_info is not None:
+            users = share_info.get('users', []) or []
+        return users
+
+    async def post_share(self, document_id, username):
+        share_info = await self.crypt_keeper_client.post_share(document_id, username)
+        if share_info is None:
+            return False
+        return share_info.get('resource_uri')
@@ -0,0 +1,101 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 60.0
+
+
+class TTLCache(object):
+    # a thread safe least recently used cache whose entries also expire ttl seconds after they were stored.
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, clock=monotonic):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive (got %s).' % max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        # every invalidation gets the next sequence number, the most recent max_size are kept by key so a value
+        # fetched before one of them is not stored afterwards. Older ones only leave the highest number forgotten.
+        self.sequence = 0
+        self.invalidated = OrderedDict()
+        self.forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def generation(self):
+        # taken before fetching a value to store with put(key, value, generation).
+        with self.lock:
+            return self.sequence
+
+    def put(self, key, value, generation=None):
+        # returns False without storing value when key was invalidated after generation was taken.
+        with self.lock:
+            if generation is not None and (
+                    self.forgotten > generation or self.invalidated.get(key, 0) > generation):
+                return False
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.sequence += 1
+            self.invalidated[key] = self.sequence
+            self.invalidated.move_to_end(key)
+            while len(self.invalidated) > self.max_size:
+                self.forgotten = self.invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sequence += 1
+            self.invalidated.clear()
+            self.forgotten = self.sequence
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,212 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import urandom
+from struct import Struct
+from logging import getLogger, WARN
+from .engines import get_engine, AES_GCM
+from .exceptions import IntegrityError
+from .utility import decode_key, prefetch, read_fully, DEFAULT_CHUNK_SIZE, DEFAULT_JOBS
+
+# Chunked documents start with a header: a 7 byte random nonce prefix, a reserved byte, the plain text chunk size
+# and 4 reserved bytes. Every chunk of plain text is then sealed on its own, followed by its tag. The nonce of a
+# chunk is the prefix, its 4 byte index and a flag set only on the last chunk, and the header is authenticated with
+# every chunk, so chunks can not be modified, reordered, dropped or appended without failing verification.
+HEADER = Struct('>7sxI4x')
+HEADER_SIZE = HEADER.size
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+MAX_CHUNKS = 2 ** 32
+CHUNKED_TYPES = (AES_GCM,)
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+
+def is_chunked(encryption_type):
+    return encryption_type in CHUNKED_TYPES
+
+
+def calculate_chunk_count(file_size, chunk_size):
+    # an empty file still has one, empty, last chunk.
+    return max(1, -(-file_size // chunk_size))
+
+
+class ChunkedCipher(object):
+    def __init__(self, cipher_type, key, header=None, chunk_size=DEFAULT_CHUNK_SIZE, engine=None):
+        # header is read from a stored document, without one a new nonce prefix is generated.
+        self.cipher_type = cipher_type
+        self.key = decode_key(key)
+        self.engine = get_engine(cipher_type, engine)
+        if header is None:
+            if chunk_size <= 0:
+                raise ValueError('chunk_size must be positive (got %s).' % chunk_size)
+            header = HEADER.pack(urandom(NONCE_PREFIX_SIZE), chunk_size)
+        elif len(header) != HEADER_SIZE:
+            raise IntegrityError('Chunked header must be %d bytes (got %d).' % (HEADER_SIZE, len(header)))
+        self.header = bytes(header)
+        self.nonce_prefix, self.chunk_size = HEADER.unpack(self.header)
+        if self.chunk_size <= 0:
+            raise IntegrityError('Chunked header has no chunk size.')
+        self.record_size = self.chunk_size + TAG_SIZE
+
+    def get_nonce(self, index, last):
+        if index >= MAX_CHUNKS:
+            raise ValueError('Documents are limited to %d chunks.' % MAX_CHUNKS)
+        return self.nonce_prefix + index.to_bytes(4, 'big') + (b'\x01' if last else b'\x00')
+
+    def encrypt_chunk(self, index, data, last=False):
+        cipher = self.engine(self.key, self.get_nonce(index, last))
+        cipher.update(self.header)
+        return cipher.encrypt(data) + cipher.digest()
+
+    def decrypt_chunk(self, index, record, last=False):
+        # returns the plain text of one chunk and its tag, or raises IntegrityError.
+        if len(record) < TAG_SIZE:
+            raise IntegrityError('Chunk %d is truncated.' % index)
+        with memoryview(record) as view:
+            cipher = self.engine(self.key, self.get_nonce(index, last))
+            cipher.update(self.header)
+            plain_text = cipher.decrypt(view[:-TAG_SIZE])
+            try:
+                cipher.verify(bytes(view[-TAG_SIZE:]))
+            except ValueError:
+                raise IntegrityError('Chunk %d failed authentication.' % index)
+        return plain_text
+
+    def get_encrypted_file_size(self, file_size):
+        return HEADER_SIZE + file_size + TAG_SIZE * calculate_chunk_count(file_size, self.chunk_size)
+
+    def plain_chunks(self, file, index=0):
+        # yields (index, plain text, last), reading one chunk ahead to find the last.
+        data = read_fully(file, self.chunk_size) or b''
+        while True:
+            following = read_fully(file, self.chunk_size) if len(data) == self.chunk_size else b''
+            yield index, data, not following
+            if not following:
+                return
+            index += 1
+            data = following
+
+    def encrypted_chunks(self, file, jobs=DEFAULT_JOBS):
+        # yields the header and then every sealed chunk in order, up to jobs chunks are encrypted concurrently.
+        yield self.header
+        for (index, _, _), record, error in prefetch(lambda chunk: self.encrypt_chunk(*chunk),
+                                                     self.plain_chunks(file), jobs):
+            if error is not None:
+                raise error
+            yield record
+
+    def encrypt_part(self, chunks, first=False):
+        # seals a list of (index, plain text, last), the first part of a document also carries the header.
+        records = [self.encrypt_chunk(index, data, last) for index, data, last in chunks]
+        if first:
+            records.insert(0, self.header)
+        return b''.join(records)
+
+    def chunks_per_part(self, part_size):
+        # parts hold whole chunks, rounded up so no part but the last is smaller than part_size.
+        return max(1, -(-part_size // self.record_size))
+
+    def calculate_chunk_range(self, first, stop, file_size):
+        # the inclusive cipher text byte range of chunks [first, stop).
+        encrypted_size = self.get_encrypted_file_size(file_size)
+        return HEADER_SIZE + first * self.record_size, min(HEADER_SIZE + stop * self.record_size, encrypted_size) - 1
+
+    def calculate_ranges(self, file_size, range_size):
+        per_range = max(1, range_size // self.chunk_size)
+        return [
+            self.calculate_chunk_range(first, first + per_range, file_size)
+            for first in range(0, calculate_chunk_count(file_size, self.chunk_size), per_range)
+        ]
+
+    def decrypt_range(self, content, start, end, file_size):
+        # decrypts the inclusive cipher text range [start, end] starting on a chunk, returns (plain text offset,
+        # plain text).
+        first = (start - HEADER_SIZE) // self.record_size
+        if len(content) != end - start + 1:
+            raise IntegrityError('Expected %d bytes of chunks from byte %d (got %d).' % (
+                end - start + 1, start, len(content)))
+        last = calculate_chunk_count(file_size, self.chunk_size) - 1
+        with memoryview(content) as view:
+            plain_text = b''.join(
+                self.decrypt_chunk(index, view[offset:offset + self.record_size], index == last)
+                for index, offset in enumerate(range(0, len(view), self.record_size), first)
+            )
+        return first * self.chunk_size, plain_text
+
+
+class ChunkedDecryptingFileWriter(object):
+    def __init__(self, file, cipher_factory, jobs=DEFAULT_JOBS):
+        # cipher_factory is called with the header once it has arrived. Chunks are verified before their plain text
+        # is written, up to jobs chunks are decrypted concurrently and written in order.
+        self.file = file
+        self.cipher_factory = cipher_factory
+        self.jobs = jobs
+        self.cipher = None
+        self.buffer = bytearray()
+        self.index = 0
+        self.pending = deque()
+        self.executor = None
+        self.decrypted = 0
+
+    def write(self, data):
+        self.buffer += data
+        if self.cipher is None:
+            if len(self.buffer) < HEADER_SIZE:
+                return
+            self.cipher = self.cipher_factory(bytes(self.buffer[:HEADER_SIZE]))
+            del self.buffer[:HEADER_SIZE]
+        # a full chunk is only known not to be the last once more data follows it.
+        while len(self.buffer) > self.cipher.record_size:
+            self.submit(bytes(self.buffer[:self.cipher.record_size]), False)
+            del self.buffer[:self.cipher.record_size]
+
+    def submit(self, record, last):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.pending.append(self.executor.submit(self.cipher.decrypt_chunk, self.index, record, last))
+        self.index += 1
+        while len(self.pending) > self.jobs:
+            self.write_next()
+
+    def write_next(self):
+        try:
+            plain_text = self.pending.popleft().result()
+        except BaseException:
+            self.shutdown()
+            raise
+        self.file.write(plain_text)
+        self.decrypted += len(plain_text)
+
+    def shutdown(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def close(self):
+        # whatever is left is the last chunk, a stream cut short fails its verification.
+        if self.cipher is None:
+            raise IntegrityError('Encrypted stream ended inside its header.')
+        self.submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.write_next()
+        self.shutdown()
@@ -13,31 +13,30 @@
 #    limitations under the License.
 #
 
-from Crypto.Cipher import AES
-from Crypto import Random
+from os import urandom
 from logging import getLogger, DEBUG, WARN
+from .engines import get_block_size, get_engine, AES_CBC
 from .utility import decode_key, calculate_encrypted_file_size
 
-AES_CBC = 'AES|CBC'
+DEFAULT_ENCRYPTION_TYPE = AES_CBC
 
 log = getLogger(__name__)
 log.setLevel(WARN)
 
 
 class Cipher(object):
-    __block_sizes__ = {
-        AES_CBC: AES.block_size
-    }
-
-    def __init__(self, cipher_type, key, file_size=None, iv_generator=None):
+    def __init__(self, cipher_type, key, file_size=None, iv_generator=None, iv=None, engine=None):
         self.key = decode_key(key)
         self.cipher_type = cipher_type
         self.file_size = file_size
         self.block_size = Cipher.get_block_size(self.cipher_type)
+        # the name of one of engines.available_engines(cipher_type), None selects the fastest.
+        self.engine = get_engine(cipher_type, engine)
         if self.file_size:
-            self.last_block_size = self.file_size % self.block_size
-            self.number_of_blocks_remaining = int(self.file_size/self.block_size)
-        if iv_generator:
+            self.bytes_remaining = self.file_size
+        if iv is not None:
+            self.iv = iv
+        elif iv_generator:
             self.iv = next(iv_generator)
         else:
             self.iv = self.generate_iv()
@@ -45,16 +44,13 @@ class Cipher(object):
 
     @staticmethod
     def get_block_size(cipher_type):
-        return Cipher.__block_sizes__.get(cipher_type)
+        return get_block_size(cipher_type)
 
     def generate_iv(self):
-        return Random.new().read(self.get_block_size(self.cipher_type))
+        return urandom(self.get_block_size(self.cipher_type))
 
     def get_cipher(self):
-        cipher = {
-            AES_CBC: AES.new(self.key, AES.MODE_CBC, self.iv)
-        }
-        return cipher.get(self.cipher_type)
+        return self.engine(self.key, self.iv)
 
     def get_iv(self):
         return self.iv
@@ -62,15 +58,38 @@ class Cipher(object):
     def get_encrypted_file_size(self):
         return calculate_encrypted_file_size(self.file_size, self.block_size)
 
-    def decrypt(self, cipher_text):
-        plain_text = self.cipher.decrypt(cipher_text)
+    @staticmethod
+    def process_into(operation, data, output):
+        # runs operation writing into the start of the writable buffer output, returns a view of the bytes written.
+        output = memoryview(output)[:len(data)]
+        operation(data, output=output)
+        return output
+
+    def decrypt(self, cipher_text, output=None):
+        # cipher_text may hold any number of whole blocks, padding past file_size is dropped. With an output buffer
+        # of at least len(cipher_text) bytes, which may be cipher_text itself, a view of output is returned.
+        if output is None:
+            plain_text = self.cipher.decrypt(cipher_text)
+        else:
+            plain_text = self.process_into(self.cipher.decrypt, cipher_text, output)
         if self.file_size:
-            if self.number_of_blocks_remaining == 0:
-                return plain_text[:self.last_block_size]
-            self.number_of_blocks_remaining -= 1
+            plain_text = plain_text[:self.bytes_remaining]
+            self.bytes_remaining -= len(plain_text)
         return plain_text
 
-    def encrypt(self, b):
-        if len(b) < self.block_size:
-            b = b.ljust(self.block_size)
-        return self.cipher.encrypt(b)
+    def encrypt(self, b, output=None):
+        # pad the final partial block with spaces, any number of whole blocks may be encrypted at once. With an
+        # output buffer of at least the padded length, which may be b itself, a view of output is returned.
+        partial = len(b) % self.block_size
+        if partial:
+            padded_length = len(b) + self.block_size - partial
+            if output is None:
+                b = bytes(b).ljust(padded_length)
+            else:
+                padded = memoryview(output)[:padded_length]
+                padded[:len(b)] = b
+                padded[len(b):] = b' ' * (padded_length - len(b))
+                b = padded
+        if output is None:
+            return self.cipher.encrypt(b)
+        return self.process_into(self.cipher.encrypt, b, output)
@@ -14,218 +14,925 @@
 #
 
 import requests
-from requests_toolbelt.streaming_iterator import StreamingIterator
+from requests.adapters import HTTPAdapter
 import json
-from os import getcwd, stat
-from os.path import getsize, join, basename
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from io import BytesIO
+from itertools import chain, islice
+from threading import Lock
+from time import sleep, time
+from os import getcwd, stat, fsync, open as os_open, close as os_close, O_WRONLY
+from os.path import abspath, getsize, join, basename, exists
 from logging import getLogger, StreamHandler, Formatter, DEBUG, WARN
-from .cipher import Cipher, AES_CBC
-from .utility import EncryptingFileIterator
+from .chunked import ChunkedCipher, ChunkedDecryptingFileWriter, calculate_chunk_count, is_chunked, HEADER_SIZE
+from .cipher import Cipher, DEFAULT_ENCRYPTION_TYPE
+from .compression import CompressingReader, DecompressingFileWriter
+from .exceptions import CryptKeeperError, CryptKeeperHTTPError, CircuitOpenError
+from .instrumentation import NO_INSTRUMENTATION
+from .journal import Checkpoint, checkpoint_path, DEFAULT_CHECKPOINT_INTERVAL
+from .progress import ProgressMeter, DEFAULT_PROGRESS_INTERVAL
+from .retry import RetryPolicy, parse_retry_after
+from .utility import (
+    EncryptingFileIterator,
+    DecryptingFileWriter,
+    IteratorReader,
+    SizedIterable,
+    backoff_delay,
+    buffered_chunks,
+    calculate_block_range,
+    calculate_encrypted_file_size,
+    calculate_ranges,
+    decode_key,
+    encode_key,
+    pipeline,
+    prefetch,
+    read_fully,
+    run_concurrently,
+    spool_file,
+    url_expiry,
+    write_at,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_JOBS,
+    DEFAULT_PART_SIZE,
+    DEFAULT_RANGE_SIZE,
+)
 
-DEFAULT_ENCRYPTION_TYPE = AES_CBC
+DEFAULT_POOL_SIZE = 10
+DEFAULT_PART_RETRIES = 3
+# a single S3 PUT is limited to 5 GiB, larger files must use multipart uploads.
+DEFAULT_MULTIPART_THRESHOLD = 5 * 1024 ** 3
+# a download ticket this close to its url's expiry is fetched again rather than risk a rejected request.
+DEFAULT_TICKET_MARGIN = 30
+DEFAULT_SHARE_BATCH_SIZE = 500
+# a server answering a batch share with one of these has no batch endpoint.
+BATCH_UNSUPPORTED_STATUSES = (404, 405, 501)
+# a server answering a multipart upload start with one of these only takes single PUTs.
+MULTIPART_UNSUPPORTED_STATUSES = (404, 405, 501)
+# a multipart upload to resume answered with one of these is gone.
+MULTIPART_GONE_STATUSES = (404, 410)
 
 log = getLogger(__name__)
 
 URL_V1 = '{base_url}/api/v1/secure_document_service'
 
+UploadResult = namedtuple('UploadResult', ['filename', 'document_id', 'error'])
+DownloadResult = namedtuple('DownloadResult', ['document_id', 'downloaded', 'error'])
+ShareResult = namedtuple('ShareResult', ['document_id', 'username', 'resource_uri', 'error'])
+
+
+class DownloadTicket(namedtuple('DownloadTicket', ['document_id', 'download_info', 'expires_at'])):
+    # a get_download_url response fetched ahead of its transfer, expires_at is None when the url has no expiry.
+    def expired(self, margin=DEFAULT_TICKET_MARGIN):
+        return self.expires_at is not None and time() + margin >= self.expires_at
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, pool_connections=DEFAULT_POOL_SIZE, max_retries=0):
+    # one keep-alive connection pool per host, pool_size should be at least the number of concurrent transfers.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class CryptKeeperClient(object):
-    def __init__(self, url, user, api_key):
+    def __init__(self, url, user, api_key, session=None, retry_policy=None, raise_errors=False, instrumentation=None):
         self.url = URL_V1.format(base_url=url)
         self.user = user
         self.api_key = api_key
         if not all([url, user, api_key]):
             raise ValueError('Must initialize url, user, and api_key. (%s, %s, %s)' % (url, user, api_key))
+        self.session = session or create_session()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # by default failed calls log and return None, raise_errors raises the typed exceptions from .exceptions.
+        self.raise_errors = raise_errors
+        self.circuit_breakers = {}
+        self.circuit_breakers_lock = Lock()
+        # e.g. an instrumentation.CallbackInstrumentation, every request is recorded as a crypt_keeper.request.
+        self.instrumentation = instrumentation or NO_INSTRUMENTATION
+
+    def close(self):
+        self.session.close()
 
     def get_upload_url(self, document_metadata):
-        log.debug('***Entering CryptKeeperClient.get_upload_url({document_metadata})'.format(
-            document_metadata=document_metadata))
+        log.debug('***Entering CryptKeeperClient.get_upload_url(%s)', document_metadata)
         data = {
             'document_metadata': document_metadata,
         }
-        try:
-            url = '%s/upload_url/' % self.url
-            response = requests.post(
-                url=url,
-                headers={
-                    'Accept': 'application/json',
-                    'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
-                    'Content-Type': 'application/json; charset=utf-8',
-                },
-                data=json.dumps(data)
-            )
-            log.debug('Crypt-Keeper upload Response HTTP Status Code: {status_code}'.format(
-                status_code=response.status_code))
-            log.debug('Crypt-Keeper upload Response HTTP Response Body: {content}'.format(
-                content=response.content))
-            if response.status_code == 201:
-                return json.loads(response.content.decode('utf-8'))
-        except requests.exceptions.RequestException as e:
-            log.exception('Crypt-Keeper HTTP upload Request failed: %s', e)
-        return None
+        return self.request('post', '%s/upload_url/' % self.url, 201, data, endpoint='upload_url')
 
     def get_download_url(self, document_id):
-        log.debug('***Entering CryptKeeperClient.get_download_url({document_id})'.format(document_id=document_id))
-        try:
-            url = '%s/download_url/%s/' % (self.url, document_id)
-            log.debug('Trying URL: %s', url)
-            response = requests.get(
-                url=url,
-                headers={
-                    'Accept': 'application/json',
-                    'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
-                },
-            )
-            log.debug('Crypt-Keeper Response HTTP Status Code: {status_code}'.format(
-                status_code=response.status_code))
-            log.debug('Crypt-Keeper Response HTTP Response Body: {content}'.format(
-                content=response.content))
-            if response.status_code == 200:
-                return json.loads(response.content.decode('utf-8'))
-        except requests.exceptions.RequestException as e:
-            log.exception('Crypt-Keeper HTTP Request failed: %s', e)
-        return None
+        log.debug('***Entering CryptKeeperClient.get_download_url(%s)', document_id)
+        return self.request('get', '%s/download_url/%s/' % (self.url, document_id), 200, endpoint='download_url',
+                            document_id=document_id)
 
     def get_share(self, document_id):
-        log.debug('***Entering CryptKeeperClient.get_share({document_id})'.format(document_id=document_id))
-        try:
-            url = '{base_url}/share/{document_id}/'.format(
-                base_url=self.url,
-                document_id=document_id
-            )
-            log.debug('Trying URL: %s', url)
-            response = requests.get(
-                url=url,
-                headers={
-                    'Accept': 'application/json',
-                    'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
-                },
-            )
-            log.debug('Crypt-Keeper get share Response HTTP Status Code: {status_code}'.format(
-                status_code=response.status_code))
-            log.debug('Crypt-Keeper get share Response HTTP Response Body: {content}'.format(
-                content=response.content))
-            if response.status_code == 200:
-                return json.loads(response.content.decode('utf-8'))
-        except requests.exceptions.RequestException as e:
-            log.exception('Crypt-Keeper get share HTTP Request failed: %s', e)
-        return None
+        log.debug('***Entering CryptKeeperClient.get_share(%s)', document_id)
+        return self.request('get', '%s/share/%s/' % (self.url, document_id), 200, endpoint='share',
+                            document_id=document_id)
 
     def post_share(self, document_id, username):
-        log.debug('***Entering CryptKeeperClient.post_share({document_id}, {username})'.format(
-            document_id=document_id,
-            username=username,
-        ))
+        log.debug('***Entering CryptKeeperClient.post_share(%s, %s)', document_id, username)
         data = {
             'document_id': document_id,
             'username': username,
         }
-        try:
-            url = '%s/share/' % self.url
-            response = requests.post(
-                url=url,
-                headers={
-                    'Accept': 'application/json',
-                    'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
-                    'Content-Type': 'application/json; charset=utf-8',
-                },
-                data=json.dumps(data)
-            )
-            log.debug('Crypt-Keeper post share Response HTTP Status Code: {status_code}'.format(
-                status_code=response.status_code))
-            log.debug('Crypt-Keeper post share Response HTTP Response Body: {content}'.format(
-                content=response.content))
-            if response.status_code == 201:
-                return json.loads(response.content.decode('utf-8'))
-        except requests.exceptions.RequestException as e:
-            log.exception('Crypt-Keeper HTTP post share Request failed: %s', e)
-        return None
+        return self.request('post', '%s/share/' % self.url, 201, data, endpoint='share', document_id=document_id)
+
+    def post_shares(self, shares):
+        # one request for many (document_id, username) pairs, the response's results follow the order of shares.
+        # Always raises on failure, so callers can tell a server without the batch endpoint from a failed batch.
+        data = {
+            'shares': [{'document_id': document_id, 'username': username} for document_id, username in shares],
+        }
+        return self.request('post', '%s/share/batch/' % self.url, 201, data, endpoint='share', raise_errors=True)
+
+    def get_circuit_breaker(self, endpoint):
+        with self.circuit_breakers_lock:
+            if endpoint not in self.circuit_breakers:
+                self.circuit_breakers[endpoint] = self.retry_policy.new_circuit_breaker(endpoint)
+            return self.circuit_breakers[endpoint]
+
+    def request(self, method, url, expected_status, data=None, endpoint=None, raise_errors=None, document_id=None):
+        # retries follow self.retry_policy and every endpoint has its own circuit breaker, url by default.
+        # raise_errors overrides self.raise_errors for this call.
+        with self.instrumentation.operation(
+                'crypt_keeper.request', endpoint=endpoint, method=method.upper(), document_id=document_id) as operation:
+            return self.send(operation, method, url, expected_status, data, endpoint, raise_errors)
+
+    def send(self, operation, method, url, expected_status, data, endpoint, raise_errors):
+        raise_errors = self.raise_errors if raise_errors is None else raise_errors
+
+        def failed(error, cause=None):
+            operation.set(error=error.__class__.__name__)
+            if raise_errors:
+                raise error from cause
+            return None
+        kwargs = {
+            'url': url,
+            'headers': {
+                'Accept': 'application/json',
+                'Authorization': 'ApiKey %s:%s' % (self.user, self.api_key),
+            },
+        }
+        if data is not None:
+            kwargs['headers']['Content-Type'] = 'application/json; charset=utf-8'
+            kwargs['data'] = json.dumps(data)
+        circuit_breaker = self.get_circuit_breaker(endpoint or url)
+        attempt = 0
+        while True:
+            try:
+                trial = circuit_breaker.before_call()
+            except CircuitOpenError as e:
+                log.error('Crypt-Keeper %s %s skipped: %s', method.upper(), url, e)
+                return failed(e)
+            try:
+                try:
+                    response = getattr(self.session, method)(**kwargs)
+                except requests.exceptions.RequestException as e:
+                    circuit_breaker.record_failure()
+                    transient = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                    if transient and self.retry_policy.should_retry(method, attempt):
+                        delay = self.retry_policy.delay(attempt)
+                        log.warning('Crypt-Keeper %s %s failed, retrying in %.1fs: %s', method.upper(), url, delay, e)
+                        sleep(delay)
+                        attempt += 1
+                        operation.set(retries=attempt)
+                        continue
+                    log.exception('Crypt-Keeper HTTP %s %s Request failed: %s', method.upper(), url, e)
+                    return failed(CryptKeeperError('Crypt-Keeper %s %s failed: %s' % (method.upper(), url, e)), e)
+                except Exception:
+                    # anything else, e.g. a broken adapter, is a failure of the call as well.
+                    circuit_breaker.record_failure()
+                    raise
+                status_code = response.status_code
+                operation.set(status_code=status_code)
+                log.debug('Crypt-Keeper %s %s Response HTTP Status Code: %s', method.upper(), url, status_code)
+                if status_code == expected_status:
+                    circuit_breaker.record_success()
+                    result = json.loads(response.content.decode('utf-8'))
+                    if operation.attributes['document_id'] is None and isinstance(result, dict):
+                        # new documents only get their id from the response.
+                        operation.set(document_id=result.get('document_id'))
+                    return result
+                retry_after = None
+                if status_code == 429 or status_code >= 500:
+                    circuit_breaker.record_failure()
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if self.retry_policy.should_retry(method, attempt, status_code, retry_after):
+                        delay = self.retry_policy.delay(attempt, retry_after)
+                        log.warning('Crypt-Keeper %s %s returned %d, retrying in %.1fs.', method.upper(), url,
+                                    status_code, delay)
+                        sleep(delay)
+                        attempt += 1
+                        operation.set(retries=attempt)
+                        continue
+                else:
+                    # the service is up, it just refused this request.
+                    circuit_breaker.record_success()
+                log.error('Crypt-Keeper %s %s returned HTTP %d.', method.upper(), url, status_code)
+                return failed(CryptKeeperHTTPError(
+                    'Crypt-Keeper %s %s returned HTTP %d.' % (method.upper(), url, status_code),
+                    status_code,
+                    retry_after,
+                    url,
+                ))
+            finally:
+                # a trial call that ended without an outcome, e.g. when interrupted, must not keep the circuit half
+                # open.
+                if trial:
+                    circuit_breaker.end_trial()
+
+    # Multipart uploads: start returns the document_id and symmetric_key, each part gets its own single use url,
+    # and completion records the parts' etags and the final content_length, which may be unknown at the start.
+    def start_multipart_upload(self, document_metadata):
+        data = {
+            'document_metadata': document_metadata,
+        }
+        return self.request('post', '%s/multipart_upload/' % self.url, 201, data, endpoint='multipart_upload')
+
+    def get_part_upload_url(self, document_id, part_number):
+        url = '%s/multipart_upload/%s/part/%d/' % (self.url, document_id, part_number)
+        return self.request('get', url, 200, endpoint='multipart_upload', document_id=document_id)
+
+    def get_multipart_upload(self, document_id):
+        # an unfinished multipart upload's document_id and symmetric_key, used to resume it.
+        url = '%s/multipart_upload/%s/' % (self.url, document_id)
+        return self.request('get', url, 200, endpoint='multipart_upload', document_id=document_id)
+
+    def complete_multipart_upload(self, document_id, parts, content_length):
+        data = {
+            'parts': parts,
+            'content_length': content_length,
+        }
+        url = '%s/multipart_upload/%s/complete/' % (self.url, document_id)
+        return self.request('post', url, 200, data, endpoint='multipart_upload', document_id=document_id)
 
 
 class EncryptingS3Client(object):
-    def __init__(self, encryption_type, key, file_size, block_size=None):
+    def __init__(self, encryption_type, key, file_size, block_size=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 session=None, cipher_jobs=DEFAULT_JOBS, executor=None, instrumentation=None, document_id=None,
+                 progress=None):
         self.encryption_type = encryption_type
         self.key = key
         self.file_size = file_size
-        self.block_size = block_size
+        self.block_size = block_size or Cipher.get_block_size(encryption_type)
+        self.chunk_size = chunk_size
+        self.session = session or create_session()
+        # chunked types are sealed chunk by chunk, up to cipher_jobs chunks are encrypted or decrypted concurrently.
+        self.chunked = is_chunked(encryption_type)
+        self.cipher_jobs = cipher_jobs
+        # with an executor, possibly shared by many uploads, uploads run as a pipeline: a reader thread, encryption
+        # on the executor and the sender, connected by queues of at most cipher_jobs chunks.
+        self.executor = executor
+        # transfers are recorded as operations tagged with document_id, the cpu time ciphers use is only measured
+        # when instrumentation is enabled.
+        self.instrumentation = instrumentation or NO_INSTRUMENTATION
+        self.document_id = document_id
+        self.timer = self.instrumentation.cipher_timer()
+        # an optional progress.ProgressMeter counting the bytes sent or received.
+        self.progress = progress
+
+    def operation(self, name, timed=False, **attributes):
+        # a timed operation reports the cpu time this client's ciphers used while it ran.
+        return self.instrumentation.operation(
+            name, self.timer if timed else None, document_id=self.document_id, **attributes)
+
+    def track(self, total=None, done=0):
+        # reports progress of the transfer run in the returned context, the final event is sent when it exits.
+        return nullcontext() if self.progress is None else self.progress.begin(total, done)
+
+    def advance(self, count):
+        if self.progress is not None:
+            self.progress.update(count)
+
+    def get_encrypted_file_size(self, cipher):
+        if self.file_size is None:
+            return None
+        if self.chunked:
+            return cipher.get_encrypted_file_size(self.file_size)
+        return calculate_encrypted_file_size(self.file_size, self.block_size)
+
+    def get_cipher(self, file_size=None, iv=None):
+        cipher = Cipher(self.encryption_type, self.key, file_size, iv=iv)
+        return cipher if self.timer is None else self.timer.instrument(cipher, 'encrypt', 'decrypt')
+
+    def encrypted_stream(self, file, cipher):
+        if self.chunked and self.executor is None:
+            yield from cipher.encrypted_chunks(file, self.cipher_jobs)
+        elif self.chunked:
+            yield cipher.header
+            yield from pipeline(
+                cipher.plain_chunks(file), lambda chunk: cipher.encrypt_chunk(*chunk), self.executor, self.cipher_jobs)
+        elif self.executor is None:
+            yield from EncryptingFileIterator(file, cipher, self.chunk_size)
+        else:
+            # the CBC chain is kept by encrypting one chunk at a time, in order. Besides the cipher_jobs chunks queued,
+            # one is being read and one encrypted, so cipher_jobs + 2 plain text buffers are never overwritten in use.
+            yield cipher.get_iv()
+            yield from pipeline(
+                buffered_chunks(file, self.chunk_size, self.cipher_jobs + 2), cipher.encrypt, self.executor,
+                self.cipher_jobs, serial=True)
 
     def upload(self, file, url):
+        if self.chunked:
+            cipher = self.get_chunked_cipher()
+            encrypted_file_size = cipher.get_encrypted_file_size(self.file_size)
+        else:
+            cipher = self.get_cipher(self.file_size)
+            encrypted_file_size = cipher.get_encrypted_file_size()
+        stream = self.encrypted_stream(file, cipher)
         try:
-            cipher = Cipher(self.encryption_type, self.key, self.file_size)
-            iterator = EncryptingFileIterator(file, cipher)
-            streamer = StreamingIterator(cipher.get_encrypted_file_size(), iterator)
-            response = requests.put(
-                url=url,
-                data=streamer,
-            )
-            log.debug('S3 Upload HTTP Response Body: {content}'.format(
-                content=response.content))
+            with self.track(encrypted_file_size), \
+                    self.operation('s3.upload', timed=True, bytes=encrypted_file_size) as operation:
+                response = self.session.put(
+                    url=url,
+                    data=SizedIterable(
+                        encrypted_file_size, stream if self.progress is None else self.progress.counted(stream)),
+                )
+                operation.set(status_code=response.status_code)
+                log.debug('S3 Upload HTTP Response Body: %s', response.content)
+                response.raise_for_status()
             return True
         except requests.exceptions.RequestException as e:
             log.exception('S3 HTTP Request failed: %s', e)
+        finally:
+            stream.close()
         return False
 
+    def encrypted_parts(self, file, cipher, part_size, part_number=1):
+        # yields (part_number, cipher text, plain text length). Parts are encrypted in order by one cipher, so the
+        # CBC chain carries across part boundaries: the first part starts with the iv and every part but the last
+        # is a whole number of blocks. A chain continued from a later part_number does not repeat the iv.
+        data = cipher.get_iv() if part_number == 1 else b''
+        while True:
+            read = read_fully(file, part_size - len(data))
+            if read:
+                data += cipher.encrypt(read)
+            if not data:
+                return
+            yield part_number, data, len(read or b'')
+            if len(data) < part_size:
+                return
+            part_number += 1
+            data = b''
+
+    def encrypt_part(self, file, part_number, part_size, iv):
+        # re-encrypts one part of a seekable file given the cipher text block preceding it, or the file iv for the
+        # first part.
+        offset = 0 if part_number == 1 else (part_number - 1) * part_size - self.block_size
+        file.seek(offset)
+        read = read_fully(file, part_size - self.block_size if part_number == 1 else part_size)
+        data = self.get_cipher(iv=iv).encrypt(read) if read else b''
+        return part_number, iv + data if part_number == 1 else data, len(read or b'')
+
+    def resumable_parts(self, file, part_size, checkpoint):
+        # every part's iv is checkpointed before the part is sent. Parts that were encrypted but never confirmed
+        # are encrypted again from their iv, then the chain continues after the last part encrypted.
+        parts = checkpoint.state.setdefault('parts', {})
+        for key in sorted(parts, key=int):
+            if 'etag' not in parts[key]:
+                yield self.encrypt_part(file, int(key), part_size, decode_key(parts[key]['iv']))
+        next_part = checkpoint.state.get('next_part')
+        if next_part is None:
+            cipher = self.get_cipher(self.file_size)
+            part_number, offset = 1, 0
+        else:
+            cipher = self.get_cipher(iv=decode_key(next_part['iv']))
+            part_number, offset = next_part['part_number'], next_part['offset']
+        file.seek(offset)
+        iv = cipher.get_iv()
+        for part in self.encrypted_parts(file, cipher, part_size, part_number):
+            part_number, data, plain_length = part
+            parts[str(part_number)] = {'iv': encode_key(iv)}
+            offset += plain_length
+            iv = data[-self.block_size:]
+            checkpoint.state['next_part'] = {'part_number': part_number + 1, 'iv': encode_key(iv), 'offset': offset}
+            checkpoint.save()
+            yield part
+
+    def chunked_parts(self, file, cipher, part_size):
+        # yields (part_number, chunks, plain text length), every part holds whole chunks of plain text that are
+        # only sealed when the part is sent.
+        chunks = cipher.plain_chunks(file)
+        per_part = cipher.chunks_per_part(part_size)
+        part_number = 1
+        while True:
+            part = list(islice(chunks, per_part))
+            if not part:
+                return
+            yield part_number, part, sum(len(data) for _, data, _ in part)
+            part_number += 1
+
+    def resumable_chunked_parts(self, file, cipher, part_size, checkpoint):
+        # a part only depends on the header and its chunks, so any part not confirmed is read and sealed again.
+        parts = checkpoint.state.setdefault('parts', {})
+        per_part = cipher.chunks_per_part(part_size)
+        count = calculate_chunk_count(self.file_size, cipher.chunk_size)
+        for part_number, first in enumerate(range(0, count, per_part), 1):
+            if 'etag' in parts.get(str(part_number), {}):
+                continue
+            file.seek(first * cipher.chunk_size)
+            part = [
+                (index, read_fully(file, cipher.chunk_size) or b'', index == count - 1)
+                for index in range(first, min(first + per_part, count))
+            ]
+            parts[str(part_number)] = {}
+            yield part_number, part, sum(len(data) for _, data, _ in part)
+
+    def get_chunked_cipher(self, header=None, checkpoint=None):
+        # the header of a resumed upload is checkpointed, it holds no secrets.
+        if header is None and checkpoint is not None and 'header' in checkpoint.state:
+            header = decode_key(checkpoint.state['header'])
+        cipher = ChunkedCipher(self.encryption_type, self.key, header, self.chunk_size)
+        if self.timer is not None:
+            self.timer.instrument(cipher, 'encrypt_chunk', 'decrypt_chunk')
+        if checkpoint is not None and 'header' not in checkpoint.state:
+            checkpoint.state['header'] = encode_key(cipher.header)
+            checkpoint.save()
+        return cipher
+
+    def get_download_cipher(self, header):
+        # the size of a chunked download is only known once its header has arrived.
+        cipher = self.get_chunked_cipher(header)
+        if self.progress is not None:
+            self.progress.total = self.get_encrypted_file_size(cipher)
+        return cipher
+
+    def upload_part(self, get_part_url, part_number, data, retries=DEFAULT_PART_RETRIES):
+        # parts are retried on their own, a fresh url is requested for every attempt.
+        for attempt in range(retries + 1):
+            try:
+                url = get_part_url(part_number)
+                if url is None:
+                    raise requests.exceptions.RequestException('No upload url for part %d.' % part_number)
+                with self.operation(
+                        's3.upload_part', part_number=part_number, bytes=len(data), retries=attempt) as operation:
+                    response = self.session.put(
+                        url=url,
+                        data=data,
+                    )
+                    operation.set(status_code=response.status_code)
+                    log.debug('S3 Part %s Upload HTTP Status Code: %s', part_number, response.status_code)
+                    response.raise_for_status()
+                return response.headers.get('ETag')
+            except requests.exceptions.RequestException as e:
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+                log.warning('S3 part %d upload failed, retrying in %.1fs: %s', part_number, delay, e)
+                sleep(delay)
+
+    def upload_multipart(self, file, get_part_url, jobs=DEFAULT_JOBS, part_size=DEFAULT_PART_SIZE,
+                         retries=DEFAULT_PART_RETRIES, checkpoint=None):
+        # returns (parts, content_length) or None, at most 2 * jobs encrypted parts are held in memory.
+        # With a checkpoint file must be seekable, and parts confirmed by an earlier attempt are not sent again.
+        if part_size < self.block_size or part_size % self.block_size != 0:
+            raise ValueError('part_size must be a positive multiple of the cipher block size %d (got %s).' % (
+                self.block_size, part_size))
+        if self.chunked:
+            # chunked parts are sealed by the upload workers, so parts are encrypted concurrently.
+            cipher = self.get_chunked_cipher(checkpoint=checkpoint)
+            if checkpoint is None:
+                encrypted_parts = self.chunked_parts(file, cipher, part_size)
+            else:
+                encrypted_parts = self.resumable_chunked_parts(file, cipher, part_size, checkpoint)
+        elif checkpoint is None:
+            cipher = self.get_cipher(self.file_size)
+            encrypted_parts = self.encrypted_parts(file, cipher, part_size)
+        else:
+            encrypted_parts = self.resumable_parts(file, part_size, checkpoint)
+        parts = []
+        content_length = 0
+
+        def upload(part):
+            data = cipher.encrypt_part(part[1], part[0] == 1) if self.chunked else part[1]
+            etag = self.upload_part(get_part_url, part[0], data, retries)
+            self.advance(len(data))
+            return etag
+        total = self.get_encrypted_file_size(cipher if self.chunked else None)
+        done = 0
+        if checkpoint is not None:
+            # parts confirmed by an earlier attempt count as done, all but the last part have the same size.
+            part_bytes = cipher.chunks_per_part(part_size) * cipher.record_size if self.chunked else part_size
+            confirmed = sum(1 for part in checkpoint.state.get('parts', {}).values() if 'etag' in part)
+            done = min(confirmed * part_bytes, total)
+        with self.track(total, done), self.operation('s3.upload_multipart', timed=True) as operation:
+            results = run_concurrently(upload, encrypted_parts, jobs)
+            try:
+                for (part_number, _, plain_length), etag, error in results:
+                    if error is not None:
+                        log.error('S3 part %d upload failed: %s', part_number, error)
+                        operation.set(error=error.__class__.__name__)
+                        return None
+                    parts.append({'part_number': part_number, 'etag': etag})
+                    content_length += plain_length
+                    if checkpoint is not None:
+                        checkpoint.state['parts'][str(part_number)]['etag'] = etag
+                        checkpoint.save()
+            finally:
+                results.close()
+                operation.set(parts=len(parts))
+        if checkpoint is not None:
+            parts = [{'part_number': int(key), 'etag': part['etag']} for key, part in checkpoint.state['parts'].items()]
+            content_length = self.file_size
+        parts.sort(key=lambda part: part['part_number'])
+        return parts, content_length
+
     def download(self, file, url):
         try:
-            byte_generator = self.get_byte_steam_for_url(self.block_size, url)
-            cipher = Cipher(self.encryption_type, self.key, self.file_size, byte_generator)
-            for b in byte_generator:
-                decoded = cipher.decrypt(b)
-                file.write(decoded)
+            total = None if self.chunked else self.get_encrypted_file_size(None)
+            with self.track(total), self.operation('s3.download', timed=True) as operation:
+                byte_generator = self.get_byte_steam_for_url(self.chunk_size, url)
+                if self.chunked:
+                    writer = ChunkedDecryptingFileWriter(file, self.get_download_cipher, self.cipher_jobs)
+                else:
+                    writer = DecryptingFileWriter(file, self.get_cipher_for_iv, self.block_size)
+                try:
+                    for chunk in byte_generator:
+                        operation.mark('time_to_first_byte')
+                        operation.add('bytes', len(chunk))
+                        self.advance(len(chunk))
+                        writer.write(chunk)
+                    writer.close()
+                finally:
+                    # a failed request leaves chunks in flight, their workers are stopped here.
+                    if self.chunked:
+                        writer.shutdown()
             return True
         except requests.exceptions.RequestException as e:
             log.exception('S3 HTTP Request failed: %s', e)
             raise e
 
-    @staticmethod
-    def get_byte_steam_for_url(block_size, url):
-        response = requests.get(
+    def download_resumable(self, filename, url, checkpoint, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        # the checkpoint records the plain text bytes committed to filename and the cipher text block preceding
+        # them, which is the iv for a range request continuing from the next block.
+        committed = checkpoint.state.get('committed', 0) if exists(filename) else 0
+        with open(filename, 'r+b' if committed else 'wb') as file:
+            file.truncate(min(committed, self.file_size))
+            if committed >= self.file_size:
+                return True
+            file.seek(committed)
+
+            def cipher_factory(iv):
+                return self.get_cipher(self.file_size - committed, iv=iv)
+            writer = DecryptingFileWriter(file, cipher_factory, self.block_size)
+
+            def save():
+                file.flush()
+                fsync(file.fileno())
+                checkpoint.state['committed'] = committed + writer.decrypted
+                checkpoint.state['iv'] = encode_key(writer.last_block)
+                checkpoint.save()
+            saved = 0
+            try:
+                if committed:
+                    writer.write(decode_key(checkpoint.state['iv']))
+                start = committed + self.block_size if committed else 0
+                with self.track(self.get_encrypted_file_size(None), start), \
+                        self.operation('s3.download', timed=True, start=start) as operation:
+                    for chunk in self.get_byte_steam_for_url(self.chunk_size, url, start):
+                        operation.mark('time_to_first_byte')
+                        operation.add('bytes', len(chunk))
+                        self.advance(len(chunk))
+                        writer.write(chunk)
+                        if writer.decrypted - saved >= interval:
+                            save()
+                            saved = writer.decrypted
+                    writer.close()
+            except BaseException:
+                # includes KeyboardInterrupt, an interrupted download keeps everything decrypted so far.
+                if writer.decrypted > saved:
+                    save()
+                raise
+        return True
+
+    def download_ranges(self, filename, url, jobs=DEFAULT_JOBS, range_size=DEFAULT_RANGE_SIZE, checkpoint=None):
+        # CBC decryption of a block only needs the preceding cipher text block and chunks only need the header, so
+        # ranges are independent. With a checkpoint the start of every range written is recorded and a resumed
+        # download skips them.
+        done = set(checkpoint.state.get('ranges', [])) if checkpoint is not None and exists(filename) else set()
+        if not done:
+            with open(filename, 'wb') as file:
+                file.truncate(self.file_size)
+        if self.chunked:
+            cipher = self.get_chunked_cipher(self.get_range(url, 0, HEADER_SIZE - 1))
+            ranges = cipher.calculate_ranges(self.file_size, range_size)
+            download_range = partial(self.download_chunked_range, cipher=cipher)
+            received = HEADER_SIZE
+        else:
+            cipher = None
+            ranges = calculate_ranges(self.file_size, self.block_size, range_size)
+            download_range = self.download_range
+            received = 0
+
+        def range_bytes(byte_range):
+            # CBC ranges after the first start with the last block of the range before.
+            overlap = self.block_size if byte_range[0] and not self.chunked else 0
+            return byte_range[1] - byte_range[0] + 1 - overlap
+        received += sum(range_bytes(r) for r in ranges if r[0] in done)
+        ranges = [r for r in ranges if r[0] not in done]
+        fd = os_open(filename, O_WRONLY)
+        with self.track(self.get_encrypted_file_size(cipher), received), \
+                self.operation('s3.download_ranges', timed=True, ranges=len(ranges)):
+            results = run_concurrently(lambda r: download_range(fd, url, *r), ranges, jobs)
+            try:
+                for byte_range, _, error in results:
+                    if error is not None:
+                        log.error('S3 range %s download failed: %s', byte_range, error)
+                        raise error
+                    self.advance(range_bytes(byte_range))
+                    if checkpoint is not None:
+                        fsync(fd)
+                        done.add(byte_range[0])
+                        checkpoint.state['ranges'] = sorted(done)
+                        checkpoint.save()
+            finally:
+                # ranges still in flight must finish before their file descriptor is closed.
+                results.close()
+                os_close(fd)
+        return True
+
+    def get_range(self, url, start, end):
+        with self.operation('s3.get_range', start=start, end=end) as operation:
+            response = self.session.get(
+                url=url,
+                headers={
+                    'Range': 'bytes=%d-%d' % (start, end),
+                },
+            )
+            # requests' elapsed time ends when the response headers have been parsed.
+            operation.set(status_code=response.status_code, time_to_first_byte=response.elapsed.total_seconds())
+            log.debug('S3 Range %s-%s Response HTTP Status Code: %s', start, end, response.status_code)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.exceptions.RequestException(
+                    'S3 ignored the range request for bytes %d-%d.' % (start, end))
+            operation.set(bytes=len(response.content))
+        return response.content
+
+    def download_range(self, fd, url, start, end):
+        content = self.get_range(url, start, end)
+        cipher = self.get_cipher(self.file_size - start, iv=content[:self.block_size])
+        write_at(fd, cipher.decrypt(memoryview(content)[self.block_size:]), start)
+
+    def download_chunked_range(self, fd, url, start, end, cipher):
+        offset, plain_text = cipher.decrypt_range(self.get_range(url, start, end), start, end, self.file_size)
+        write_at(fd, plain_text, offset)
+
+    def read_range(self, url, offset, length):
+        # fetches and decrypts only the cipher text blocks, or chunks, covering the requested plain text.
+        length = min(length, self.file_size - offset)
+        if length <= 0:
+            return b''
+        with self.operation('s3.read_range', timed=True, offset=offset, length=length):
+            if self.chunked:
+                cipher = self.get_chunked_cipher(self.get_range(url, 0, HEADER_SIZE - 1))
+                start, end = cipher.calculate_chunk_range(
+                    offset // cipher.chunk_size, (offset + length - 1) // cipher.chunk_size + 1, self.file_size)
+                first, plain_text = cipher.decrypt_range(self.get_range(url, start, end), start, end, self.file_size)
+                return plain_text[offset - first:offset - first + length]
+            start, end = calculate_block_range(offset, length, self.block_size)
+            content = self.get_range(url, start, end)
+            cipher = self.get_cipher(iv=content[:self.block_size])
+            skip = offset - start
+            return cipher.decrypt(memoryview(content)[self.block_size:])[skip:skip + length]
+
+    def get_cipher_for_iv(self, iv):
+        return self.get_cipher(self.file_size, iv=iv)
+
+    def get_byte_steam_for_url(self, block_size, url, start=0):
+        headers = {
+            "Content-Type": "application/octet-stream",
+        }
+        if start:
+            headers['Range'] = 'bytes=%d-' % start
+        response = self.session.get(
             url=url,
-            headers={
-                "Content-Type": "application/octet-stream",
-            },
+            headers=headers,
             stream=True
         )
-        log.debug('S3 Download Response HTTP Status Code: {status_code}'.format(
-            status_code=response.status_code))
+        log.debug('S3 Download Response HTTP Status Code: %s', response.status_code)
+        response.raise_for_status()
+        if start and response.status_code != 206:
+            raise requests.exceptions.RequestException('S3 ignored the range request from byte %d.' % start)
         byte_generator = response.iter_content(block_size)
         return byte_generator
 
 
 class SimpleClient(object):
-    def __init__(self, crypt_keeper_client, content_type='text/plain'):
+    def __init__(self, crypt_keeper_client, content_type='text/plain', chunk_size=DEFAULT_CHUNK_SIZE,
+                 compression=None, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, part_size=DEFAULT_PART_SIZE,
+                 part_jobs=DEFAULT_JOBS, checkpoint_dir=None, share_cache=None,
+                 encryption_type=DEFAULT_ENCRYPTION_TYPE, cipher_jobs=DEFAULT_JOBS, instrumentation=None,
+                 progress_callback=None, progress_interval=DEFAULT_PROGRESS_INTERVAL):
         self.crypt_keeper_client = crypt_keeper_client
         self.content_type = content_type
+        self.chunk_size = chunk_size
+        # one of compression.available_compressions() or None to store documents uncompressed.
+        self.compression = compression
+        # files of at least multipart_threshold bytes and streams longer than one part use multipart uploads.
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_jobs = part_jobs
+        # with a checkpoint_dir, e.g. journal.DEFAULT_CHECKPOINT_DIR, interrupted file transfers resume where they
+        # stopped. Files larger than one part are then always sent as multipart uploads.
+        self.checkpoint_dir = checkpoint_dir
+        # an optional cache.TTLCache of share lists by document id, entries are dropped when post_share succeeds.
+        self.share_cache = share_cache
+        # None until the first post_shares call finds out whether the server has a batch share endpoint.
+        self.batch_shares = None
+        # the type new documents are encrypted with, downloads use the type recorded in each document's metadata.
+        # Chunked types, e.g. chunked.AES_GCM, spread encryption of one document over cipher_jobs threads.
+        self.encryption_type = encryption_type
+        self.cipher_jobs = cipher_jobs
+        # one pool of cipher_jobs threads encrypts for every upload of this client, created on first use.
+        self.cipher_executor = None
+        self.cipher_executor_lock = Lock()
+        # S3 transfers share the Crypt-Keeper connection pool for the lifetime of this client.
+        self.session = crypt_keeper_client.session
+        # records S3 transfers, see instrumentation. create() also hands it to the Crypt-Keeper client.
+        self.instrumentation = instrumentation or NO_INSTRUMENTATION
+        # called with a progress.ProgressEvent for each file transfer every progress_interval seconds and when it
+        # finishes, e.g. a progress.ProgressBar. Events of concurrent transfers arrive on their own threads.
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
 
     @classmethod
-    def create(cls, url, user, api_key, content_type='text/plain'):
-        crypt_keeper_client = CryptKeeperClient(url, user, api_key)
-        return cls(crypt_keeper_client, content_type)
+    def create(cls, url, user, api_key, content_type='text/plain', chunk_size=DEFAULT_CHUNK_SIZE, session=None,
+               compression=None, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, part_size=DEFAULT_PART_SIZE,
+               part_jobs=DEFAULT_JOBS, checkpoint_dir=None, retry_policy=None, raise_errors=False, share_cache=None,
+               encryption_type=DEFAULT_ENCRYPTION_TYPE, cipher_jobs=DEFAULT_JOBS, instrumentation=None,
+               progress_callback=None, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        crypt_keeper_client = CryptKeeperClient(
+            url, user, api_key, session, retry_policy, raise_errors, instrumentation)
+        return cls(crypt_keeper_client, content_type, chunk_size, compression, multipart_threshold, part_size,
+                   part_jobs, checkpoint_dir, share_cache, encryption_type, cipher_jobs, instrumentation,
+                   progress_callback, progress_interval)
+
+    def close(self):
+        self.crypt_keeper_client.close()
+        if self.cipher_executor is not None:
+            self.cipher_executor.shutdown()
+            self.cipher_executor = None
+
+    def __enter__(self):
+        return self
+
+    def get_cipher_executor(self):
+        with self.cipher_executor_lock:
+            if self.cipher_executor is None:
+                self.cipher_executor = ThreadPoolExecutor(
+                    max_workers=self.cipher_jobs, thread_name_prefix='ckc-cipher')
+            return self.cipher_executor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_progress(self, operation, name, document_id):
+        if self.progress_callback is None:
+            return None
+        return ProgressMeter(self.progress_callback, operation, name, document_id, self.progress_interval)
 
     def upload_file(self, filename):
-        file_size = getsize(filename)
-        document_metadata = {
+        with open(filename, 'rb') as file:
+            if self.compression is not None:
+                # the compressed size is unknown until the whole file has been read.
+                return self.upload_stream(file, basename(filename))
+            file_size = getsize(filename)
+            if self.checkpoint_dir is not None and file_size > self.part_size:
+                checkpoint = Checkpoint(
+                    checkpoint_path(self.checkpoint_dir, 'upload', filename),
+                    filename=abspath(filename),
+                    file_size=file_size,
+                    mtime=stat(filename).st_mtime_ns,
+                    part_size=self.part_size,
+                )
+                return self.upload_fileobj_multipart(file, file_size, basename(filename), checkpoint=checkpoint)
+            if file_size >= self.multipart_threshold:
+                return self.upload_fileobj_multipart(file, file_size, basename(filename))
+            return self.upload_fileobj(file, file_size, basename(filename))
+
+    def upload_stream(self, stream, name):
+        # stream is a binary file-like object or an iterable of bytes of unknown length, e.g. stdin or a pipe.
+        # Streams that fit in one part use a single PUT, anything longer is sent as a multipart upload.
+        if not hasattr(stream, 'read'):
+            stream = IteratorReader(stream)
+        compressed = self.compression is not None
+        if compressed:
+            stream = CompressingReader(stream, self.compression, self.chunk_size)
+        head = read_fully(stream, self.part_size)
+        if len(head) < self.part_size:
+            return self.upload_fileobj(BytesIO(head), len(head), name, compressed)
+        stream = IteratorReader(chain([head], iter(partial(stream.read, self.chunk_size), b'')))
+        return self.upload_fileobj_multipart(stream, None, name, compressed)
+
+    def get_document_metadata(self, file_size, name, compressed=False):
+        # content_length is the number of bytes stored, after any compression.
+        return {
             'content_length': file_size,
             'content_type': self.content_type,
-            'name': basename(filename),
-            'compressed': False,
-            'encryption_type': DEFAULT_ENCRYPTION_TYPE,
+            'name': name,
+            'compressed': compressed,
+            'encryption_type': self.encryption_type,
         }
+
+    def upload_fileobj(self, file, file_size, name, compressed=False):
+        document_metadata = self.get_document_metadata(file_size, name, compressed)
         upload_info = self.crypt_keeper_client.get_upload_url(document_metadata)
         if not upload_info:
             return None
-        with open(filename, 'rb') as file:
-            key = upload_info.get('symmetric_key')
-            encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
-            s3_client = EncryptingS3Client(encryption_type, key, file_size)
-            url = upload_info.get('single_use_url')
-            if s3_client.upload(file, url):
-                return upload_info.get('document_id')
+        key = upload_info.get('symmetric_key')
+        encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
+        s3_client = EncryptingS3Client(
+            encryption_type, key, file_size, chunk_size=self.chunk_size, session=self.session,
+            cipher_jobs=self.cipher_jobs, executor=self.get_cipher_executor(), instrumentation=self.instrumentation,
+            document_id=upload_info.get('document_id'),
+            progress=self.get_progress('upload', name, upload_info.get('document_id')))
+        url = upload_info.get('single_use_url')
+        if s3_client.upload(file, url):
+            return upload_info.get('document_id')
         return None
 
-    def download_file(self, document_id, file_name=None, file_path=None):
+    def upload_fileobj_multipart(self, file, file_size, name, compressed=False, checkpoint=None):
+        # file_size may be None for streams, the final content_length is sent when the upload completes.
+        # A checkpoint needs a seekable file, the upload it names is continued if the server still has it.
+        document_metadata = self.get_document_metadata(file_size, name, compressed)
+        upload_info = None
+        if checkpoint is not None and 'document_id' in checkpoint.state:
+            # the key is fetched again rather than ever being written to the checkpoint.
+            try:
+                upload_info = self.crypt_keeper_client.get_multipart_upload(checkpoint.state['document_id'])
+            except CryptKeeperHTTPError as e:
+                if e.status_code not in MULTIPART_GONE_STATUSES:
+                    raise
+            if not upload_info:
+                log.warning('Multipart upload %s can not be resumed, starting over.', checkpoint.state['document_id'])
+                checkpoint.reset()
+        if not upload_info:
+            try:
+                upload_info = self.crypt_keeper_client.start_multipart_upload(document_metadata)
+            except CryptKeeperHTTPError as e:
+                if e.status_code not in MULTIPART_UNSUPPORTED_STATUSES:
+                    raise
+            if upload_info and checkpoint is not None:
+                checkpoint.state['document_id'] = upload_info.get('document_id')
+                checkpoint.save()
+        if not upload_info:
+            # servers without multipart support only take a single PUT, which needs the size up front.
+            log.warning('Multipart upload unavailable for %s, falling back to a single PUT.', name)
+            if file_size is not None:
+                return self.upload_fileobj(file, file_size, name, compressed)
+            spool, file_size = spool_file(file, self.chunk_size)
+            with spool:
+                return self.upload_fileobj(spool, file_size, name, compressed)
+        document_id = upload_info.get('document_id')
+        key = upload_info.get('symmetric_key')
+        encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
+        s3_client = EncryptingS3Client(
+            encryption_type, key, file_size, chunk_size=self.chunk_size, session=self.session,
+            cipher_jobs=self.cipher_jobs, instrumentation=self.instrumentation, document_id=document_id,
+            progress=self.get_progress('upload', name, document_id))
+
+        def get_part_url(part_number):
+            part_info = self.crypt_keeper_client.get_part_upload_url(document_id, part_number)
+            return None if part_info is None else part_info.get('single_use_url')
+        uploaded = s3_client.upload_multipart(file, get_part_url, self.part_jobs, self.part_size, checkpoint=checkpoint)
+        if uploaded is None:
+            return None
+        parts, content_length = uploaded
+        if self.crypt_keeper_client.complete_multipart_upload(document_id, parts, content_length) is None:
+            return None
+        if checkpoint is not None:
+            checkpoint.delete()
+        return document_id
+
+    def upload_files(self, filenames, jobs=DEFAULT_JOBS):
+        # results are yielded in completion order, the session pool should allow at least jobs connections.
+        for filename, document_id, error in run_concurrently(self.upload_file, filenames, jobs):
+            if error is not None:
+                log.error('Upload of %s failed: %s', filename, error)
+                error = str(error) or error.__class__.__name__
+            elif document_id is None:
+                error = 'Upload failed, see logs.'
+            yield UploadResult(filename, document_id, error)
+
+    def get_download_ticket(self, document_id):
         download_info = self.crypt_keeper_client.get_download_url(document_id)
         if download_info is None:
-            return False
+            return None
+        return DownloadTicket(document_id, download_info, url_expiry(download_info.get('single_use_url')))
+
+    def download_file(self, document_id, file_name=None, file_path=None, range_jobs=1, ticket=None):
+        # ticket is an optional prefetched get_download_ticket result, an expired one is fetched again.
+        if ticket is None or ticket.expired():
+            ticket = self.get_download_ticket(document_id)
+            if ticket is None:
+                return False
+        download_info = ticket.download_info
         document_metadata = download_info.get('document_metadata', {})
         encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
         key = download_info.get('symmetric_key')
@@ -233,26 +940,158 @@ class SimpleClient(object):
         filename = self.generate_file_name(document_id, document_metadata, file_name, file_path)
         block_size = Cipher.get_block_size(encryption_type)
         url = download_info.get('single_use_url')
-        s3_client = EncryptingS3Client(encryption_type, key, file_size, block_size)
+        s3_client = EncryptingS3Client(
+            encryption_type, key, file_size, block_size, self.chunk_size, self.session, cipher_jobs=self.cipher_jobs,
+            instrumentation=self.instrumentation, document_id=document_id,
+            progress=self.get_progress('download', basename(filename), document_id))
+        compressed = document_metadata.get('compressed', False)
+        if self.checkpoint_dir is not None and not compressed:
+            # decompressor state can not be checkpointed, compressed documents always download from the start.
+            # Chunked documents are resumed by range.
+            by_range = range_jobs > 1 or s3_client.chunked
+            checkpoint = Checkpoint(
+                checkpoint_path(self.checkpoint_dir, 'download', filename),
+                document_id=document_id,
+                content_length=file_size,
+                range_size=DEFAULT_RANGE_SIZE if by_range else None,
+            )
+            if by_range:
+                s3_client.download_ranges(filename, url, range_jobs, checkpoint=checkpoint)
+            else:
+                s3_client.download_resumable(filename, url, checkpoint)
+            checkpoint.delete()
+            return True
+        if range_jobs > 1 and not compressed:
+            return s3_client.download_ranges(filename, url, range_jobs)
         with open(filename, 'wb') as file:
-            s3_client.download(file, url)
+            if compressed:
+                decompressing_file = DecompressingFileWriter(file)
+                s3_client.download(decompressing_file, url)
+                decompressing_file.close()
+            else:
+                s3_client.download(file, url)
             file.flush()
             file.close()
         return True
 
+    def download_files(self, document_ids, file_path=None, jobs=DEFAULT_JOBS, range_jobs=1, lookahead=None):
+        # results are yielded in completion order, each document is written to file_path under its metadata name.
+        # Download tickets are fetched up to lookahead documents ahead of the transfers, 2 * jobs by default.
+        tickets = prefetch(self.get_download_ticket, document_ids, lookahead or 2 * jobs)
+
+        def download(prefetched):
+            document_id, ticket, error = prefetched
+            if error is not None:
+                raise error
+            if ticket is None:
+                return False
+            return self.download_file(document_id, file_path=file_path, range_jobs=range_jobs, ticket=ticket)
+        for (document_id, _, _), downloaded, error in run_concurrently(download, tickets, jobs):
+            if error is not None:
+                log.error('Download of %s failed: %s', document_id, error)
+                error = str(error) or error.__class__.__name__
+            elif not downloaded:
+                error = 'Download failed, see logs.'
+            yield DownloadResult(document_id, bool(downloaded), error)
+
+    def read_document(self, document_id, offset=0, length=None):
+        # returns plain text bytes [offset, offset + length), a negative offset counts back from the end.
+        download_info = self.crypt_keeper_client.get_download_url(document_id)
+        if download_info is None:
+            return None
+        document_metadata = download_info.get('document_metadata', {})
+        encryption_type = document_metadata.get('encryption_type', DEFAULT_ENCRYPTION_TYPE)
+        key = download_info.get('symmetric_key')
+        file_size = int(document_metadata.get('content_length'))
+        if document_metadata.get('compressed', False):
+            raise ValueError('Document %s is compressed and does not support byte range reads.' % document_id)
+        if offset < 0:
+            offset = max(file_size + offset, 0)
+        if length is None:
+            length = file_size - offset
+        s3_client = EncryptingS3Client(
+            encryption_type, key, file_size, session=self.session, instrumentation=self.instrumentation,
+            document_id=document_id)
+        return s3_client.read_range(download_info.get('single_use_url'), offset, length)
+
     def get_share(self, document_id):
+        generation = None
+        if self.share_cache is not None:
+            users = self.share_cache.get(document_id)
+            if users is not None:
+                return list(users)
+            # a share posted while the lookup is in flight invalidates the entry, the list fetched is then not cached.
+            generation = self.share_cache.generation()
         users = []
         share_info = self.crypt_keeper_client.get_share(document_id)
         if share_info is not None:
             users = share_info.get('users', []) or []
+            # failed lookups are not cached, the next call asks the service again.
+            if self.share_cache is not None:
+                self.share_cache.put(document_id, tuple(users), generation)
         return users
 
     def post_share(self, document_id, username):
         share_info = self.crypt_keeper_client.post_share(document_id, username)
         if share_info is None:
             return False
+        if self.share_cache is not None:
+            self.share_cache.invalidate(document_id)
         return share_info.get('resource_uri')
 
+    def post_share_batch(self, shares):
+        # returns a ShareResult per pair, or None when the server has no batch endpoint.
+        try:
+            response = self.crypt_keeper_client.post_shares(shares)
+        except CryptKeeperHTTPError as e:
+            if e.status_code in BATCH_UNSUPPORTED_STATUSES:
+                return None
+            return [ShareResult(document_id, username, None, str(e)) for document_id, username in shares]
+        except CryptKeeperError as e:
+            return [ShareResult(document_id, username, None, str(e)) for document_id, username in shares]
+        results = []
+        for (document_id, username), result in zip(shares, response.get('results', [])):
+            resource_uri = result.get('resource_uri')
+            if resource_uri and self.share_cache is not None:
+                self.share_cache.invalidate(document_id)
+            error = None if resource_uri else result.get('error') or 'Share failed.'
+            results.append(ShareResult(document_id, username, resource_uri, error))
+        for document_id, username in shares[len(results):]:
+            results.append(ShareResult(document_id, username, None, 'Missing from the batch response.'))
+        return results
+
+    def post_shares(self, shares, jobs=DEFAULT_JOBS, batch_size=DEFAULT_SHARE_BATCH_SIZE):
+        # shares is an iterable of (document_id, username) pairs, a ShareResult is yielded for each pair.
+        # Pairs are sent batch_size at a time to the batch endpoint, or as concurrent single shares when the server
+        # does not have one.
+        shares = iter(shares)
+        batches = iter(lambda: list(islice(shares, batch_size)), [])
+        if self.batch_shares is None:
+            first = next(batches, None)
+            if first is None:
+                return
+            results = self.post_share_batch(first)
+            self.batch_shares = results is not None
+            if self.batch_shares:
+                yield from results
+            else:
+                log.warning('Batch share endpoint unavailable, sharing one pair per request.')
+                batches = chain([first], batches)
+        if self.batch_shares:
+            for _, results, error in run_concurrently(self.post_share_batch, batches, jobs):
+                if error is not None:
+                    raise error
+                yield from results
+            return
+        for (document_id, username), resource_uri, error in run_concurrently(
+                lambda pair: self.post_share(*pair), chain.from_iterable(batches), jobs):
+            if error is not None:
+                log.error('Share of %s with %s failed: %s', document_id, username, error)
+                error = str(error) or error.__class__.__name__
+            elif not resource_uri:
+                error = 'Share failed, see logs.'
+            yield ShareResult(document_id, username, resource_uri or None, error)
+
     @staticmethod
     def generate_file_name(document_id, document_metadata, file_name, file_path):
         path = getcwd() if file_path is None else file_path
@@ -13,20 +13,30 @@
 #    limitations under the License.
 #
 
-from logging import StreamHandler, Formatter, getLogger, DEBUG, ERROR, basicConfig, root
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from .client import SimpleClient, log as client_log
-from . import console_handler
+from logging import StreamHandler, Formatter, getLogger, DEBUG, ERROR, WARN, basicConfig, root
+from argparse import ArgumentParser, ArgumentTypeError, RawDescriptionHelpFormatter
+from .cipher import DEFAULT_ENCRYPTION_TYPE
+from .compression import available_compressions, DEFAULT_COMPRESSION
+from .engines import AES_CBC, AES_GCM
+from .journal import DEFAULT_CHECKPOINT_DIR
+from .progress import JsonProgress, ProgressBar, DEFAULT_PROGRESS_INTERVAL
+from .utility import DEFAULT_JOBS
 from json import dumps, loads
-from sys import stdin, stderr
+from itertools import chain
+from contextlib import ExitStack
+from sys import stdin, stdout, stderr
 from os import path
 
 
 # setup logging
 log = getLogger(__name__)
+console_handler = StreamHandler()
+console_handler.setLevel(WARN)
 
 
 CONFIGURATION_FILE_NAME = path.join(path.expanduser('~'), '.ckc_config.json')
+# an object in piped input spanning more lines than this is given up on.
+MAX_DOCUMENT_LINES = 1000
 REQUIRED_CONFIG = {
     'url': ('url', 'Service URL'),
     'user': ('user', 'User name'),
@@ -39,7 +49,7 @@ def merge(override_map=None, default_map=None):
     m.update(override_map)
     for key in m:
         if m[key] is None:
-            m[key] = default_map.get(key)
+            m[key] = (default_map or {}).get(key)
     return m
 
 
@@ -66,6 +76,91 @@ def validate_config(config):
         return r
 
 
+def positive_int(text):
+    # job counts size thread pools, which need at least one worker.
+    try:
+        value = int(text)
+    except ValueError:
+        raise ArgumentTypeError('invalid int value: {text!r}'.format(text=text))
+    if value < 1:
+        raise ArgumentTypeError('must be a positive integer: {text!r}'.format(text=text))
+    return value
+
+
+def parse_object(text):
+    # the json object in text, or None when text is not one.
+    try:
+        document = loads(text)
+    except ValueError:
+        return None
+    return document if isinstance(document, dict) else None
+
+
+def read_document_ids(lines):
+    # newline delimited json, an object spanning several lines is accumulated until it parses. Unreadable text is
+    # dropped once a later line holds a whole object or after MAX_DOCUMENT_LINES lines.
+    pending = []
+    for line in lines:
+        if not pending and not line.strip():
+            continue
+        pending.append(line)
+        try:
+            document = loads(''.join(pending))
+        except ValueError:
+            if len(pending) > 1 and parse_object(line) is not None:
+                log.warning('Skipping unreadable input: {text}'.format(text=''.join(pending[:-1]).strip()))
+                pending = [line]
+                document = parse_object(line)
+            elif len(pending) >= MAX_DOCUMENT_LINES:
+                log.warning('Skipping {count} unreadable lines of input.'.format(count=len(pending)))
+                pending = []
+                continue
+            else:
+                continue
+        pending = []
+        if not isinstance(document, dict):
+            log.warning('Skipping input that is not an object: {document}'.format(document=document))
+            continue
+        document_id = document.get('documentId')
+        if document_id is None:
+            log.warning('Skipping input without a documentId: {document}'.format(document=document))
+        else:
+            yield document_id
+
+
+def read_document_id(file):
+    # the documentId of the json object in file, e.g. the output of ckc upload --json.
+    with file:
+        document = parse_object(file.read())
+    return document.get('documentId') if document is not None else None
+
+
+def read_share_pairs(lines, usernames=()):
+    # (document_id, username) pairs from lines of "document_id [username]" or json objects with a documentId and an
+    # optional username, e.g. upload output. Documents without a username are shared with each of usernames.
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                document = loads(line)
+            except ValueError:
+                log.warning('Skipping unreadable share input: {line}'.format(line=line))
+                continue
+            document_id = document.get('documentId')
+            username = document.get('username')
+        else:
+            fields = line.split()
+            document_id = fields[0]
+            username = fields[1] if len(fields) > 1 else None
+        if document_id is None:
+            log.warning('Skipping input without a documentId: {line}'.format(line=line))
+            continue
+        for username in [username] if username else usernames:
+            yield document_id, username
+
+
 def main():
     parser = ArgumentParser(
         formatter_class=RawDescriptionHelpFormatter,
@@ -117,6 +212,25 @@ def main():
         action='store_true',
         help='Output json data.',
     )
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        default=None,
+        help='Report transfer progress on stderr, a progress bar or json events with --json. Defaults to on when '
+             'stderr is a terminal.',
+    )
+    parser.add_argument(
+        '--no-progress',
+        action='store_false',
+        dest='progress',
+        help='Do not report transfer progress.',
+    )
+    parser.add_argument(
+        '--progress-interval',
+        type=float,
+        default=DEFAULT_PROGRESS_INTERVAL,
+        help='Seconds between progress reports.',
+    )
     sub_parsers = parser.add_subparsers(
         title='sub-command',
         description='valid sub-commands',
@@ -126,14 +240,54 @@ def main():
 
     upload_parser = sub_parsers.add_parser('upload', help='upload help')
     upload_parser.add_argument(
-        'filename',
-        help='The name of the file to upload.'
+        'filenames',
+        metavar='FILE',
+        nargs='+',
+        help='The name of the file(s) to upload, - reads the document from stdin.'
+    )
+    upload_parser.add_argument(
+        '-n',
+        '--name',
+        help='The document name when uploading from stdin.'
+    )
+    upload_parser.add_argument(
+        '--jobs',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='The number of files to upload concurrently.'
+    )
+    upload_parser.add_argument(
+        '--compress',
+        nargs='?',
+        const=DEFAULT_COMPRESSION,
+        choices=available_compressions(),
+        help='Compress before encrypting, defaults to %s when no algorithm is given.' % DEFAULT_COMPRESSION
+    )
+    upload_parser.add_argument(
+        '--encryption',
+        choices=[AES_CBC, AES_GCM],
+        help='The encryption type, defaults to %s. %s is authenticated and encrypts on several cores.' % (
+            DEFAULT_ENCRYPTION_TYPE, AES_GCM)
+    )
+    upload_parser.add_argument(
+        '--cipher-jobs',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='The number of threads encrypting, shared by all files being uploaded.'
+    )
+    upload_parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Checkpoint progress in %s, rerun the same command to resume an interrupted upload.' % (
+            DEFAULT_CHECKPOINT_DIR)
     )
 
     download_parser = sub_parsers.add_parser('download', help='download help')
     download_parser.add_argument(
-        'document_id',
-        help='The document id for the document to download.'
+        'document_ids',
+        metavar='DOCUMENT_ID',
+        nargs='+',
+        help='The document id(s) to download, - reads newline delimited json from stdin.'
     )
     download_parser.add_argument(
         '-f',
@@ -145,23 +299,85 @@ def main():
         '--path',
         help='The path to the file to download.'
     )
+    download_parser.add_argument(
+        '--jobs',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='The number of documents to download concurrently.'
+    )
+    download_parser.add_argument(
+        '--range-jobs',
+        type=positive_int,
+        default=1,
+        help='The number of concurrent byte range requests per document.'
+    )
+    download_parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Checkpoint progress in %s, rerun the same command to resume an interrupted download.' % (
+            DEFAULT_CHECKPOINT_DIR)
+    )
+
+    read_parser = sub_parsers.add_parser('read', help='Write a byte range of a document to stdout.')
+    read_parser.add_argument(
+        'document_id',
+        help='The document id for the document to read.'
+    )
+    read_parser.add_argument(
+        '-o',
+        '--offset',
+        type=int,
+        default=0,
+        help='The offset of the first byte to read, negative values count back from the end.'
+    )
+    read_parser.add_argument(
+        '-l',
+        '--length',
+        type=int,
+        help='The number of bytes to read, defaults to the rest of the document.'
+    )
 
     share_parser = sub_parsers.add_parser('share', help='share help')
     share_parser.add_argument(
         'document_id',
+        nargs='?',
         help='The document id to share or lookup.'
     )
     share_parser.add_argument(
         '-a',
         '--add',
-        help='The name of a user to add to document share.'
+        nargs='+',
+        metavar='USERNAME',
+        help='The name(s) of users to add to document share.'
+    )
+    share_parser.add_argument(
+        '--batch',
+        metavar='FILE',
+        help='Share the "document_id [username]" lines or json objects in FILE, - reads stdin. Documents without a '
+             'username are shared with every --add user.'
+    )
+    share_parser.add_argument(
+        '--jobs',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='The number of concurrent share requests.'
     )
 
     write_config_parser = sub_parsers.add_parser('write-config', help='Write supplied required args to config file.')
 
     args = vars(parser.parse_args())
+    if args.get('sub_parser_name') == 'upload' and '-' in args['filenames'] and len(args['filenames']) > 1:
+        # stdin is uploaded as a single document, so it cannot be one of several files.
+        upload_parser.error('- cannot be combined with other files.')
+    if args.get('sub_parser_name') == 'download' and args.get('filename') and len(args['document_ids']) > 1:
+        download_parser.error('-f/--filename can only be used with a single document id.')
+    if args.get('sub_parser_name') == 'share' and args.get('document_id') == '-' and args.get('batch') == '-':
+        share_parser.error('- cannot be both the document id and the --batch file.')
+    if console_handler not in root.handlers:
+        root.addHandler(console_handler)
     config = get_config(args)
     if config.get('debug'):
+        from .client import log as client_log
         log.setLevel(DEBUG)
         client_log.setLevel(DEBUG)
         console_handler.setLevel(DEBUG)
@@ -197,15 +413,45 @@ def main():
         parser.print_usage()
         exit()
 
+    # requests and the cipher libraries are only loaded once a command that talks to the service has been parsed.
+    from .client import SimpleClient, create_session, DEFAULT_POOL_SIZE
+    concurrency = (config.get('jobs') or 1) * (config.get('range_jobs') or 1)
+    session = create_session(pool_size=max(concurrency, DEFAULT_POOL_SIZE))
+    checkpoint_dir = DEFAULT_CHECKPOINT_DIR if config.get('resume') else None
+    encryption_type = config.get('encryption') or DEFAULT_ENCRYPTION_TYPE
+    cipher_jobs = config.get('cipher_jobs') or DEFAULT_JOBS
+    progress = config.get('progress')
+    if progress is None:
+        progress = stderr.isatty()
+    progress_callback = None
+    if progress:
+        # stdout is kept for results, which may be piped into another ckc command.
+        progress_callback = JsonProgress(stderr) if json else ProgressBar(stderr)
+    progress_interval = config.get('progress_interval') or DEFAULT_PROGRESS_INTERVAL
     if config.get('content_type') is None:
-        client = SimpleClient.create(config['url'], config['user'], config['api_key'])
+        client = SimpleClient.create(
+            config['url'], config['user'], config['api_key'], session=session, compression=config.get('compress'),
+            checkpoint_dir=checkpoint_dir, encryption_type=encryption_type, cipher_jobs=cipher_jobs,
+            progress_callback=progress_callback, progress_interval=progress_interval)
     else:
-        client = SimpleClient.create(['url'], config['user'], config['api_key'], config['content_type'])
+        client = SimpleClient.create(
+            config['url'], config['user'], config['api_key'], config['content_type'], session=session,
+            compression=config.get('compress'), checkpoint_dir=checkpoint_dir, encryption_type=encryption_type,
+            cipher_jobs=cipher_jobs, progress_callback=progress_callback, progress_interval=progress_interval)
+    if config['sub_parser_name'] == 'download' and config['document_ids'] == ['-'] and config.get('filename'):
+        # e.g. ckc upload x --json | ckc download - -f out, a single piped document keeps the name given.
+        config['document_ids'] = list(read_document_ids(stdin))
+        if len(config['document_ids']) != 1:
+            download_parser.error('-f/--filename can only be used with a single document id, stdin had {count}.'.format(
+                count=len(config['document_ids'])))
     if config['sub_parser_name'] is None:
         parser.print_usage()
         exit()
-    elif config['sub_parser_name'] == 'upload':
-        output = client.upload_file(config['filename'])
+    elif config['sub_parser_name'] == 'upload' and len(config['filenames']) == 1:
+        if config['filenames'][0] == '-':
+            output = client.upload_stream(stdin.buffer, config.get('name') or 'stdin')
+        else:
+            output = client.upload_file(config['filenames'][0])
         if json:
             print(dumps(
                 {
@@ -214,16 +460,31 @@ def main():
             ))
         else:
             print('Document ID: {output}'.format(output=output))
-    elif config['sub_parser_name'] == 'download':
-        document_id = config['document_id']
-        if document_id == '-':
-            document_id = None
-            with stdin as f:
-                document_id = loads(f.read()).get('documentId')
-        if document_id is None:
-            print('ERROR: Document id must be provided.', file=stderr)
-            exit()
-        output = client.download_file(document_id, config['filename'], config['path'])
+    elif config['sub_parser_name'] == 'upload':
+        # one line per file as each upload finishes.
+        for result in client.upload_files(config['filenames'], config['jobs']):
+            if json:
+                print(dumps(
+                    {
+                        'filename': result.filename,
+                        'documentId': result.document_id,
+                        'error': result.error,
+                    }
+                ), flush=True)
+            elif result.error is None:
+                print('{filename} Document ID: {document_id}'.format(
+                    filename=result.filename,
+                    document_id=result.document_id,
+                ), flush=True)
+            else:
+                print('{filename} not uploaded: {error}'.format(
+                    filename=result.filename,
+                    error=result.error,
+                ), flush=True)
+    elif config['sub_parser_name'] == 'download' and len(config['document_ids']) == 1 \
+            and config['document_ids'][0] != '-':
+        document_id = config['document_ids'][0]
+        output = client.download_file(document_id, config['filename'], config['path'], config['range_jobs'])
         if json:
             print(dumps(
                 {
@@ -234,17 +495,84 @@ def main():
             if output:
                 print('Successful downloaded file {filename}.'.format(filename=config['filename']))
             else:
-                print('File not downloaded for document id {document_id}.'.format(document_id=config['document_id']))
+                print('File not downloaded for document id {document_id}.'.format(document_id=document_id))
+    elif config['sub_parser_name'] == 'download':
+        document_ids = config['document_ids']
+        if document_ids == ['-']:
+            document_ids = read_document_ids(stdin)
+        # one line per document as each download finishes.
+        for result in client.download_files(document_ids, config['path'], config['jobs'], config['range_jobs']):
+            if json:
+                print(dumps(
+                    {
+                        'documentId': result.document_id,
+                        'downloaded': result.downloaded,
+                        'error': result.error,
+                    }
+                ), flush=True)
+            elif result.downloaded:
+                print('Successful downloaded document {document_id}.'.format(
+                    document_id=result.document_id,
+                ), flush=True)
+            else:
+                print('File not downloaded for document id {document_id}: {error}'.format(
+                    document_id=result.document_id,
+                    error=result.error,
+                ), flush=True)
+    elif config['sub_parser_name'] == 'read':
+        try:
+            output = client.read_document(config['document_id'], config['offset'], config['length'])
+        except ValueError as e:
+            # e.g. compressed documents, which have no byte ranges.
+            print('ERROR: {error}'.format(error=e), file=stderr)
+            exit(1)
+        if output is None:
+            print('Could not read document id {document_id}. See logs.'.format(
+                document_id=config['document_id']), file=stderr)
+            exit(1)
+        stdout.buffer.write(output)
+        stdout.flush()
+    elif config['sub_parser_name'] == 'share' and (config.get('batch') or len(config.get('add') or []) > 1):
+        usernames = config.get('add') or []
+        document_id = config.get('document_id')
+        if document_id == '-':
+            document_id = read_document_id(stdin)
+            if document_id is None:
+                print('ERROR: Document id must be provided.', file=stderr)
+                exit()
+        shares = []
+        if document_id is not None:
+            shares = [(document_id, username) for username in usernames]
+        with ExitStack() as stack:
+            if config.get('batch') == '-':
+                shares = chain(shares, read_share_pairs(stdin, usernames))
+            elif config.get('batch'):
+                batch_file = stack.enter_context(open(config['batch'], 'r', encoding='utf-8'))
+                shares = chain(shares, read_share_pairs(batch_file, usernames))
+            for result in client.post_shares(shares, config['jobs']):
+                if json:
+                    print(dumps(
+                        {
+                            'documentId': result.document_id,
+                            'username': result.username,
+                            'resourceUri': result.resource_uri,
+                            'error': result.error,
+                        }
+                    ), flush=True)
+                elif result.error is None:
+                    print('Added {username} to {document_id}.'.format(
+                        username=result.username, document_id=result.document_id), flush=True)
+                else:
+                    print('Could not add {username} to {document_id}: {error}'.format(
+                        username=result.username, document_id=result.document_id, error=result.error), flush=True)
     elif config['sub_parser_name'] == 'share':
         document_id = config['document_id']
         if document_id == '-':
-            document_id = None
-            with stdin as f:
-                document_id = loads(f.read()).get('documentId')
+            document_id = read_document_id(stdin)
         if document_id is None:
             print('ERROR: Document id must be provided.', file=stderr)
             exit()
-        username = config.get('add')
+        username = (config.get('add') or [None])[0]
         if username is not None:
             output = client.post_share(document_id, username)
             if json:
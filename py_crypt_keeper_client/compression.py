@@ -0,0 +1,211 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import zlib
+from importlib.util import find_spec
+from logging import getLogger, WARN
+from .utility import spool_file, DEFAULT_CHUNK_SIZE, DEFAULT_SPOOL_SIZE
+
+ZLIB = 'zlib'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+
+DEFAULT_COMPRESSION = ZLIB
+
+# compressed streams are recognized by their leading bytes, so only the metadata's compressed flag is needed.
+MAGIC_NUMBERS = {
+    GZIP: b'\x1f\x8b',
+    ZSTD: b'\x28\xb5\x2f\xfd',
+    LZ4: b'\x04\x22\x4d\x18',
+}
+MAGIC_SIZE = 4
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+
+def available_compressions():
+    # zstandard and lz4 are only looked up here, they are imported once a stream actually uses them, so building
+    # the ckc --compress choices stays cheap.
+    compressions = [ZLIB, GZIP]
+    if find_spec('zstandard') is not None:
+        compressions.append(ZSTD)
+    if find_spec('lz4') is not None:
+        compressions.append(LZ4)
+    return compressions
+
+
+def detect_compression(head):
+    for compression, magic in MAGIC_NUMBERS.items():
+        if head.startswith(magic):
+            return compression
+    return ZLIB
+
+
+class Lz4Compressor(object):
+    def __init__(self, lz4_frame):
+        self.compressor = lz4_frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.flush()
+        return self.compressor.flush()
+
+
+class ZlibDecompressor(object):
+    # decompressors write to file in pieces of at most max_length bytes, a small highly compressed input can expand
+    # to gigabytes.
+    def __init__(self, file, wbits, max_length=DEFAULT_CHUNK_SIZE):
+        self.file = file
+        self.decompressor = zlib.decompressobj(wbits)
+        self.max_length = max_length
+
+    def write(self, data):
+        while data:
+            self.file.write(self.decompressor.decompress(data, self.max_length))
+            data = self.decompressor.unconsumed_tail
+
+    def flush(self):
+        self.file.write(self.decompressor.flush())
+
+
+class Lz4Decompressor(object):
+    def __init__(self, lz4_frame, file, max_length=DEFAULT_CHUNK_SIZE):
+        self.file = file
+        self.decompressor = lz4_frame.LZ4FrameDecompressor()
+        self.max_length = max_length
+
+    def write(self, data):
+        # input beyond what one call can turn into max_length bytes is kept by the decompressor until asked again.
+        self.file.write(self.decompressor.decompress(data, self.max_length))
+        while not self.decompressor.needs_input and not self.decompressor.eof:
+            self.file.write(self.decompressor.decompress(b'', self.max_length))
+
+    def flush(self):
+        pass
+
+
+class ZstdDecompressor(object):
+    def __init__(self, zstandard, file, max_length=DEFAULT_CHUNK_SIZE):
+        # the stream writer hands its fixed size output buffer to file each time it fills.
+        self.writer = zstandard.ZstdDecompressor().stream_writer(file, write_size=max_length)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def flush(self):
+        pass
+
+
+def get_compressor(compression, level=None):
+    if compression in (ZLIB, GZIP):
+        return zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+            zlib.DEFLATED,
+            zlib.MAX_WBITS if compression == ZLIB else 16 + zlib.MAX_WBITS,
+        )
+    if compression in available_compressions():
+        if compression == ZSTD:
+            import zstandard
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        if compression == LZ4:
+            import lz4.frame
+            return Lz4Compressor(lz4.frame)
+    raise ValueError('Compression %s is not available, use one of %s.' % (compression, available_compressions()))
+
+
+def get_decompressor(compression, file):
+    if compression == ZLIB:
+        return ZlibDecompressor(file, zlib.MAX_WBITS)
+    if compression == GZIP:
+        return ZlibDecompressor(file, 16 + zlib.MAX_WBITS)
+    if compression in available_compressions():
+        if compression == ZSTD:
+            import zstandard
+            return ZstdDecompressor(zstandard, file)
+        if compression == LZ4:
+            import lz4.frame
+            return Lz4Decompressor(lz4.frame, file)
+    raise ValueError('Compression %s is not available, use one of %s.' % (compression, available_compressions()))
+
+
+class CompressingReader(object):
+    # file-like read() of the compressed form of file, without knowing the compressed size up front.
+    def __init__(self, file, compression=DEFAULT_COMPRESSION, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.file = file
+        self.compressor = get_compressor(compression)
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.finished = False
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.finished:
+            read = self.file.read(self.chunk_size)
+            if read:
+                compressed = self.compressor.compress(read)
+            else:
+                compressed = self.compressor.flush()
+                self.finished = True
+            chunks.append(compressed)
+            length += len(compressed)
+        data = b''.join(chunks)
+        if size < 0:
+            size = length
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def compress_file(file, compression=DEFAULT_COMPRESSION, chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_memory=DEFAULT_SPOOL_SIZE):
+    # the compressed size must be known before requesting a single PUT upload url, so the output is spooled and
+    # only spills to a temporary file past max_memory. Returns the spool rewound to the start and its size.
+    spool, size = spool_file(CompressingReader(file, compression, chunk_size), chunk_size, max_memory)
+    log.debug('Compressed to {size} bytes with {compression}.'.format(size=size, compression=compression))
+    return spool, size
+
+
+class DecompressingFileWriter(object):
+    def __init__(self, file):
+        self.file = file
+        self.decompressor = None
+        self.head = b''
+
+    def write(self, data):
+        if self.decompressor is None:
+            self.head += bytes(data)
+            if len(self.head) < MAGIC_SIZE:
+                return
+            data, self.head = self.head, b''
+            self.decompressor = get_decompressor(detect_compression(data), self.file)
+        self.decompressor.write(data)
+
+    def close(self):
+        if self.decompressor is None:
+            if not self.head:
+                return
+            self.decompressor = get_decompressor(detect_compression(self.head), self.file)
+            self.write(self.head)
+        self.decompressor.flush()
@@ -0,0 +1,194 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from collections import OrderedDict
+from os import environ, urandom
+from threading import Lock
+from time import perf_counter
+from logging import getLogger, WARN
+
+AES_CBC = 'AES|CBC'
+AES_GCM = 'AES|GCM'
+
+# set to an engine name to skip automatic selection.
+ENGINE_ENVIRONMENT_VARIABLE = 'CKC_CIPHER_ENGINE'
+BENCHMARK_SIZE = 256 * 1024
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+# An engine is a factory called with (key, iv) that returns an object with encrypt(data, output=None) and
+# decrypt(data, output=None) over whole blocks, keeping the chain between calls. With output, a writable buffer of
+# len(data) bytes that may alias data, the result is written there and None returned. Engines of authenticated
+# types are called with (key, nonce) and also have update(associated_data), digest() after encrypting and
+# verify(tag) after decrypting, which raises ValueError for a wrong tag. Every engine registered for a cipher type
+# must produce the same bytes.
+BLOCK_SIZES = {}
+ENGINES = {}
+selected_engines = {}
+selection_lock = Lock()
+# the cipher libraries are a large part of start up time, so they are only imported once an engine is looked up.
+engines_loaded = False
+load_lock = Lock()
+
+
+def register_cipher_type(cipher_type, block_size):
+    BLOCK_SIZES[cipher_type] = block_size
+    ENGINES.setdefault(cipher_type, OrderedDict())
+
+
+def register_engine(cipher_type, name, factory):
+    ENGINES[cipher_type][name] = factory
+    selected_engines.pop(cipher_type, None)
+
+
+def load_engines():
+    global engines_loaded
+    if engines_loaded:
+        return
+    with load_lock:
+        if engines_loaded:
+            return
+        try:
+            import Crypto
+            from Crypto.Cipher import AES
+        except ImportError:
+            AES = None
+        # the output argument engines must take first appeared in pycryptodome 3.7, PyCrypto 2.x installs the same
+        # package without it.
+        if AES is not None and Crypto.version_info >= (3, 7):
+            register_engine(AES_CBC, 'pycryptodome', lambda key, iv: AES.new(key, AES.MODE_CBC, iv))
+            register_engine(AES_GCM, 'pycryptodome', lambda key, nonce: AES.new(key, AES.MODE_GCM, nonce=nonce))
+        try:
+            import cryptography.hazmat.primitives.ciphers
+        except ImportError:
+            pass
+        else:
+            register_engine(AES_CBC, 'cryptography', CryptographyCbc)
+            register_engine(AES_GCM, 'cryptography', CryptographyGcm)
+        # only set once every engine is registered, callers that see it skip the lock.
+        engines_loaded = True
+
+
+def get_block_size(cipher_type):
+    return BLOCK_SIZES.get(cipher_type)
+
+
+def available_engines(cipher_type):
+    load_engines()
+    return list(ENGINES.get(cipher_type, ()))
+
+
+def benchmark_engine(factory, block_size, size=BENCHMARK_SIZE):
+    key = urandom(32)
+    data = bytearray(size)
+    start = perf_counter()
+    factory(key, urandom(block_size)).encrypt(data, output=data)
+    factory(key, urandom(block_size)).decrypt(data, output=data)
+    return perf_counter() - start
+
+
+def select_engine(cipher_type):
+    # the fastest available engine is measured once per process.
+    load_engines()
+    with selection_lock:
+        if cipher_type not in selected_engines:
+            engines = ENGINES.get(cipher_type)
+            if not engines:
+                raise ValueError('No cipher engine is available for %s.' % cipher_type)
+            timings = {name: benchmark_engine(factory, BLOCK_SIZES[cipher_type]) for name, factory in engines.items()}
+            selected_engines[cipher_type] = min(timings, key=timings.get)
+            log.debug('Selected {engine} for {cipher_type} from {timings}.'.format(
+                engine=selected_engines[cipher_type], cipher_type=cipher_type, timings=timings))
+        return selected_engines[cipher_type]
+
+
+def get_engine(cipher_type, name=None):
+    load_engines()
+    name = name or environ.get(ENGINE_ENVIRONMENT_VARIABLE) or select_engine(cipher_type)
+    try:
+        return ENGINES[cipher_type][name]
+    except KeyError:
+        raise ValueError('Cipher engine %s is not available for %s, use one of %s.' % (
+            name, cipher_type, available_engines(cipher_type)))
+
+
+class CryptographyCbc(object):
+    # cryptography's update_into needs block_size - 1 spare bytes of output, so results are copied instead.
+    def __init__(self, key, iv):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self.cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+        self.encryptor = None
+        self.decryptor = None
+
+    @staticmethod
+    def process(context, data, output):
+        if output is None:
+            return context.update(data)
+        output[:] = context.update(data)
+
+    def encrypt(self, data, output=None):
+        if self.encryptor is None:
+            self.encryptor = self.cipher.encryptor()
+        return self.process(self.encryptor, data, output)
+
+    def decrypt(self, data, output=None):
+        if self.decryptor is None:
+            self.decryptor = self.cipher.decryptor()
+        return self.process(self.decryptor, data, output)
+
+
+class CryptographyGcm(CryptographyCbc):
+    def __init__(self, key, nonce):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self.cipher = Cipher(algorithms.AES(key), modes.GCM(nonce))
+        self.encryptor = None
+        self.decryptor = None
+        self.associated_data = b''
+
+    def update(self, associated_data):
+        # pycryptodome takes associated data before any encryption, so it is only handed over with the first block.
+        self.associated_data += associated_data
+
+    def encrypt(self, data, output=None):
+        if self.encryptor is None:
+            self.encryptor = self.cipher.encryptor()
+            self.encryptor.authenticate_additional_data(self.associated_data)
+        return self.process(self.encryptor, data, output)
+
+    def decrypt(self, data, output=None):
+        if self.decryptor is None:
+            self.decryptor = self.cipher.decryptor()
+            self.decryptor.authenticate_additional_data(self.associated_data)
+        return self.process(self.decryptor, data, output)
+
+    def digest(self):
+        if self.encryptor is None:
+            self.encrypt(b'')
+        self.encryptor.finalize()
+        return self.encryptor.tag
+
+    def verify(self, tag):
+        from cryptography.exceptions import InvalidTag
+        if self.decryptor is None:
+            self.decrypt(b'')
+        try:
+            self.decryptor.finalize_with_tag(tag)
+        except InvalidTag:
+            raise ValueError('MAC check failed')
+
+
+register_cipher_type(AES_CBC, 16)
+register_cipher_type(AES_GCM, 16)
@@ -0,0 +1,40 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+
+class CryptKeeperError(Exception):
+    pass
+
+
+class CryptKeeperHTTPError(CryptKeeperError):
+    def __init__(self, message, status_code=None, retry_after=None, url=None):
+        super().__init__(message)
+        self.status_code = status_code
+        # seconds the server asked clients to wait before trying again, or None.
+        self.retry_after = retry_after
+        self.url = url
+
+
+class CircuitOpenError(CryptKeeperError):
+    def __init__(self, message, endpoint=None, retry_after=None):
+        super().__init__(message)
+        self.endpoint = endpoint
+        # seconds until the circuit lets a trial request through.
+        self.retry_after = retry_after
+
+
+class IntegrityError(CryptKeeperError, ValueError):
+    # downloaded cipher text failed authentication, it was modified, truncated or reordered.
+    pass
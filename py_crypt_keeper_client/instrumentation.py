@@ -0,0 +1,172 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from collections import namedtuple
+from threading import Lock
+from time import perf_counter, thread_time, time
+from logging import getLogger, WARN
+
+try:
+    from opentelemetry import metrics as otel_metrics, trace as otel_trace
+except ImportError:
+    otel_metrics = None
+    otel_trace = None
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+# attributes of few distinct values, the only ones metrics are labelled with. Spans get every attribute.
+METRIC_LABELS = ('endpoint', 'method', 'status_code', 'error')
+
+# started is the epoch time the operation began, duration and any times in attributes are in seconds.
+Measurement = namedtuple('Measurement', ['operation', 'started', 'duration', 'attributes'])
+
+
+class CipherTimer(object):
+    # sums the cpu time threads spend in a cipher's methods, which may run on many threads at once.
+    def __init__(self):
+        self.total = 0.0
+        self.lock = Lock()
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            started = thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = thread_time() - started
+                with self.lock:
+                    self.total += elapsed
+        return timed
+
+    def instrument(self, cipher, *names):
+        for name in names:
+            setattr(cipher, name, self.wrap(getattr(cipher, name)))
+        return cipher
+
+
+class Operation(object):
+    # times one client operation as a context manager, attributes such as bytes sent are added while it runs.
+    def __init__(self, instrumentation, name, attributes, timer=None):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.attributes = attributes
+        self.timer = timer
+        self.lock = Lock()
+
+    def __enter__(self):
+        self.started = time()
+        self.counter = perf_counter()
+        self.cipher_started = None if self.timer is None else self.timer.total
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = perf_counter() - self.counter
+        if self.timer is not None:
+            self.attributes['cipher_time'] = self.timer.total - self.cipher_started
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.instrumentation.emit(Measurement(self.name, self.started, duration, self.attributes))
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, value):
+        with self.lock:
+            self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def mark(self, name):
+        # the seconds since the operation started, only the first mark of a name is kept.
+        self.attributes.setdefault(name, perf_counter() - self.counter)
+
+
+class Instrumentation(object):
+    # the default, which records nothing. Subclasses set enabled and implement record(measurement).
+    enabled = False
+
+    def operation(self, name, timer=None, **attributes):
+        return Operation(self, name, attributes, timer)
+
+    def cipher_timer(self):
+        # None when disabled, so ciphers are not wrapped at all.
+        return CipherTimer() if self.enabled else None
+
+    def emit(self, measurement):
+        if not self.enabled:
+            return
+        try:
+            self.record(measurement)
+        except Exception:
+            # metrics must never fail a transfer.
+            log.exception('Recording %s failed.', measurement.operation)
+
+    def record(self, measurement):
+        pass
+
+
+NO_INSTRUMENTATION = Instrumentation()
+
+
+class CallbackInstrumentation(Instrumentation):
+    # calls callback with each Measurement, on the thread that ran the operation.
+    enabled = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, measurement):
+        self.callback(measurement)
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    # a span for each operation, and duration, cipher time, time to first byte, byte and retry metrics.
+    # tracer and meter default to the global OpenTelemetry providers, which need the opentelemetry-api package.
+    enabled = True
+
+    def __init__(self, tracer=None, meter=None):
+        if (tracer is None or meter is None) and otel_trace is None:
+            raise ValueError('OpenTelemetry is not available, install opentelemetry-api or pass a tracer and meter.')
+        self.tracer = tracer or otel_trace.get_tracer(__name__)
+        meter = meter or otel_metrics.get_meter(__name__)
+        self.durations = meter.create_histogram(
+            'ckc.operation.duration', unit='s', description='Duration of Crypt-Keeper client operations.')
+        self.cipher_times = meter.create_histogram(
+            'ckc.cipher.time', unit='s', description='CPU time spent encrypting or decrypting.')
+        self.first_bytes = meter.create_histogram(
+            'ckc.time_to_first_byte', unit='s', description='Time until the first byte of a download arrived.')
+        self.transferred = meter.create_counter(
+            'ckc.transfer.bytes', unit='By', description='Bytes sent to or received from S3.')
+        self.retries = meter.create_counter('ckc.retries', description='Requests sent again after a failure.')
+
+    def record(self, measurement):
+        attributes = {
+            name: value for name, value in measurement.attributes.items()
+            if isinstance(value, (str, bool, int, float))
+        }
+        start_time = int(measurement.started * 1e9)
+        span = self.tracer.start_span(measurement.operation, start_time=start_time, attributes=attributes)
+        span.end(end_time=start_time + int(measurement.duration * 1e9))
+        labels = {name: attributes[name] for name in METRIC_LABELS if name in attributes}
+        labels['operation'] = measurement.operation
+        self.durations.record(measurement.duration, labels)
+        if 'cipher_time' in attributes:
+            self.cipher_times.record(attributes['cipher_time'], labels)
+        if 'time_to_first_byte' in attributes:
+            self.first_bytes.record(attributes['time_to_first_byte'], labels)
+        if attributes.get('bytes'):
+            self.transferred.add(attributes['bytes'], labels)
+        if attributes.get('retries'):
+            self.retries.add(attributes['retries'], labels)
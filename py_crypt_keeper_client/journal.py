@@ -0,0 +1,66 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import json
+from hashlib import sha256
+from os import makedirs, remove, replace
+from os.path import abspath, dirname, exists, expanduser, join
+from logging import getLogger, WARN
+
+DEFAULT_CHECKPOINT_DIR = join(expanduser('~'), '.ckc_checkpoints')
+# committed progress is written at most once per interval of transferred bytes.
+DEFAULT_CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+
+class Checkpoint(object):
+    # a small json document recording how far a transfer got, it never holds keys or plain text. identity names
+    # the transfer, a saved checkpoint whose identity differs (e.g. the source file changed) is ignored.
+    def __init__(self, path, **identity):
+        self.path = path
+        self.identity = identity
+        self.state = dict(identity)
+        if exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    state = json.loads(file.read())
+            except (IOError, ValueError) as e:
+                log.warning('Ignoring unreadable checkpoint %s: %s', path, e)
+                return
+            if all(state.get(key) == value for key, value in identity.items()):
+                self.state = state
+
+    def reset(self):
+        self.state = dict(self.identity)
+
+    def save(self):
+        # write then rename so an interrupted save never leaves a torn checkpoint behind.
+        makedirs(dirname(self.path) or '.', exist_ok=True)
+        temporary_path = '%s.tmp' % self.path
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(self.state))
+        replace(temporary_path, self.path)
+
+    def delete(self):
+        if exists(self.path):
+            remove(self.path)
+
+
+def checkpoint_path(checkpoint_dir, kind, filename):
+    # one checkpoint per local file and direction.
+    digest = sha256(abspath(filename).encode('utf-8')).hexdigest()[:32]
+    return join(checkpoint_dir, '%s-%s.json' % (kind, digest))
@@ -0,0 +1,488 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import json
+import re
+from argparse import ArgumentParser
+from collections import Counter, namedtuple
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import urandom
+from random import Random
+from threading import Lock, Thread
+from time import gmtime, sleep, strftime, time
+from urllib.parse import parse_qs, urlencode, urlsplit
+from uuid import uuid4
+from logging import getLogger, WARN
+from .utility import encode_key
+
+DEFAULT_USER = 'cryptkeeper-user'
+DEFAULT_API_KEY = 'test'
+DEFAULT_URL_TTL = 600
+API_PATH = '/api/v1/secure_document_service'
+# object bodies are sent and received this many bytes at a time when bandwidth is limited.
+THROTTLE_CHUNK_SIZE = 64 * 1024
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+MockRequest = namedtuple('MockRequest', ['method', 'path', 'query', 'headers', 'read_body'])
+Fault = namedtuple('Fault', ['route', 'status', 'retry_after'])
+ObjectUrl = namedtuple('ObjectUrl', ['document_id', 'method', 'part_number', 'expires_at'])
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so clients can pool connections as they do against the real service. Headers and body are written
+    # separately, without TCP_NODELAY every response would wait on a delayed ack.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        self.body_read = False
+        status, body, headers = self.server.mock.handle(method, self.path, self.headers, self.read_body)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+        if not self.body_read:
+            # an unread body would be taken for the next request on this connection.
+            self.discard_body()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.server.mock.send_body(self.wfile, body)
+
+    def read_body(self):
+        # like S3, only bodies of a declared length are accepted.
+        self.body_read = True
+        length = self.headers.get('Content-Length')
+        return None if length is None else self.server.mock.receive_body(self.rfile, int(length))
+
+    def discard_body(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            remaining = int(length)
+            while remaining > 0:
+                read = self.rfile.read(min(remaining, THROTTLE_CHUNK_SIZE))
+                if not read:
+                    break
+                remaining -= len(read)
+        elif self.headers.get('Transfer-Encoding'):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        log.debug('Mock server: {message}'.format(message=format % args))
+
+
+def parse_range(value, size):
+    # the inclusive (start, end) of a single byte range header, None for a header that is not one, or ValueError
+    # when the range does not overlap an object of size bytes.
+    match = re.match(r'^bytes=(\d*)-(\d*)$', value or '')
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range %s is not satisfiable for %d bytes.' % (value, size))
+    return start, end
+
+
+class MockServer(object):
+    # a stand-in for the Crypt-Keeper service and S3 on localhost, documents are kept in memory.
+    # latency is added to every request in seconds, bandwidth limits each object transfer in bytes per second, and
+    # error_rate is the chance any request fails with error_status, like an overloaded service. Object urls expire
+    # after url_ttl seconds and with single_use a url only sends or receives one whole object, ranged GETs reuse it.
+    routes = [
+        ('POST', re.compile(r'^%s/upload_url/$' % API_PATH), 'upload_url'),
+        ('GET', re.compile(r'^%s/download_url/(?P<document_id>[^/]+)/$' % API_PATH), 'download_url'),
+        ('POST', re.compile(r'^%s/share/$' % API_PATH), 'post_share'),
+        ('POST', re.compile(r'^%s/share/batch/$' % API_PATH), 'post_shares'),
+        ('GET', re.compile(r'^%s/share/(?P<document_id>[^/]+)/$' % API_PATH), 'get_share'),
+        ('POST', re.compile(r'^%s/multipart_upload/$' % API_PATH), 'start_multipart_upload'),
+        ('GET', re.compile(r'^%s/multipart_upload/(?P<document_id>[^/]+)/$' % API_PATH), 'get_multipart_upload'),
+        ('GET', re.compile(r'^%s/multipart_upload/(?P<document_id>[^/]+)/part/(?P<part_number>\d+)/$' % API_PATH),
+         'part_upload_url'),
+        ('POST', re.compile(r'^%s/multipart_upload/(?P<document_id>[^/]+)/complete/$' % API_PATH),
+         'complete_multipart_upload'),
+        ('PUT', re.compile(r'^/s3/(?P<document_id>[^/]+)$'), 'put_object'),
+        ('GET', re.compile(r'^/s3/(?P<document_id>[^/]+)$'), 'get_object'),
+    ]
+
+    def __init__(self, user=DEFAULT_USER, api_key=DEFAULT_API_KEY, host='127.0.0.1', port=0, latency=0.0,
+                 bandwidth=None, error_rate=0.0, error_status=503, retry_after=0, url_ttl=DEFAULT_URL_TTL,
+                 single_use=True, seed=None):
+        self.user = user
+        self.api_key = api_key
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.url_ttl = url_ttl
+        self.single_use = single_use
+        self.random = Random(seed)
+        self.documents = {}
+        self.objects = {}
+        # parts of multipart uploads that have not been completed, by document id and part number.
+        self.uploads = {}
+        self.object_urls = {}
+        self.faults = []
+        # requests received by route name, e.g. to check how a client used the service in a load test.
+        self.requests = Counter()
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer((host, port), MockRequestHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server.server_address[:2]
+
+    def start(self):
+        # a short poll interval keeps stop() quick.
+        self.thread = Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def fail(self, count=1, status=503, route=None, retry_after=0):
+        # the next count requests to route, any route when None, fail with status. retry_after None sends no header.
+        with self.lock:
+            self.faults.extend(Fault(route, status, retry_after) for _ in range(count))
+
+    def take_fault(self, name):
+        with self.lock:
+            for fault in self.faults:
+                if fault.route in (None, name):
+                    self.faults.remove(fault)
+                    return fault
+            if self.error_rate and self.random.random() < self.error_rate:
+                return Fault(name, self.error_status, self.retry_after)
+        return None
+
+    def handle(self, method, target, headers, read_body):
+        split = urlsplit(target)
+        path = split.path
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                with self.lock:
+                    self.requests[name] += 1
+                if self.latency:
+                    sleep(self.latency)
+                api = path.startswith(API_PATH)
+                fault = self.take_fault(name)
+                if fault is not None:
+                    log.debug('Mock server failing {method} {path} with {status}'.format(
+                        method=method, path=path, status=fault.status))
+                    retry_after = {} if fault.retry_after is None else {'Retry-After': str(fault.retry_after)}
+                    return fault.status, {'error': 'Injected failure.'} if api else b'', retry_after
+                if api and not self.authorized(headers):
+                    return 401, {'error': 'Unauthorized.'}, {}
+                query = {key: values[0] for key, values in parse_qs(split.query).items()}
+                return getattr(self, name)(MockRequest(method, path, query, headers, read_body), **match.groupdict())
+        return 404, {'error': 'No route for %s %s.' % (method, path)}, {}
+
+    def authorized(self, headers):
+        return headers.get('Authorization') == 'ApiKey %s:%s' % (self.user, self.api_key)
+
+    def throttle(self, size):
+        if self.bandwidth:
+            sleep(size / self.bandwidth)
+
+    def send_body(self, file, body):
+        if not self.bandwidth:
+            file.write(body)
+            return
+        with memoryview(body) as view:
+            for start in range(0, len(view), THROTTLE_CHUNK_SIZE):
+                chunk = view[start:start + THROTTLE_CHUNK_SIZE]
+                file.write(chunk)
+                self.throttle(len(chunk))
+
+    def receive_body(self, file, length):
+        if not self.bandwidth:
+            return file.read(length)
+        chunks = []
+        while length > 0:
+            chunk = file.read(min(length, THROTTLE_CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+            self.throttle(len(chunk))
+        return b''.join(chunks)
+
+    def read_json(self, request):
+        try:
+            return json.loads(request.read_body().decode('utf-8'))
+        except (AttributeError, ValueError):
+            return None
+
+    def object_url(self, document_id, method, part_number=None):
+        # presigned style, so clients can read the expiry from X-Amz-Date and X-Amz-Expires.
+        signed_at = int(time())
+        token = uuid4().hex
+        with self.lock:
+            self.object_urls[token] = ObjectUrl(document_id, method, part_number, signed_at + self.url_ttl)
+        query = [('X-Amz-Date', strftime('%Y%m%dT%H%M%SZ', gmtime(signed_at))), ('X-Amz-Expires', self.url_ttl)]
+        if part_number is not None:
+            query.append(('partNumber', part_number))
+        query.append(('X-Amz-Signature', token))
+        return '%s/s3/%s?%s' % (self.url, document_id, urlencode(query))
+
+    def check_object_url(self, request, document_id, consume):
+        part_number = request.query.get('partNumber')
+        with self.lock:
+            object_url = self.object_urls.get(request.query.get('X-Amz-Signature'))
+            if object_url is None or object_url.expires_at <= time():
+                return False
+            if object_url[:3] != (document_id, request.method, None if part_number is None else int(part_number)):
+                return False
+            if consume and self.single_use:
+                del self.object_urls[request.query['X-Amz-Signature']]
+        return True
+
+    def document_info(self, document_id, kind, method):
+        # None for an unknown document. object_url takes the lock itself, so it is called after the read.
+        with self.lock:
+            document = self.documents.get(document_id)
+            if document is None:
+                return None
+            document_metadata = dict(document['document_metadata'])
+            symmetric_key = document['symmetric_key']
+        return {
+            'document_id': document_id,
+            'document_metadata': document_metadata,
+            'resource_uri': '%s/%s/%s/' % (API_PATH, kind, document_id),
+            'single_use_url': self.object_url(document_id, method),
+            'symmetric_key': symmetric_key,
+        }
+
+    def create_document(self, request):
+        document_metadata = (self.read_json(request) or {}).get('document_metadata')
+        if not isinstance(document_metadata, dict):
+            return None
+        document_id = str(uuid4())
+        with self.lock:
+            self.documents[document_id] = {
+                'document_metadata': document_metadata,
+                'symmetric_key': encode_key(urandom(32)),
+                'users': [self.user],
+            }
+        return document_id
+
+    def upload_url(self, request):
+        document_id = self.create_document(request)
+        if document_id is None:
+            return 400, {'error': 'Expected a document_metadata object.'}, {}
+        return 201, self.document_info(document_id, 'upload_url', 'PUT'), {}
+
+    def download_url(self, request, document_id):
+        document_info = self.document_info(document_id, 'download_url', 'GET')
+        if document_info is None:
+            return 404, {'error': 'Unknown document %s.' % document_id}, {}
+        return 200, document_info, {}
+
+    def share_info(self, document_id, username):
+        with self.lock:
+            if document_id not in self.documents:
+                return None
+            users = self.documents[document_id]['users']
+            if username not in users:
+                users.append(username)
+        return {
+            'document_id': document_id,
+            'username': username,
+            'resource_uri': '%s/share/%s/' % (API_PATH, document_id),
+        }
+
+    def post_share(self, request):
+        data = self.read_json(request) or {}
+        if not data.get('document_id') or not data.get('username'):
+            return 400, {'error': 'Expected a document_id and username.'}, {}
+        share_info = self.share_info(data['document_id'], data['username'])
+        if share_info is None:
+            return 404, {'error': 'Unknown document %s.' % data['document_id']}, {}
+        return 201, share_info, {}
+
+    def post_shares(self, request):
+        shares = (self.read_json(request) or {}).get('shares')
+        if not isinstance(shares, list) or not all(isinstance(share, dict) for share in shares):
+            return 400, {'error': 'Expected a list of share objects.'}, {}
+        results = []
+        for share in shares:
+            share_info = self.share_info(share.get('document_id'), share.get('username'))
+            if share_info is None:
+                results.append({'error': 'Unknown document %s.' % share.get('document_id')})
+            else:
+                results.append({'resource_uri': share_info['resource_uri']})
+        return 201, {'results': results}, {}
+
+    def get_share(self, request, document_id):
+        with self.lock:
+            if document_id not in self.documents:
+                return 404, {'error': 'Unknown document %s.' % document_id}, {}
+            users = list(self.documents[document_id]['users'])
+        return 200, {
+            'document_id': document_id,
+            'users': users,
+            'resource_uri': '%s/share/%s/' % (API_PATH, document_id),
+        }, {}
+
+    def multipart_info(self, document_id):
+        # must be called holding the lock.
+        document = self.documents[document_id]
+        return {
+            'document_id': document_id,
+            'document_metadata': dict(document['document_metadata']),
+            'resource_uri': '%s/multipart_upload/%s/' % (API_PATH, document_id),
+            'symmetric_key': document['symmetric_key'],
+        }
+
+    def start_multipart_upload(self, request):
+        document_id = self.create_document(request)
+        if document_id is None:
+            return 400, {'error': 'Expected a document_metadata object.'}, {}
+        with self.lock:
+            self.uploads[document_id] = {}
+            return 201, self.multipart_info(document_id), {}
+
+    def get_multipart_upload(self, request, document_id):
+        with self.lock:
+            if document_id not in self.uploads:
+                return 404, {'error': 'No multipart upload for %s.' % document_id}, {}
+            return 200, self.multipart_info(document_id), {}
+
+    def part_upload_url(self, request, document_id, part_number):
+        with self.lock:
+            uploading = document_id in self.uploads
+        if not uploading:
+            return 404, {'error': 'No multipart upload for %s.' % document_id}, {}
+        return 200, {'single_use_url': self.object_url(document_id, 'PUT', int(part_number))}, {}
+
+    def complete_multipart_upload(self, request, document_id):
+        data = self.read_json(request) or {}
+        with self.lock:
+            uploaded = self.uploads.get(document_id)
+            if uploaded is None:
+                return 404, {'error': 'No multipart upload for %s.' % document_id}, {}
+            try:
+                parts = sorted((int(part['part_number']), part['etag']) for part in data['parts'])
+            except (KeyError, TypeError, ValueError):
+                return 400, {'error': 'Expected a list of parts.'}, {}
+            for part_number, etag in parts:
+                if part_number not in uploaded or uploaded[part_number][0] != etag:
+                    return 400, {'error': 'Part %d was not uploaded with etag %s.' % (part_number, etag)}, {}
+            self.objects[document_id] = b''.join(uploaded[part_number][1] for part_number, _ in parts)
+            del self.uploads[document_id]
+            document_metadata = self.documents[document_id]['document_metadata']
+            if data.get('content_length') is not None:
+                document_metadata['content_length'] = data['content_length']
+            return 200, self.multipart_info(document_id), {}
+
+    def put_object(self, request, document_id):
+        if not self.check_object_url(request, document_id, True):
+            return 403, b'', {}
+        body = request.read_body()
+        if body is None:
+            return 411, b'', {}
+        etag = '"%s"' % md5(body).hexdigest()
+        part_number = request.query.get('partNumber')
+        with self.lock:
+            if part_number is None:
+                self.objects[document_id] = body
+            elif document_id in self.uploads:
+                self.uploads[document_id][int(part_number)] = (etag, body)
+            else:
+                return 404, b'', {}
+        return 200, b'', {'ETag': etag}
+
+    def get_object(self, request, document_id):
+        range_header = request.headers.get('Range')
+        if not self.check_object_url(request, document_id, range_header is None):
+            return 403, b'', {}
+        with self.lock:
+            body = self.objects.get(document_id)
+        if body is None:
+            return 404, b'', {}
+        headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        try:
+            byte_range = parse_range(range_header, len(body))
+        except ValueError:
+            return 416, b'', dict(headers, **{'Content-Range': 'bytes */%d' % len(body)})
+        if byte_range is None:
+            return 200, body, headers
+        start, end = byte_range
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+        return 206, body[start:end + 1], headers
+
+
+def main():
+    # prints the server's url once it is listening, e.g. for a client running in another process.
+    parser = ArgumentParser(description='Run a local stand-in for the Crypt-Keeper service and S3.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000, help='The port to listen on, 0 picks a free port.')
+    parser.add_argument('--user', default=DEFAULT_USER)
+    parser.add_argument('--api-key', default=DEFAULT_API_KEY)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Bytes per second of each object transfer, unlimited by default.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='The chance of any request failing with --error-status, e.g. 0.01.')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--url-ttl', type=int, default=DEFAULT_URL_TTL, help='Seconds object urls stay valid.')
+    parser.add_argument('--seed', type=int, default=None, help='Seeds error injection for repeatable runs.')
+    args = parser.parse_args()
+    server = MockServer(
+        args.user, args.api_key, args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, error_status=args.error_status, url_ttl=args.url_ttl, seed=args.seed)
+    print(server.url, flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
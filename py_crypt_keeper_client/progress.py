@@ -0,0 +1,201 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from collections import namedtuple
+from json import dumps
+from threading import Event, Lock, Thread
+from time import monotonic
+from logging import getLogger, WARN
+
+DEFAULT_PROGRESS_INTERVAL = 1.0
+DEFAULT_BAR_WIDTH = 24
+BYTE_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+# done and total count bytes sent or received, including encryption overhead, total is None when unknown. rate is
+# bytes per second since the previous event, eta is None while the rate is zero or the total unknown.
+ProgressEvent = namedtuple('ProgressEvent', [
+    'operation', 'name', 'document_id', 'done', 'total', 'rate', 'average_rate', 'eta', 'elapsed', 'finished',
+])
+
+
+def format_bytes(count):
+    for unit in BYTE_UNITS[:-1]:
+        if abs(count) < 1024:
+            break
+        count /= 1024.0
+    else:
+        unit = BYTE_UNITS[-1]
+    return '%d %s' % (count, unit) if unit == 'B' else '%.1f %s' % (count, unit)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class ProgressMeter(object):
+    # counts the bytes of one transfer. While it runs a reporting thread calls callback with a ProgressEvent every
+    # interval seconds, stalled or not, and once more when it finishes, so counting a chunk is only an addition.
+    def __init__(self, callback, operation, name, document_id=None, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.callback = callback
+        self.operation = operation
+        self.name = name
+        self.document_id = document_id
+        self.interval = interval
+        self.total = None
+        self.done = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def begin(self, total=None, done=0):
+        # done is the bytes an earlier, resumed attempt already transferred.
+        self.total = total
+        self.done = self.initial = self.reported = done
+        self.started = self.reported_at = monotonic()
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name='ckc-progress', daemon=True)
+        self.thread.start()
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    def update(self, count):
+        with self.lock:
+            self.done += count
+
+    def counted(self, chunks):
+        for chunk in chunks:
+            self.update(len(chunk))
+            yield chunk
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report(False)
+
+    def finish(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.report(True)
+
+    def report(self, finished):
+        now = monotonic()
+        done = self.done
+        elapsed = now - self.started
+        since = now - self.reported_at
+        rate = (done - self.reported) / since if since > 0 else 0.0
+        average_rate = (done - self.initial) / elapsed if elapsed > 0 else 0.0
+        self.reported, self.reported_at = done, now
+        remaining = None if self.total is None else max(self.total - done, 0)
+        if remaining == 0:
+            eta = 0.0
+        elif remaining is None or rate <= 0:
+            eta = None
+        else:
+            eta = remaining / rate
+        try:
+            self.callback(ProgressEvent(
+                self.operation, self.name, self.document_id, done, self.total, rate, average_rate, eta, elapsed,
+                finished))
+        except Exception:
+            # a broken display must not fail the transfer.
+            log.exception('Progress callback failed.')
+
+
+class ProgressBar(object):
+    # renders the combined progress of concurrent transfers on one terminal line, the line is cleared whenever a
+    # transfer finishes so results printed after it are not garbled.
+    def __init__(self, file, width=DEFAULT_BAR_WIDTH):
+        self.file = file
+        self.width = width
+        self.transfers = {}
+        self.shown = 0
+        self.lock = Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            key = (event.operation, event.name, event.document_id)
+            if event.finished:
+                self.transfers.pop(key, None)
+                self.clear()
+            else:
+                self.transfers[key] = event
+                self.render()
+
+    def clear(self):
+        if self.shown:
+            self.file.write('\r%s\r' % (' ' * self.shown))
+            self.file.flush()
+            self.shown = 0
+
+    def render(self):
+        events = list(self.transfers.values())
+        done = sum(event.done for event in events)
+        rate = sum(event.rate for event in events)
+        totals = [event.total for event in events]
+        label = events[0].name if len(events) == 1 else '%d transfers' % len(events)
+        if None in totals:
+            line = '%s %s %s/s' % (label, format_bytes(done), format_bytes(rate))
+        else:
+            total = sum(totals)
+            fraction = min(done / total, 1.0) if total else 1.0
+            filled = int(fraction * self.width)
+            remaining = max(total - done, 0)
+            if rate > 0 or not remaining:
+                eta = format_duration(remaining / rate if remaining else 0)
+            else:
+                eta = '--:--:--'
+            line = '%s [%s%s] %3d%% %s/%s %s/s ETA %s' % (
+                label, '#' * filled, '-' * (self.width - filled), fraction * 100, format_bytes(done),
+                format_bytes(total), format_bytes(rate), eta)
+        self.file.write('\r%s' % line.ljust(self.shown))
+        self.file.flush()
+        self.shown = len(line)
+
+
+class JsonProgress(object):
+    # writes each event as a line of json.
+    def __init__(self, file):
+        self.file = file
+        self.lock = Lock()
+
+    def __call__(self, event):
+        line = dumps({
+            'event': 'progress',
+            'operation': event.operation,
+            'name': event.name,
+            'documentId': event.document_id,
+            'done': event.done,
+            'total': event.total,
+            'rate': event.rate,
+            'averageRate': event.average_rate,
+            'eta': event.eta,
+            'elapsed': event.elapsed,
+            'finished': event.finished,
+        })
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
@@ -0,0 +1,135 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic
+from logging import getLogger, WARN
+from .exceptions import CircuitOpenError
+from .utility import backoff_delay
+
+DEFAULT_RETRIES = 3
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+# the server is overloaded or a gateway failed, the request may succeed later.
+RETRY_STATUSES = (429, 502, 503, 504)
+# the server refused the request without processing it, so even a POST is safe to send again.
+UNPROCESSED_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ('get', 'head', 'options', 'put', 'delete')
+
+log = getLogger(__name__)
+log.setLevel(WARN)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=0.5, max_delay=30.0, max_retry_after=60.0,
+                 retry_statuses=RETRY_STATUSES, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        # a server asking for a longer wait than this gets an error instead, so callers can back off themselves.
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+        # settings for the per endpoint circuit breakers.
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def should_retry(self, method, attempt, status_code=None, retry_after=None):
+        # status_code None means the request failed in transit, which only idempotent methods may repeat.
+        if attempt >= self.retries:
+            return False
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return False
+        idempotent = method.lower() in IDEMPOTENT_METHODS
+        if status_code is None:
+            return idempotent
+        return status_code in self.retry_statuses and (idempotent or status_code in UNPROCESSED_STATUSES)
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        return backoff_delay(attempt, self.backoff, self.max_delay)
+
+    def new_circuit_breaker(self, endpoint):
+        return CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+
+
+class CircuitBreaker(object):
+    # after failure_threshold consecutive failures calls fail fast for reset_timeout seconds, then a single trial
+    # call decides whether the circuit closes again.
+    def __init__(self, endpoint, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = Lock()
+
+    def before_call(self):
+        # returns True when this call is the trial, which must end with record_success, record_failure or end_trial.
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset_timeout - monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(
+                    'Circuit for %s is open after %d failures.' % (self.endpoint, self.failures),
+                    self.endpoint,
+                    max(remaining, 0.0),
+                )
+            self.trial = True
+            return True
+
+    def end_trial(self):
+        # a trial that ended without an outcome keeps the circuit open for another reset_timeout.
+        with self.lock:
+            if self.trial:
+                self.trial = False
+                self.opened_at = monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    log.warning('Opening circuit for %s after %d failures.', self.endpoint, self.failures)
+                self.opened_at = monotonic()
+                self.trial = False
@@ -0,0 +1,220 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import IsolatedAsyncioTestCase, mock, skipIf
+from asyncio import CancelledError, Event, create_task
+from os import urandom
+from threading import current_thread
+from os.path import join
+from tempfile import mkdtemp
+from py_crypt_keeper_client.chunked import ChunkedDecryptingFileWriter
+from py_crypt_keeper_client.engines import AES_CBC, AES_GCM
+from py_crypt_keeper_client.exceptions import CryptKeeperHTTPError
+from py_crypt_keeper_client.utility import encode_key
+
+try:
+    from aiohttp import web, ClientResponseError
+    from py_crypt_keeper_client.async_client import AsyncSimpleClient
+except ImportError:
+    web = None
+
+USER = 'cryptkeeper-user'
+API_KEY = 'test'
+
+
+@skipIf(web is None, 'aiohttp is not installed')
+class AsyncSimpleClientTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.documents = {}
+        self.objects = {}
+        self.unavailable = 0
+        self.object_status = 200
+        self.hang = None
+        self.key = encode_key(urandom(32))
+        app = web.Application()
+        app.router.add_post('/api/v1/secure_document_service/upload_url/', self.upload_url)
+        app.router.add_get('/api/v1/secure_document_service/download_url/{document_id}/', self.download_url)
+        app.router.add_put('/s3/{document_id}', self.put_object)
+        app.router.add_get('/s3/{document_id}', self.get_object)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.runner.addresses[0][1]
+        self.client = AsyncSimpleClient.create(self.base_url, USER, API_KEY, chunk_size=64)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def upload_url(self, request):
+        metadata = (await request.json())['document_metadata']
+        document_id = 'document-%d' % len(self.documents)
+        self.documents[document_id] = metadata
+        return web.json_response({
+            'document_id': document_id,
+            'document_metadata': metadata,
+            'single_use_url': '%s/s3/%s' % (self.base_url, document_id),
+            'symmetric_key': self.key,
+        }, status=201)
+
+    async def download_url(self, request):
+        document_id = request.match_info['document_id']
+        if self.hang is not None:
+            self.hang.set()
+            await Event().wait()
+        if self.unavailable:
+            self.unavailable -= 1
+            return web.json_response({}, status=503, headers={'Retry-After': '0'})
+        if document_id not in self.objects:
+            return web.json_response({}, status=404)
+        return web.json_response({
+            'document_id': document_id,
+            'document_metadata': self.documents[document_id],
+            'single_use_url': '%s/s3/%s' % (self.base_url, document_id),
+            'symmetric_key': self.key,
+        })
+
+    async def put_object(self, request):
+        self.assertNotIn('Transfer-Encoding', request.headers)
+        body = await request.read()
+        self.assertEqual(len(body), int(request.headers['Content-Length']))
+        self.objects[request.match_info['document_id']] = body
+        return web.Response()
+
+    async def get_object(self, request):
+        if self.object_status != 200:
+            return web.Response(status=self.object_status)
+        return web.Response(body=self.objects[request.match_info['document_id']])
+
+    async def test_upload_and_download(self):
+        path = mkdtemp()
+        data = urandom(1000)
+        with open(join(path, 'upload.bin'), 'wb') as file:
+            file.write(data)
+        document_id = await self.client.upload_file(join(path, 'upload.bin'))
+        self.assertIsNotNone(document_id)
+        self.assertNotIn(data[:64], self.objects[document_id])
+        self.assertTrue(await self.client.download_file(document_id, 'download.bin', path))
+        with open(join(path, 'download.bin'), 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    async def test_chunked_upload_and_download(self):
+        path = mkdtemp()
+        data = urandom(1000)
+        with open(join(path, 'upload.bin'), 'wb') as file:
+            file.write(data)
+        self.client.encryption_type = AES_GCM
+        document_id = await self.client.upload_file(join(path, 'upload.bin'))
+        self.assertEqual(self.documents[document_id]['encryption_type'], AES_GCM)
+        self.assertEqual(len(self.objects[document_id]), 16 + 1000 + 16 * 16)
+        self.client.encryption_type = AES_CBC
+        self.assertTrue(await self.client.download_file(document_id, 'download.bin', path))
+        with open(join(path, 'download.bin'), 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    async def test_chunked_writer_is_finished_off_the_loop(self):
+        path = mkdtemp()
+        with open(join(path, 'upload.bin'), 'wb') as file:
+            file.write(urandom(1000))
+        self.client.encryption_type = AES_GCM
+        document_id = await self.client.upload_file(join(path, 'upload.bin'))
+        loop_thread = current_thread()
+        threads = []
+        close = ChunkedDecryptingFileWriter.close
+        shutdown = ChunkedDecryptingFileWriter.shutdown
+
+        def record(method):
+            def wrapper(writer):
+                threads.append((method.__name__, current_thread()))
+                return method(writer)
+            return wrapper
+        with mock.patch.object(ChunkedDecryptingFileWriter, 'close', record(close)), \
+                mock.patch.object(ChunkedDecryptingFileWriter, 'shutdown', record(shutdown)):
+            self.assertTrue(await self.client.download_file(document_id, 'download.bin', path))
+            self.assertEqual([name for name, _ in threads], ['close', 'shutdown', 'shutdown'])
+            self.assertNotIn(loop_thread, [thread for _, thread in threads])
+            # a failed request still stops the writer's workers.
+            del threads[:]
+            self.object_status = 500
+            with self.assertRaises(ClientResponseError):
+                await self.client.download_file(document_id, 'download.bin', path)
+            self.assertEqual([name for name, _ in threads], ['shutdown'])
+            self.assertNotIn(loop_thread, [thread for _, thread in threads])
+
+    async def test_compressed_upload_and_download(self):
+        path = mkdtemp()
+        data = b'compressible text\n' * 1000
+        with open(join(path, 'upload.txt'), 'wb') as file:
+            file.write(data)
+        self.client.compression = 'gzip'
+        document_id = await self.client.upload_file(join(path, 'upload.txt'))
+        self.assertTrue(self.documents[document_id]['compressed'])
+        self.assertLess(self.documents[document_id]['content_length'], len(data))
+        self.assertTrue(await self.client.download_file(document_id, 'download.txt', path))
+        with open(join(path, 'download.txt'), 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    async def test_bulk_upload_and_download(self):
+        path = mkdtemp()
+        filenames = []
+        for i in range(5):
+            filenames.append(join(path, 'file-%d' % i))
+            with open(filenames[-1], 'wb') as file:
+                file.write(urandom(100 * i))
+        results = [r async for r in self.client.upload_files(filenames + [join(path, 'missing')], jobs=2)]
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len([r for r in results if r.error is None]), 5)
+        document_ids = [r.document_id for r in results if r.error is None] + ['unknown']
+        results = [r async for r in self.client.download_files(document_ids, mkdtemp(), jobs=3)]
+        self.assertEqual(len([r for r in results if r.downloaded]), 5)
+        self.assertEqual([r.document_id for r in results if not r.downloaded], ['unknown'])
+
+    async def test_retries_unavailable(self):
+        path = mkdtemp()
+        with open(join(path, 'upload.bin'), 'wb') as file:
+            file.write(b'retried')
+        document_id = await self.client.upload_file(join(path, 'upload.bin'))
+        self.unavailable = 2
+        self.assertTrue(await self.client.download_file(document_id, 'download.bin', path))
+        self.assertEqual(self.unavailable, 0)
+        self.unavailable = 10
+        self.client.crypt_keeper_client.raise_errors = True
+        with self.assertRaises(CryptKeeperHTTPError) as context:
+            await self.client.download_file(document_id, 'download.bin', path)
+        self.assertEqual(context.exception.status_code, 503)
+
+    async def test_cancelled_circuit_breaker_trial(self):
+        breaker = self.client.crypt_keeper_client.get_circuit_breaker('download_url')
+        breaker.failures = breaker.failure_threshold
+        breaker.opened_at = 0.0
+        self.hang = Event()
+        task = create_task(self.client.crypt_keeper_client.get_download_url('document-0'))
+        await self.hang.wait()
+        self.assertTrue(breaker.trial)
+        task.cancel()
+        with self.assertRaises(CancelledError):
+            await task
+        self.assertFalse(breaker.trial)
+        self.assertIsNotNone(breaker.opened_at)
+        self.assertEqual(breaker.failures, breaker.failure_threshold)
+
+        with mock.patch.object(self.client.crypt_keeper_client, 'get_session') as get_session_mock:
+            get_session_mock.return_value.request.side_effect = TypeError('broken session')
+            breaker.opened_at = 0.0
+            with self.assertRaises(TypeError):
+                await self.client.crypt_keeper_client.get_download_url('document-0')
+        self.assertFalse(breaker.trial)
+        self.assertEqual(breaker.failures, breaker.failure_threshold + 1)
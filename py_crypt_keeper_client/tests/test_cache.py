@@ -0,0 +1,81 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase
+from py_crypt_keeper_client.cache import TTLCache
+
+
+class TTLCacheTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.cache = TTLCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b', 'default'), 'default')
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 1, 'hit_rate': 1 / 3})
+
+    def test_expiry(self):
+        self.cache.put('a', 1)
+        self.now += 9.9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now += 0.1
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate_and_clear(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.invalidate('a')
+        self.cache.invalidate('missing')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_size(self):
+        with self.assertRaises(ValueError):
+            TTLCache(max_size=0)
+
+    def test_put_after_invalidation_is_dropped(self):
+        generation = self.cache.generation()
+        self.cache.invalidate('a')
+        self.assertFalse(self.cache.put('a', 1, generation))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.put('b', 2, generation))
+        self.assertTrue(self.cache.put('a', 1, self.cache.generation()))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_forgotten_invalidations_drop_older_puts(self):
+        generation = self.cache.generation()
+        for key in ['a', 'b', 'c']:
+            self.cache.invalidate(key)
+        # a's invalidation no longer fits in the two tracked, so any value fetched before it is dropped.
+        self.assertFalse(self.cache.put('x', 1, generation))
+        self.assertTrue(self.cache.put('x', 1, self.cache.generation()))
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.assertFalse(self.cache.put('x', 1, generation))
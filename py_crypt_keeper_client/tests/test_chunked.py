@@ -0,0 +1,140 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock
+from io import BytesIO
+from os import urandom
+from py_crypt_keeper_client.chunked import (
+    calculate_chunk_count,
+    is_chunked,
+    ChunkedCipher,
+    ChunkedDecryptingFileWriter,
+    HEADER_SIZE,
+    TAG_SIZE,
+)
+from py_crypt_keeper_client.engines import available_engines, AES_CBC, AES_GCM
+from py_crypt_keeper_client.exceptions import IntegrityError
+from py_crypt_keeper_client.utility import encode_key
+
+
+class ChunkedTest(TestCase):
+    def setUp(self):
+        self.key = encode_key(urandom(32))
+
+    def encrypt(self, data, chunk_size=100, engine=None):
+        cipher = ChunkedCipher(AES_GCM, self.key, chunk_size=chunk_size, engine=engine)
+        return b''.join(cipher.encrypted_chunks(BytesIO(data), jobs=3))
+
+    def decrypt(self, encrypted, write_size=7, jobs=2):
+        out = BytesIO()
+        writer = ChunkedDecryptingFileWriter(out, lambda header: ChunkedCipher(AES_GCM, self.key, header), jobs)
+        for i in range(0, len(encrypted), write_size):
+            writer.write(encrypted[i:i + write_size])
+        writer.close()
+        return out.getvalue()
+
+    def test_is_chunked(self):
+        self.assertTrue(is_chunked(AES_GCM))
+        self.assertFalse(is_chunked(AES_CBC))
+
+    def test_round_trip(self):
+        for size in [0, 1, 99, 100, 101, 1000, 1234]:
+            with self.subTest(size=size):
+                data = urandom(size)
+                encrypted = self.encrypt(data)
+                self.assertEqual(len(encrypted), HEADER_SIZE + size + TAG_SIZE * calculate_chunk_count(size, 100))
+                self.assertEqual(len(encrypted), ChunkedCipher(AES_GCM, self.key, chunk_size=100)
+                                 .get_encrypted_file_size(size))
+                self.assertEqual(self.decrypt(encrypted), data)
+
+    def test_engines_agree(self):
+        data = urandom(1000)
+        encrypted = {}
+        for engine in available_engines(AES_GCM):
+            with self.subTest(engine=engine):
+                with mock.patch('py_crypt_keeper_client.chunked.urandom', return_value=b'n' * 7):
+                    encrypted[engine] = self.encrypt(data, engine=engine)
+                self.assertEqual(self.decrypt(encrypted[engine]), data)
+        self.assertEqual(len(set(encrypted.values())), 1)
+
+    def test_nonces_are_unique(self):
+        data = b'\0' * 300
+        first, second = self.encrypt(data), self.encrypt(data)
+        self.assertNotEqual(first, second)
+        records = [first[i:i + 116] for i in range(HEADER_SIZE, len(first), 116)]
+        self.assertEqual(len(set(records)), len(records))
+
+    def test_modified_chunk(self):
+        encrypted = bytearray(self.encrypt(urandom(500)))
+        encrypted[HEADER_SIZE + 150] ^= 1
+        with self.assertRaises(IntegrityError):
+            self.decrypt(bytes(encrypted))
+
+    def test_modified_header(self):
+        encrypted = bytearray(self.encrypt(urandom(500)))
+        encrypted[7] ^= 1
+        with self.assertRaises(IntegrityError):
+            self.decrypt(bytes(encrypted))
+
+    def test_truncated(self):
+        encrypted = self.encrypt(urandom(500))
+        for length in [0, 10, HEADER_SIZE, HEADER_SIZE + 116, HEADER_SIZE + 116 * 2, len(encrypted) - 1]:
+            with self.subTest(length=length):
+                with self.assertRaises(IntegrityError):
+                    self.decrypt(encrypted[:length])
+
+    def test_reordered(self):
+        encrypted = self.encrypt(urandom(500))
+        records = [encrypted[i:i + 116] for i in range(HEADER_SIZE, len(encrypted), 116)]
+        records[0], records[1] = records[1], records[0]
+        with self.assertRaises(IntegrityError):
+            self.decrypt(encrypted[:HEADER_SIZE] + b''.join(records))
+
+    def test_appended(self):
+        encrypted = self.encrypt(urandom(500))
+        with self.assertRaises(IntegrityError):
+            self.decrypt(encrypted + encrypted[-116:])
+
+    def test_decrypt_range(self):
+        data = urandom(1000)
+        encrypted = self.encrypt(data)
+        cipher = ChunkedCipher(AES_GCM, self.key, encrypted[:HEADER_SIZE])
+        decrypted = bytearray(len(data))
+        ranges = cipher.calculate_ranges(len(data), 300)
+        self.assertEqual(len(ranges), 4)
+        for start, end in ranges:
+            offset, plain_text = cipher.decrypt_range(encrypted[start:end + 1], start, end, len(data))
+            decrypted[offset:offset + len(plain_text)] = plain_text
+        self.assertEqual(decrypted, data)
+        start, end = ranges[-1]
+        with self.assertRaises(IntegrityError):
+            cipher.decrypt_range(encrypted[start:end], start, end, len(data))
+
+    def test_encrypt_part(self):
+        data = urandom(1000)
+        cipher = ChunkedCipher(AES_GCM, self.key, chunk_size=100)
+        chunks = list(cipher.plain_chunks(BytesIO(data)))
+        self.assertEqual([last for _, _, last in chunks], [False] * 9 + [True])
+        per_part = cipher.chunks_per_part(300)
+        self.assertEqual(per_part, 3)
+        encrypted = b''.join(
+            cipher.encrypt_part(chunks[i:i + per_part], i == 0) for i in range(0, len(chunks), per_part))
+        self.assertEqual(self.decrypt(encrypted), data)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(ValueError):
+            ChunkedCipher(AES_GCM, self.key, chunk_size=0)
+        with self.assertRaises(IntegrityError):
+            ChunkedCipher(AES_GCM, self.key, header=b'\0' * HEADER_SIZE)
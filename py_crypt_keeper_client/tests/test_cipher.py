@@ -15,17 +15,18 @@
 
 from unittest import TestCase, mock
 from py_crypt_keeper_client.cipher import Cipher, AES_CBC
-from Crypto.Hash import SHA256
-from Crypto.Cipher import AES
+from py_crypt_keeper_client.engines import available_engines
+from hashlib import sha256
 from base64 import b64encode
+from os import urandom
 
-KEY_SIZE = AES.key_size[0]
-AES_BLOCK_SIZE = AES.block_size
+KEY_SIZE = 16
+AES_BLOCK_SIZE = 16
 
 
 class CipherTest(TestCase):
     def setUp(self):
-        key = SHA256.new('test'.encode()).digest()[:KEY_SIZE]
+        key = sha256('test'.encode()).digest()[:KEY_SIZE]
         self.key = b64encode(key).decode('utf-8', 'backslashreplace')
         self.cipher_type = AES_CBC
         self.create_unit()
@@ -41,23 +42,57 @@ class CipherTest(TestCase):
         self.assertIsNotNone(iv)
 
     def test_get_cipher(self):
-        cipher = self.unit.get_cipher()
-        self.assertTrue(isinstance(cipher, AES.AESCipher))
+        for engine in available_engines(AES_CBC):
+            with self.subTest(engine=engine):
+                unit = Cipher(self.cipher_type, self.key, engine=engine)
+                cipher = unit.get_cipher()
+                self.assertTrue(hasattr(cipher, 'encrypt'))
+                self.assertTrue(hasattr(cipher, 'decrypt'))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            Cipher(self.cipher_type, self.key, engine='rot13')
 
     def test_get_iv(self):
         iv = self.unit.get_iv()
         self.assertIsNotNone(iv)
 
-    @mock.patch('Crypto.Cipher.AES.AESCipher.encrypt')
-    def test_encrypt(self, mock_cipher_encrypt):
+    def test_encrypt(self):
         text = b'test'
-        mock_cipher_encrypt.return_value = b'test'
+        self.unit.cipher = mock.MagicMock()
+        self.unit.cipher.encrypt.return_value = b'test'
         cipher_text = self.unit.encrypt(text)
         self.assertIsNotNone(cipher_text)
+        self.unit.cipher.encrypt.assert_called_with(b'test'.ljust(AES_BLOCK_SIZE))
 
-    @mock.patch('Crypto.Cipher.AES.AESCipher.decrypt')
-    def test_decrypt(self, mock_cipher_decrypt):
+    def test_decrypt(self):
         cipher_text = 'cipher'
-        mock_cipher_decrypt.return_value = 'text'
+        self.unit.cipher = mock.MagicMock()
+        self.unit.cipher.decrypt.return_value = 'text'
         text = self.unit.decrypt(cipher_text)
         self.assertIsNotNone(text)
+
+    def test_encrypt_into_output(self):
+        iv = urandom(AES_BLOCK_SIZE)
+        for length in [16, 20, 64]:
+            with self.subTest(length=length):
+                data = urandom(length)
+                expected = Cipher(self.cipher_type, self.key, iv=iv).encrypt(data)
+                output = bytearray(80)
+                cipher_text = Cipher(self.cipher_type, self.key, iv=iv).encrypt(data, output=output)
+                self.assertEqual(bytes(cipher_text), expected)
+                self.assertEqual(bytes(output[:len(expected)]), expected)
+                buffer = bytearray(data.ljust(80, b'x'))
+                in_place = Cipher(self.cipher_type, self.key, iv=iv).encrypt(memoryview(buffer)[:length], buffer)
+                self.assertEqual(bytes(in_place), expected)
+
+    def test_decrypt_into_output(self):
+        data = urandom(40)
+        unit = Cipher(self.cipher_type, self.key, len(data))
+        buffer = bytearray(unit.encrypt(data))
+        unit = Cipher(self.cipher_type, self.key, len(data), iv=unit.get_iv())
+        first = unit.decrypt(memoryview(buffer)[:32], output=buffer)
+        self.assertEqual(bytes(first), data[:32])
+        last = unit.decrypt(memoryview(buffer)[32:], output=bytearray(16))
+        self.assertEqual(bytes(last), data[32:])
+
@@ -14,18 +14,35 @@
 #
 
 from unittest import TestCase, mock
-from py_crypt_keeper_client.client import CryptKeeperClient, SimpleClient, EncryptingS3Client
+from py_crypt_keeper_client.client import (
+    CryptKeeperClient,
+    DownloadTicket,
+    SimpleClient,
+    EncryptingS3Client,
+    create_session,
+)
+from py_crypt_keeper_client.cache import TTLCache
+from py_crypt_keeper_client.chunked import ChunkedCipher, ChunkedDecryptingFileWriter
 from py_crypt_keeper_client.cipher import Cipher, AES_CBC
+from py_crypt_keeper_client.engines import AES_GCM
+from py_crypt_keeper_client.exceptions import CryptKeeperError, CryptKeeperHTTPError, CircuitOpenError, IntegrityError
+from py_crypt_keeper_client.journal import Checkpoint, checkpoint_path
+from py_crypt_keeper_client.retry import RetryPolicy
 from py_crypt_keeper_client.utility import encode_key
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import json
 import requests
-from os import getcwd
-from Crypto.Hash import SHA256
-from Crypto.Cipher import AES
+import zlib
+from os import getcwd, urandom
+from os.path import exists, join, getsize
+from tempfile import mkdtemp
+from hashlib import sha256
 from base64 import b64encode
+from time import time
+from io import BytesIO
 
-KEY_SIZE = AES.key_size[0]
+KEY_SIZE = 16
 
 API_KEY = 'test'
 USER = 'cryptkeeper-user'
@@ -75,7 +92,7 @@ class TestCryptKeeperClient(BaseClientTest):
             fail = True
         self.assertTrue(fail)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_get_upload_url(self, post_mock):
         post_mock.return_value = self.upload_response
         client = CryptKeeperClient(URL, USER, API_KEY)
@@ -93,7 +110,7 @@ class TestCryptKeeperClient(BaseClientTest):
             data=json.dumps({'document_metadata': metadata})
         )
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_get_upload_url_error(self, post_mock):
         post_mock.side_effect = requests.exceptions.RequestException('ERROR')
         client = CryptKeeperClient(URL, USER, API_KEY)
@@ -101,7 +118,7 @@ class TestCryptKeeperClient(BaseClientTest):
         response = client.get_upload_url(metadata)
         self.assertIsNone(response)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get_download_url(self, get_mock):
         get_mock.return_value = self.download_response
         client = CryptKeeperClient(URL, USER, API_KEY)
@@ -116,14 +133,14 @@ class TestCryptKeeperClient(BaseClientTest):
             headers=headers,
         )
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get_download_url_error(self, get_mock):
         get_mock.side_effect = requests.exceptions.RequestException('ERROR')
         client = CryptKeeperClient(URL, USER, API_KEY)
         response = client.get_download_url(self.document_id)
         self.assertIsNone(response)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get_share(self, get_mock):
         get_mock.return_value = self.get_share_response
         client = CryptKeeperClient(URL, USER, API_KEY)
@@ -138,7 +155,7 @@ class TestCryptKeeperClient(BaseClientTest):
             headers=headers,
         )
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_post_share(self, post_mock):
         post_mock.return_value = self.post_share_response
         client = CryptKeeperClient(URL, USER, API_KEY)
@@ -158,13 +175,104 @@ class TestCryptKeeperClient(BaseClientTest):
             })
         )
 
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_multipart_upload_calls(self, get_mock, post_mock):
+        client = CryptKeeperClient(URL, USER, API_KEY)
+        post_mock.return_value = self.Response(content=b'{"document_id": "d"}', status_code=201)
+        self.assertEqual(client.start_multipart_upload({'name': 'n'}), {'document_id': 'd'})
+        self.assertEqual(post_mock.call_args[1]['url'], '%s/multipart_upload/' % EXPECTED_URL)
+        get_mock.return_value = self.Response(content=b'{"single_use_url": "u"}', status_code=200)
+        self.assertEqual(client.get_part_upload_url('d', 3), {'single_use_url': 'u'})
+        self.assertEqual(get_mock.call_args[1]['url'], '%s/multipart_upload/d/part/3/' % EXPECTED_URL)
+        post_mock.return_value = self.Response(content=b'{"document_id": "d"}', status_code=200)
+        self.assertIsNotNone(client.complete_multipart_upload('d', [{'part_number': 1, 'etag': 'e'}], 10))
+        self.assertEqual(post_mock.call_args[1]['url'], '%s/multipart_upload/d/complete/' % EXPECTED_URL)
+        self.assertEqual(json.loads(post_mock.call_args[1]['data'])['content_length'], 10)
+        post_mock.return_value = self.Response(content=b'', status_code=404)
+        self.assertIsNone(client.start_multipart_upload({'name': 'n'}))
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    @mock.patch('requests.Session.get')
+    def test_retries_unavailable(self, get_mock, sleep_mock):
+        unavailable = mock.MagicMock(status_code=503, headers={'Retry-After': '2'})
+        get_mock.side_effect = [unavailable, requests.exceptions.ConnectionError('reset'), self.download_response]
+        client = CryptKeeperClient(URL, USER, API_KEY)
+        self.assertIsNotNone(client.get_download_url(self.document_id))
+        self.assertEqual(get_mock.call_count, 3)
+        self.assertEqual(sleep_mock.call_args_list[0], mock.call(2.0))
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    @mock.patch('requests.Session.post')
+    def test_raise_errors(self, post_mock, sleep_mock):
+        post_mock.return_value = mock.MagicMock(status_code=502, headers={})
+        client = CryptKeeperClient(URL, USER, API_KEY, raise_errors=True)
+        with self.assertRaises(CryptKeeperHTTPError) as context:
+            client.post_share(self.document_id, USER)
+        self.assertEqual(context.exception.status_code, 502)
+        # a POST may have reached the service through a failing gateway, so it is not repeated.
+        self.assertEqual(post_mock.call_count, 1)
+        post_mock.side_effect = requests.exceptions.ConnectionError('reset')
+        with self.assertRaises(CryptKeeperError):
+            client.get_upload_url({})
+        self.assertFalse(sleep_mock.called)
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    @mock.patch('requests.Session.get')
+    def test_circuit_breaker(self, get_mock, sleep_mock):
+        get_mock.return_value = mock.MagicMock(status_code=503, headers={})
+        client = CryptKeeperClient(URL, USER, API_KEY, retry_policy=RetryPolicy(retries=1, failure_threshold=4))
+        self.assertIsNone(client.get_download_url(self.document_id))
+        self.assertIsNone(client.get_download_url(self.document_id))
+        self.assertEqual(get_mock.call_count, 4)
+        self.assertIsNone(client.get_download_url(self.document_id))
+        self.assertEqual(get_mock.call_count, 4)
+        client.raise_errors = True
+        with self.assertRaises(CircuitOpenError):
+            client.get_download_url(self.document_id)
+        # other endpoints have their own circuit.
+        get_mock.return_value = self.get_share_response
+        self.assertIsNotNone(client.get_share(self.document_id))
+
+    @mock.patch('py_crypt_keeper_client.retry.monotonic')
+    @mock.patch('requests.Session.get')
+    def test_circuit_breaker_trial_raises(self, get_mock, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        client = CryptKeeperClient(URL, USER, API_KEY, retry_policy=RetryPolicy(failure_threshold=1, reset_timeout=10))
+        breaker = client.get_circuit_breaker('share')
+        breaker.record_failure()
+        monotonic_mock.return_value = 111.0
+        for error in [TypeError('broken adapter'), KeyboardInterrupt()]:
+            with self.subTest(error=error):
+                get_mock.side_effect = error
+                with self.assertRaises(type(error)):
+                    client.get_share(self.document_id)
+                self.assertFalse(breaker.trial)
+                self.assertIsNone(client.get_share(self.document_id))
+                monotonic_mock.return_value += 11
+        self.assertEqual(breaker.failures, 2)
+        get_mock.side_effect = None
+        get_mock.return_value = self.get_share_response
+        self.assertIsNotNone(client.get_share(self.document_id))
+
+    def test_session_is_reused(self):
+        session = create_session(pool_size=4)
+        client = CryptKeeperClient(URL, USER, API_KEY, session)
+        self.assertIs(client.session, session)
+        self.assertEqual(session.get_adapter('https://test').poolmanager.connection_pool_kw['maxsize'], 4)
+        with mock.patch.object(session, 'get') as get_mock:
+            get_mock.return_value = self.download_response
+            client.get_download_url(self.document_id)
+            client.get_share(self.document_id)
+            self.assertEqual(get_mock.call_count, 2)
+
 
 class TestEncryptingS3Client(BaseClientTest):
     def setUp(self):
-        key = SHA256.new('test'.encode()).digest()[:KEY_SIZE]
+        key = sha256('test'.encode()).digest()[:KEY_SIZE]
         self.key = b64encode(key).decode('utf-8', 'backslashreplace')
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_upload_error_put(self, put_mock):
         put_mock.side_effect = requests.exceptions.RequestException('ERROR')
         client = EncryptingS3Client('AES|CBC', self.key, 1)
@@ -173,9 +281,9 @@ class TestEncryptingS3Client(BaseClientTest):
         result = client.upload(file, url)
         self.assertFalse(result)
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_upload(self, put_mock):
-        put_mock.return_value = self.upload_response
+        put_mock.return_value = mock.MagicMock(status_code=200, content=b'')
         client = EncryptingS3Client('AES|CBC', self.key, 1)
         file = mock.MagicMock()
         file.read.return_value = 'a'
@@ -183,6 +291,346 @@ class TestEncryptingS3Client(BaseClientTest):
         result = client.upload(file, url)
         self.assertTrue(result)
 
+    @mock.patch('requests.Session.put')
+    def test_upload_error_status(self, put_mock):
+        # a PUT rejected by S3, e.g. with an expired url, is a failed upload.
+        put_mock.return_value = mock.MagicMock(status_code=403, content=b'')
+        put_mock.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError('403 Forbidden')
+        client = EncryptingS3Client('AES|CBC', self.key, 1)
+        self.assertFalse(client.upload(BytesIO(b'a'), 'test_url'))
+        put_mock.return_value.raise_for_status.assert_called_once_with()
+
+    @mock.patch('requests.Session.get')
+    def test_download_error_status(self, get_mock):
+        # the error page of a rejected GET must not be decrypted into the file.
+        get_mock.return_value = mock.MagicMock(status_code=403)
+        get_mock.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError('403 Forbidden')
+        client = EncryptingS3Client(AES_CBC, self.key, 100)
+        file = BytesIO()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.download(file, 'test_url')
+        self.assertEqual(file.getvalue(), b'')
+        get_mock.return_value.iter_content.assert_not_called()
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.get_byte_steam_for_url')
+    def test_download(self, byte_stream_mock):
+        data = b'0123456789' * 10
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        encrypted = cipher.get_iv() + cipher.encrypt(data)
+        byte_stream_mock.return_value = iter([encrypted[:40], encrypted[40:41], encrypted[41:]])
+        client = EncryptingS3Client(AES_CBC, self.key, len(data))
+        file = BytesIO()
+        result = client.download(file, 'test_url')
+        self.assertTrue(result)
+        self.assertEqual(file.getvalue(), data)
+        byte_stream_mock.assert_called_with(client.chunk_size, 'test_url')
+
+    def test_download_ranges(self):
+        data = urandom(1000)
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        encrypted = cipher.get_iv() + cipher.encrypt(data)
+
+        def get(url, headers):
+            start, end = [int(i) for i in headers['Range'][len('bytes='):].split('-')]
+            response = mock.MagicMock(status_code=206, content=encrypted[start:end + 1])
+            return response
+        session = mock.MagicMock()
+        session.get.side_effect = get
+        client = EncryptingS3Client(AES_CBC, self.key, len(data), session=session)
+        filename = join(mkdtemp(), 'ranges.bin')
+        self.assertTrue(client.download_ranges(filename, 'test_url', jobs=3, range_size=64))
+        self.assertEqual(session.get.call_count, 16)
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    def test_upload_multipart(self, sleep_mock):
+        data = urandom(1000)
+        parts = {}
+        failures = {2: 1}
+
+        def put(url, data):
+            part_number = int(url.split('/')[-1])
+            if failures.get(part_number):
+                failures[part_number] -= 1
+                raise requests.exceptions.ConnectionError('blip')
+            parts[part_number] = data
+            return mock.MagicMock(status_code=200, headers={'ETag': 'etag-%d' % part_number})
+        session = mock.MagicMock()
+        session.put.side_effect = put
+        client = EncryptingS3Client(AES_CBC, self.key, None, session=session)
+        uploaded, content_length = client.upload_multipart(
+            BytesIO(data), lambda n: 'part/%d' % n, jobs=3, part_size=128)
+        self.assertEqual(content_length, 1000)
+        self.assertEqual([p['part_number'] for p in uploaded], list(range(1, 9)))
+        self.assertEqual(uploaded[1]['etag'], 'etag-2')
+        self.assertTrue(all(len(parts[n]) == 128 for n in range(1, 8)))
+        self.assertEqual(sleep_mock.call_count, 1)
+        encrypted = b''.join(parts[n] for n in range(1, 9))
+        cipher = Cipher(AES_CBC, self.key, len(data), iv=encrypted[:16])
+        self.assertEqual(cipher.decrypt(encrypted[16:]), data)
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    def test_upload_multipart_part_failure(self, sleep_mock):
+        session = mock.MagicMock()
+        session.put.side_effect = requests.exceptions.ConnectionError('down')
+        client = EncryptingS3Client(AES_CBC, self.key, None, session=session)
+        self.assertIsNone(client.upload_multipart(BytesIO(urandom(500)), lambda n: 'url', 2, 128, retries=2))
+
+    def range_session(self, encrypted):
+        def get(url, headers):
+            start, end = [int(i) for i in headers['Range'][len('bytes='):].split('-')]
+            return mock.MagicMock(status_code=206, content=encrypted[start:end + 1])
+        session = mock.MagicMock()
+        session.get.side_effect = get
+        return session
+
+    def test_read_range(self):
+        data = urandom(1000)
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        encrypted = cipher.get_iv() + cipher.encrypt(data)
+        session = self.range_session(encrypted)
+        client = EncryptingS3Client(AES_CBC, self.key, len(data), session=session)
+        for offset, length in [(0, 1), (0, 16), (15, 2), (17, 100), (990, 10), (990, 100), (1000, 5), (3, 0)]:
+            with self.subTest(offset=offset, length=length):
+                self.assertEqual(client.read_range('test_url', offset, length), data[offset:offset + length])
+        session.get.reset_mock()
+        client.read_range('test_url', 40, 8)
+        session.get.assert_called_once_with(url='test_url', headers={'Range': 'bytes=32-63'})
+
+    def test_download_resumable(self):
+        data = urandom(1000)
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        encrypted = cipher.get_iv() + cipher.encrypt(data)
+        starts = []
+
+        def get(url, headers, stream):
+            start = int(headers.get('Range', 'bytes=0-')[len('bytes='):-1])
+            starts.append(start)
+
+            def chunks():
+                for i in range(start, len(encrypted), 64):
+                    if len(starts) == 1 and i >= 400:
+                        raise requests.exceptions.ConnectionError('reset')
+                    yield encrypted[i:i + 64]
+            response = mock.MagicMock(status_code=206 if start else 200)
+            response.iter_content.return_value = chunks()
+            return response
+        session = mock.MagicMock()
+        session.get.side_effect = get
+        client = EncryptingS3Client(AES_CBC, self.key, len(data), chunk_size=64, session=session)
+        path = mkdtemp()
+        filename = join(path, 'resumed.bin')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.download_resumable(filename, 'test_url', Checkpoint(join(path, 'checkpoint.json')), interval=128)
+        checkpoint = Checkpoint(join(path, 'checkpoint.json'))
+        self.assertEqual(checkpoint.state['committed'], 432)
+        self.assertEqual(getsize(filename), 432)
+        self.assertTrue(client.download_resumable(filename, 'test_url', checkpoint, interval=128))
+        self.assertEqual(starts, [0, 448])
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    def test_download_ranges_resumed(self):
+        data = urandom(1000)
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        encrypted = cipher.get_iv() + cipher.encrypt(data)
+        session = self.range_session(encrypted)
+        get = session.get.side_effect
+
+        def fail_once(url, headers):
+            if headers['Range'].startswith('bytes=128-'):
+                session.get.side_effect = get
+                raise requests.exceptions.ConnectionError('reset')
+            return get(url, headers)
+        session.get.side_effect = fail_once
+        client = EncryptingS3Client(AES_CBC, self.key, len(data), session=session)
+        path = mkdtemp()
+        filename = join(path, 'ranges.bin')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.download_ranges(filename, 'test_url', jobs=1, range_size=64,
+                                   checkpoint=Checkpoint(join(path, 'checkpoint.json')))
+        checkpoint = Checkpoint(join(path, 'checkpoint.json'))
+        done = checkpoint.state['ranges']
+        self.assertTrue(done)
+        self.assertNotIn(128, done)
+        session.get.reset_mock()
+        self.assertTrue(client.download_ranges(filename, 'test_url', jobs=3, range_size=64, checkpoint=checkpoint))
+        self.assertEqual(session.get.call_count, 16 - len(done))
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    def test_upload_multipart_resumed(self, sleep_mock):
+        data = urandom(1000)
+        parts = {}
+        failing = {5}
+
+        def put(url, data):
+            part_number = int(url.split('/')[-1])
+            if part_number in failing:
+                raise requests.exceptions.ConnectionError('down')
+            parts[part_number] = data
+            return mock.MagicMock(status_code=200, headers={'ETag': 'etag-%d' % part_number})
+        session = mock.MagicMock()
+        session.put.side_effect = put
+        path = join(mkdtemp(), 'checkpoint.json')
+        client = EncryptingS3Client(AES_CBC, self.key, len(data), session=session)
+        file = BytesIO(data)
+        self.assertIsNone(client.upload_multipart(file, lambda n: 'part/%d' % n, 1, 128, 0, Checkpoint(path)))
+        checkpoint = Checkpoint(path)
+        confirmed = sorted(int(n) for n, part in checkpoint.state['parts'].items() if 'etag' in part)
+        self.assertEqual(confirmed[:3], [1, 2, 3])
+        self.assertNotIn(5, confirmed)
+        session.put.reset_mock()
+        failing.clear()
+        uploaded, content_length = client.upload_multipart(file, lambda n: 'part/%d' % n, 2, 128, 0, checkpoint)
+        self.assertEqual(content_length, 1000)
+        self.assertEqual([p['part_number'] for p in uploaded], list(range(1, 9)))
+        self.assertEqual([p['etag'] for p in uploaded], ['etag-%d' % n for n in range(1, 9)])
+        resent = sorted(int(c[1]['url'].split('/')[-1]) for c in session.put.call_args_list)
+        self.assertEqual(resent, [n for n in range(1, 9) if n not in confirmed])
+        encrypted = b''.join(parts[n] for n in range(1, 9))
+        cipher = Cipher(AES_CBC, self.key, len(data), iv=encrypted[:16])
+        self.assertEqual(cipher.decrypt(encrypted[16:]), data)
+
+    def upload_chunked(self, data, chunk_size=64, encryption_type=AES_GCM, executor=None):
+        uploaded = []
+
+        def put(url, data):
+            uploaded.append(b''.join(data))
+            return mock.MagicMock(status_code=200)
+        session = mock.MagicMock()
+        session.put.side_effect = put
+        client = EncryptingS3Client(
+            encryption_type, self.key, len(data), chunk_size=chunk_size, session=session, cipher_jobs=3,
+            executor=executor)
+        self.assertTrue(client.upload(BytesIO(data), 'test_url'))
+        return uploaded[0]
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.get_byte_steam_for_url')
+    def test_upload_pipelined(self, byte_stream_mock):
+        data = urandom(1000)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for encryption_type in [AES_CBC, AES_GCM]:
+                with self.subTest(encryption_type=encryption_type):
+                    encrypted = self.upload_chunked(data, 64, encryption_type, executor)
+                    byte_stream_mock.return_value = iter([encrypted])
+                    file = BytesIO()
+                    EncryptingS3Client(encryption_type, self.key, len(data)).download(file, 'test_url')
+                    self.assertEqual(file.getvalue(), data)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.get_byte_steam_for_url')
+    def test_chunked_upload_download(self, byte_stream_mock):
+        data = urandom(1000)
+        encrypted = self.upload_chunked(data)
+        self.assertEqual(len(encrypted), 16 + len(data) + 16 * 16)
+        byte_stream_mock.return_value = iter([encrypted[:10], encrypted[10:500], encrypted[500:]])
+        client = EncryptingS3Client(AES_GCM, self.key, len(data), cipher_jobs=2)
+        file = BytesIO()
+        self.assertTrue(client.download(file, 'test_url'))
+        self.assertEqual(file.getvalue(), data)
+        tampered = bytearray(encrypted)
+        tampered[600] ^= 1
+        byte_stream_mock.return_value = iter([bytes(tampered)])
+        with self.assertRaises(IntegrityError):
+            client.download(BytesIO(), 'test_url')
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.get_byte_steam_for_url')
+    def test_chunked_download_network_error(self, byte_stream_mock):
+        data = urandom(1000)
+        encrypted = self.upload_chunked(data)
+
+        def byte_stream(*args):
+            yield encrypted[:500]
+            raise requests.exceptions.ConnectionError('reset')
+        byte_stream_mock.side_effect = byte_stream
+        client = EncryptingS3Client(AES_GCM, self.key, len(data), cipher_jobs=2, chunk_size=64)
+        shutdown = ChunkedDecryptingFileWriter.shutdown
+        with mock.patch.object(ChunkedDecryptingFileWriter, 'shutdown', autospec=True, side_effect=shutdown) as mocked:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                client.download(BytesIO(), 'test_url')
+        mocked.assert_called_once()
+        self.assertIsNone(mocked.call_args[0][0].executor)
+
+    def test_chunked_download_ranges(self):
+        data = urandom(1000)
+        encrypted = self.upload_chunked(data)
+        session = self.range_session(encrypted)
+        client = EncryptingS3Client(AES_GCM, self.key, len(data), session=session)
+        filename = join(mkdtemp(), 'ranges.bin')
+        self.assertTrue(client.download_ranges(filename, 'test_url', jobs=3, range_size=128))
+        # the header and 8 ranges of 2 chunks.
+        self.assertEqual(session.get.call_count, 9)
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    def test_chunked_read_range(self):
+        data = urandom(1000)
+        encrypted = self.upload_chunked(data)
+        client = EncryptingS3Client(AES_GCM, self.key, len(data), session=self.range_session(encrypted))
+        for offset, length in [(0, 1), (0, 64), (63, 2), (100, 300), (990, 100), (1000, 5)]:
+            with self.subTest(offset=offset, length=length):
+                self.assertEqual(client.read_range('test_url', offset, length), data[offset:offset + length])
+
+    @mock.patch('py_crypt_keeper_client.client.sleep')
+    def test_chunked_upload_multipart_resumed(self, sleep_mock):
+        data = urandom(1000)
+        parts = {}
+        failing = {3}
+
+        def put(url, data):
+            part_number = int(url.split('/')[-1])
+            if part_number in failing:
+                raise requests.exceptions.ConnectionError('down')
+            parts[part_number] = data
+            return mock.MagicMock(status_code=200, headers={'ETag': 'etag-%d' % part_number})
+        session = mock.MagicMock()
+        session.put.side_effect = put
+        path = join(mkdtemp(), 'checkpoint.json')
+        client = EncryptingS3Client(AES_GCM, self.key, len(data), chunk_size=64, session=session)
+        file = BytesIO(data)
+        self.assertIsNone(client.upload_multipart(file, lambda n: 'part/%d' % n, 1, 128, 0, Checkpoint(path)))
+        checkpoint = Checkpoint(path)
+        self.assertIn('header', checkpoint.state)
+        failing.clear()
+        session.put.reset_mock()
+        uploaded, content_length = client.upload_multipart(file, lambda n: 'part/%d' % n, 2, 128, 0, checkpoint)
+        self.assertEqual(content_length, 1000)
+        # parts of 2 chunks.
+        self.assertEqual([p['part_number'] for p in uploaded], list(range(1, 9)))
+        self.assertNotIn(mock.call(url='part/1', data=mock.ANY), session.put.call_args_list)
+        encrypted = b''.join(parts[n] for n in range(1, 9))
+        byte_stream = mock.patch.object(client, 'get_byte_steam_for_url', return_value=iter([encrypted]))
+        file = BytesIO()
+        with byte_stream:
+            client.download(file, 'test_url')
+        self.assertEqual(file.getvalue(), data)
+
+    def test_chunked_upload_multipart_stream(self):
+        data = urandom(1000)
+        parts = {}
+        session = mock.MagicMock()
+        session.put.side_effect = lambda url, data: parts.__setitem__(url, data) or mock.MagicMock(
+            status_code=200, headers={'ETag': 'etag'})
+        client = EncryptingS3Client(AES_GCM, self.key, None, chunk_size=64, session=session)
+        uploaded, content_length = client.upload_multipart(BytesIO(data), lambda n: 'part/%d' % n, 3, 208)
+        self.assertEqual(content_length, 1000)
+        # parts of 3 chunks, the first carries the header.
+        self.assertEqual(len(parts['part/1']), 16 + 3 * 80)
+        self.assertEqual(len(uploaded), 6)
+        cipher = ChunkedCipher(AES_GCM, self.key, parts['part/1'][:16])
+        encrypted = b''.join(parts['part/%d' % n] for n in range(1, 7))
+        start, end = cipher.calculate_chunk_range(0, 16, len(data))
+        self.assertEqual(cipher.decrypt_range(encrypted[start:end + 1], start, end, len(data))[1], data)
+
+    def test_download_ranges_requires_range_support(self):
+        session = mock.MagicMock()
+        session.get.return_value = mock.MagicMock(status_code=200, content=b'')
+        client = EncryptingS3Client(AES_CBC, self.key, 100, session=session)
+        with self.assertRaises(requests.exceptions.RequestException):
+            client.download_ranges(join(mkdtemp(), 'ranges.bin'), 'test_url', jobs=2, range_size=32)
+
 
 class TestSimpleClient(BaseClientTest):
     @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
@@ -211,6 +659,147 @@ class TestSimpleClient(BaseClientTest):
         self.assertIsNotNone(document_id)
         self.assertEqual(document_id, self.document_id)
 
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
+    def test_upload_file_encryption_type(self, get_upload_url_mock, s3_client_upload_mock):
+        get_upload_url_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        s3_client_upload_mock.return_value = True
+        client = SimpleClient.create(URL, USER, API_KEY)
+        client.upload_file(__file__)
+        self.assertEqual(get_upload_url_mock.call_args[0][0]['encryption_type'], AES_CBC)
+        client = SimpleClient.create(URL, USER, API_KEY, encryption_type=AES_GCM)
+        client.upload_file(__file__)
+        self.assertEqual(get_upload_url_mock.call_args[0][0]['encryption_type'], AES_GCM)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
+    def test_upload_file_compressed(self, get_upload_url_mock, s3_client_upload_mock):
+        get_upload_url_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        s3_client_upload_mock.return_value = True
+        client = SimpleClient.create(URL, USER, API_KEY, compression='zlib')
+        document_id = client.upload_file(__file__)
+        self.assertEqual(document_id, self.document_id)
+        document_metadata = get_upload_url_mock.call_args[0][0]
+        self.assertTrue(document_metadata['compressed'])
+        with open(__file__, 'rb') as file:
+            self.assertLess(document_metadata['content_length'], len(file.read()))
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.download')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
+    def test_download_file_compressed(self, get_download_url_mock, s3_client_mock):
+        get_download_url_mock.return_value = json.loads(self.download_response.content.decode('utf-8'))
+        get_download_url_mock.return_value['document_metadata']['compressed'] = True
+        s3_client_mock.side_effect = lambda file, url: file.write(zlib.compress(b'plain text'))
+        client = SimpleClient.create(URL, USER, API_KEY)
+        path = mkdtemp()
+        self.assertTrue(client.download_file(self.document_id, 'out.txt', path, range_jobs=4))
+        with open(join(path, 'out.txt'), 'rb') as file:
+            self.assertEqual(file.read(), b'plain text')
+        with self.assertRaises(ValueError):
+            client.read_document(self.document_id, 0, 10)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
+    def test_upload_stream(self, get_upload_url_mock, s3_client_upload_mock):
+        get_upload_url_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        uploaded = []
+        s3_client_upload_mock.side_effect = lambda file, url: uploaded.append(file.read()) or True
+        client = SimpleClient.create(URL, USER, API_KEY)
+        for stream in [BytesIO(b'streamed data'), (b for b in [b'streamed', b' ', b'data'])]:
+            with self.subTest(stream=stream):
+                self.assertEqual(client.upload_stream(stream, 'stdin'), self.document_id)
+                document_metadata = get_upload_url_mock.call_args[0][0]
+                self.assertEqual(document_metadata['content_length'], 13)
+                self.assertEqual(document_metadata['name'], 'stdin')
+                self.assertEqual(uploaded[-1], b'streamed data')
+
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.complete_multipart_upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_part_upload_url')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.start_multipart_upload')
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload_multipart')
+    def test_upload_stream_multipart(self, upload_multipart_mock, start_mock, part_url_mock, complete_mock):
+        start_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        part_url_mock.return_value = {'single_use_url': 'part-url'}
+        complete_mock.return_value = {}
+        streamed = []
+
+        def upload_multipart(file, get_part_url, jobs, part_size, checkpoint=None):
+            self.assertEqual(get_part_url(1), 'part-url')
+            streamed.append(file.read())
+            return [{'part_number': 1, 'etag': 'e'}], len(streamed[0])
+        upload_multipart_mock.side_effect = upload_multipart
+        client = SimpleClient.create(URL, USER, API_KEY, part_size=64)
+        data = urandom(200)
+        document_id = client.upload_stream((data[i:i + 30] for i in range(0, 200, 30)), 'stream')
+        self.assertEqual(document_id, self.document_id)
+        self.assertEqual(streamed, [data])
+        self.assertIsNone(start_mock.call_args[0][0]['content_length'])
+        complete_mock.assert_called_with(self.document_id, [{'part_number': 1, 'etag': 'e'}], 200)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.start_multipart_upload')
+    def test_upload_file_multipart_unsupported(self, start_mock, get_upload_url_mock, s3_client_upload_mock):
+        start_mock.return_value = None
+        get_upload_url_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        s3_client_upload_mock.return_value = True
+        client = SimpleClient.create(URL, USER, API_KEY, multipart_threshold=10)
+        self.assertEqual(client.upload_file(__file__), self.document_id)
+        self.assertTrue(start_mock.called)
+        self.assertEqual(get_upload_url_mock.call_args[0][0]['content_length'], getsize(__file__))
+
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.complete_multipart_upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_multipart_upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.start_multipart_upload')
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload_multipart')
+    def test_upload_file_resumes_multipart(self, upload_multipart_mock, start_mock, get_upload_mock, complete_mock):
+        upload_info = json.loads(self.upload_response.content.decode('utf-8'))
+        start_mock.return_value = upload_info
+        get_upload_mock.return_value = upload_info
+        complete_mock.return_value = {}
+        upload_multipart_mock.return_value = None
+        checkpoint_dir = mkdtemp()
+        client = SimpleClient.create(URL, USER, API_KEY, part_size=64, checkpoint_dir=checkpoint_dir)
+        self.assertIsNone(client.upload_file(__file__))
+        checkpoint = upload_multipart_mock.call_args[1]['checkpoint']
+        self.assertEqual(Checkpoint(checkpoint.path).state['document_id'], self.document_id)
+        self.assertNotIn(upload_info['symmetric_key'], open(checkpoint.path).read())
+        upload_multipart_mock.return_value = [{'part_number': 1, 'etag': 'e'}], getsize(__file__)
+        self.assertEqual(client.upload_file(__file__), self.document_id)
+        self.assertEqual(start_mock.call_count, 1)
+        get_upload_mock.assert_called_once_with(self.document_id)
+        self.assertFalse(exists(checkpoint_path(checkpoint_dir, 'upload', __file__)))
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.download_resumable')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
+    def test_download_file_with_checkpoint(self, get_download_url_mock, download_mock):
+        get_download_url_mock.return_value = json.loads(self.download_response.content.decode('utf-8'))
+        download_mock.return_value = True
+        checkpoint_dir = mkdtemp()
+        client = SimpleClient.create(URL, USER, API_KEY, checkpoint_dir=checkpoint_dir)
+        self.assertTrue(client.download_file(self.document_id, file_path=mkdtemp()))
+        filename, url, checkpoint = download_mock.call_args[0]
+        self.assertEqual(checkpoint.state['document_id'], self.document_id)
+        self.assertEqual(checkpoint.path, checkpoint_path(checkpoint_dir, 'download', filename))
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.upload_file')
+    def test_upload_files(self, upload_file_mock):
+        def upload_file(filename):
+            if filename == 'missing':
+                raise FileNotFoundError('missing')
+            if filename == 'rejected':
+                return None
+            return 'id-%s' % filename
+        upload_file_mock.side_effect = upload_file
+        client = SimpleClient.create(URL, USER, API_KEY)
+        results = {r.filename: r for r in client.upload_files(['a', 'b', 'missing', 'rejected'], jobs=2)}
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results['a'].document_id, 'id-a')
+        self.assertIsNone(results['a'].error)
+        self.assertEqual(results['missing'].error, 'missing')
+        self.assertIsNone(results['rejected'].document_id)
+        self.assertIsNotNone(results['rejected'].error)
+
     @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.download')
     @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
     def test_download_file(self, get_download_url_mock, s3_client_mock):
@@ -220,6 +809,82 @@ class TestSimpleClient(BaseClientTest):
         result = client.download_file(self.document_id)
         self.assertTrue(result)
 
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.upload')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_upload_url')
+    def test_upload_files_share_cipher_executor(self, get_upload_url_mock, s3_client_upload_mock):
+        get_upload_url_mock.return_value = json.loads(self.upload_response.content.decode('utf-8'))
+        s3_client_upload_mock.return_value = True
+        client = SimpleClient.create(URL, USER, API_KEY, cipher_jobs=2)
+        with mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.__init__', return_value=None) as init_mock:
+            list(client.upload_files([__file__] * 3, jobs=3))
+        executors = {c[1]['executor'] for c in init_mock.call_args_list}
+        self.assertEqual(executors, {client.cipher_executor})
+        self.assertEqual(client.cipher_executor._max_workers, 2)
+        client.close()
+        self.assertIsNone(client.cipher_executor)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.download')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
+    def test_download_file_shares_session(self, get_download_url_mock, s3_client_mock):
+        get_download_url_mock.return_value = json.loads(self.download_response.content.decode('utf-8'))
+        session = create_session()
+        client = SimpleClient.create(URL, USER, API_KEY, session=session)
+        with mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.__init__', return_value=None) as init_mock:
+            client.download_file(self.document_id, file_path=mkdtemp())
+        self.assertIs(init_mock.call_args[0][-1], session)
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.read_range')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
+    def test_read_document(self, get_download_url_mock, read_range_mock):
+        get_download_url_mock.return_value = json.loads(self.download_response.content.decode('utf-8'))
+        read_range_mock.return_value = b'tail'
+        client = SimpleClient.create(URL, USER, API_KEY)
+        self.assertEqual(client.read_document(self.document_id, -4), b'tail')
+        read_range_mock.assert_called_with(get_download_url_mock.return_value['single_use_url'], 1300, 4)
+        client.read_document(self.document_id, 10)
+        read_range_mock.assert_called_with(get_download_url_mock.return_value['single_use_url'], 10, 1294)
+        get_download_url_mock.return_value = None
+        self.assertIsNone(client.read_document(self.document_id, 0, 10))
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.download_file')
+    def test_download_files(self, download_file_mock):
+        def download_file(document_id, file_path=None, range_jobs=1, ticket=None):
+            self.assertEqual(ticket.document_id, document_id)
+            if document_id == 'broken':
+                raise requests.exceptions.RequestException('broken')
+            return True
+
+        def get_download_ticket(document_id):
+            return None if document_id == 'unknown' else DownloadTicket(document_id, {}, None)
+        download_file_mock.side_effect = download_file
+        client = SimpleClient.create(URL, USER, API_KEY)
+        client.get_download_ticket = get_download_ticket
+        results = {r.document_id: r for r in client.download_files(['a', 'broken', 'unknown'], 'path', jobs=2)}
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results['a'].downloaded)
+        self.assertIsNone(results['a'].error)
+        self.assertFalse(results['broken'].downloaded)
+        self.assertEqual(results['broken'].error, 'broken')
+        self.assertFalse(results['unknown'].downloaded)
+        self.assertIsNotNone(results['unknown'].error)
+        download_file_mock.assert_any_call('a', file_path='path', range_jobs=1, ticket=DownloadTicket('a', {}, None))
+
+    @mock.patch('py_crypt_keeper_client.client.EncryptingS3Client.download')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_download_url')
+    def test_download_file_with_ticket(self, get_download_url_mock, s3_client_mock):
+        download_info = json.loads(self.download_response.content.decode('utf-8'))
+        get_download_url_mock.return_value = download_info
+        client = SimpleClient.create(URL, USER, API_KEY)
+        ticket = DownloadTicket(self.document_id, download_info, time() + 600)
+        self.assertTrue(client.download_file(self.document_id, file_path=mkdtemp(), ticket=ticket))
+        self.assertFalse(get_download_url_mock.called)
+        ticket = client.get_download_ticket(self.document_id)
+        # the fixture's url was signed in 2017 and has long expired.
+        self.assertTrue(ticket.expired())
+        get_download_url_mock.reset_mock()
+        self.assertTrue(client.download_file(self.document_id, file_path=mkdtemp(), ticket=ticket))
+        self.assertTrue(get_download_url_mock.called)
+
     @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_share')
     def test_get_share(self, get_share_mock):
         get_share_mock.return_value = json.loads(self.get_share_response.content.decode('utf-8'))
@@ -262,6 +927,85 @@ class TestSimpleClient(BaseClientTest):
         self.assertIsNotNone(result)
         self.assertEqual([], result)
 
+    @mock.patch('requests.Session.post')
+    def test_post_shares_batch(self, post_mock):
+        def post(url, headers, data):
+            shares = json.loads(data)['shares']
+            results = [{'resource_uri': '/share/%s/' % share['document_id']} for share in shares]
+            results[0] = {'error': 'unknown user'}
+            return self.Response(content=json.dumps({'results': results}).encode(), status_code=201)
+        post_mock.side_effect = post
+        cache = TTLCache()
+        cache.put('d1', ('someone',))
+        client = SimpleClient.create(URL, USER, API_KEY, share_cache=cache)
+        pairs = [('d%d' % i, 'user') for i in range(5)]
+        results = sorted(client.post_shares(pairs, jobs=2, batch_size=2))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(post_mock.call_count, 3)
+        self.assertEqual(post_mock.call_args[1]['url'], '%s/share/batch/' % EXPECTED_URL)
+        self.assertEqual([r.document_id for r in results if r.error], ['d0', 'd2', 'd4'])
+        self.assertEqual(results[1], ('d1', 'user', '/share/d1/', None))
+        self.assertEqual(len(cache), 0)
+
+    @mock.patch('requests.Session.post')
+    def test_post_shares_fallback(self, post_mock):
+        def post(url, headers, data):
+            if url.endswith('/batch/'):
+                return self.Response(content=b'', status_code=404)
+            if json.loads(data)['username'] == 'missing':
+                return self.Response(content=b'', status_code=400)
+            return self.post_share_response
+        post_mock.side_effect = post
+        client = SimpleClient.create(URL, USER, API_KEY)
+        pairs = [(self.document_id, 'user-%d' % i) for i in range(4)] + [(self.document_id, 'missing')]
+        results = list(client.post_shares(pairs, jobs=3, batch_size=2))
+        self.assertEqual(len(results), 5)
+        self.assertEqual([r.username for r in results if r.error], ['missing'])
+        self.assertFalse(client.batch_shares)
+        post_mock.reset_mock()
+        self.assertEqual(len(list(client.post_shares(pairs[:2]))), 2)
+        self.assertEqual(post_mock.call_count, 2)
+
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.post_share')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_share')
+    def test_get_share_cached(self, get_share_mock, post_share_mock):
+        get_share_mock.return_value = json.loads(self.get_share_response.content.decode('utf-8'))
+        post_share_mock.return_value = json.loads(self.post_share_response.content.decode('utf-8'))
+        cache = TTLCache()
+        client = SimpleClient.create(URL, USER, API_KEY, share_cache=cache)
+        self.assertEqual(client.get_share(self.document_id), ['cryptkeeper-user', 'other-user'])
+        client.get_share(self.document_id).append('mutated')
+        self.assertEqual(client.get_share(self.document_id), ['cryptkeeper-user', 'other-user'])
+        self.assertEqual(get_share_mock.call_count, 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        client.post_share(self.document_id, 'new-user')
+        client.get_share(self.document_id)
+        self.assertEqual(get_share_mock.call_count, 2)
+        get_share_mock.return_value = None
+        self.assertEqual(client.get_share('unknown'), [])
+        self.assertEqual(client.get_share('unknown'), [])
+        self.assertEqual(get_share_mock.call_count, 4)
+
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.post_share')
+    @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.get_share')
+    def test_get_share_invalidated_in_flight(self, get_share_mock, post_share_mock):
+        cache = TTLCache()
+        client = SimpleClient.create(URL, USER, API_KEY, share_cache=cache)
+        post_share_mock.return_value = json.loads(self.post_share_response.content.decode('utf-8'))
+
+        def get_share(document_id):
+            # the share is posted after the service answered but before the answer is cached.
+            client.post_share(document_id, 'new-user')
+            return {'users': ['cryptkeeper-user']}
+        get_share_mock.side_effect = get_share
+        self.assertEqual(client.get_share(self.document_id), ['cryptkeeper-user'])
+        self.assertIsNone(cache.get(self.document_id))
+        get_share_mock.side_effect = None
+        get_share_mock.return_value = {'users': ['cryptkeeper-user', 'new-user']}
+        self.assertEqual(client.get_share(self.document_id), ['cryptkeeper-user', 'new-user'])
+        self.assertEqual(client.get_share(self.document_id), ['cryptkeeper-user', 'new-user'])
+        self.assertEqual(get_share_mock.call_count, 2)
+
     @mock.patch('py_crypt_keeper_client.client.CryptKeeperClient.post_share')
     def test_post_share(self, post_share_mock):
         post_share_mock.return_value = json.loads(self.post_share_response.content.decode('utf-8'))
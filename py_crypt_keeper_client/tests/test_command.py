@@ -0,0 +1,227 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import sys
+from subprocess import run, PIPE
+from unittest import TestCase, mock
+from argparse import ArgumentTypeError
+from io import StringIO
+from logging import root
+from os import close, remove
+from tempfile import mkstemp
+from py_crypt_keeper_client.client import ShareResult
+from py_crypt_keeper_client.command import (
+    console_handler,
+    main,
+    positive_int,
+    read_document_ids,
+    read_share_pairs,
+    MAX_DOCUMENT_LINES,
+)
+
+
+class ReadDocumentIdsTest(TestCase):
+    def test_newline_delimited(self):
+        lines = StringIO('{"documentId": "a"}\n\n{"documentId": "b", "error": null}\n')
+        self.assertEqual(list(read_document_ids(lines)), ['a', 'b'])
+
+    def test_single_object_over_several_lines(self):
+        lines = StringIO('{\n  "documentId": "a"\n}\n')
+        self.assertEqual(list(read_document_ids(lines)), ['a'])
+
+    def test_skips_missing_document_id(self):
+        lines = StringIO('{"documentId": null, "error": "failed"}\n{"documentId": "b"}\n')
+        self.assertEqual(list(read_document_ids(lines)), ['b'])
+
+    def test_bad_line_does_not_swallow_the_rest(self):
+        lines = StringIO('{"documentId": "a"}\nnot json\n{"documentId": "b"}\n{broken\n{"documentId": "c"}\n')
+        self.assertEqual(list(read_document_ids(lines)), ['a', 'b', 'c'])
+
+    def test_unreadable_input_is_bounded(self):
+        # without the bound the object spanning the last three lines would be appended to the unreadable ones.
+        lines = StringIO('{\n' * MAX_DOCUMENT_LINES + '{\n"documentId": "a"\n}\n')
+        with self.assertLogs('py_crypt_keeper_client.command', 'WARNING'):
+            self.assertEqual(list(read_document_ids(lines)), ['a'])
+
+    def test_skips_values_that_are_not_objects(self):
+        lines = StringIO('42\n["documentId"]\n"a"\n{"documentId": "b"}\n')
+        self.assertEqual(list(read_document_ids(lines)), ['b'])
+
+
+class ReadSharePairsTest(TestCase):
+    def test_pairs(self):
+        lines = StringIO('a alice\n\n  b   bob \n{"documentId": "c", "username": "carol"}\n')
+        self.assertEqual(list(read_share_pairs(lines)), [('a', 'alice'), ('b', 'bob'), ('c', 'carol')])
+
+    def test_documents_without_username(self):
+        lines = StringIO('{"documentId": "a", "error": null}\nb\nc carol\n')
+        self.assertEqual(list(read_share_pairs(lines, ['x', 'y'])), [
+            ('a', 'x'), ('a', 'y'), ('b', 'x'), ('b', 'y'), ('c', 'carol'),
+        ])
+
+    def test_skips_bad_lines(self):
+        lines = StringIO('{"documentId": null}\n{broken\na alice\n')
+        self.assertEqual(list(read_share_pairs(lines)), [('a', 'alice')])
+
+
+class PositiveIntTest(TestCase):
+    def test_positive_int(self):
+        self.assertEqual(positive_int('3'), 3)
+        for text in ['0', '-2', 'x']:
+            with self.subTest(text=text):
+                with self.assertRaises(ArgumentTypeError):
+                    positive_int(text)
+
+
+class MainTest(TestCase):
+    def run_main(self, *args):
+        # returns the exit code and what was written to stderr.
+        self.addCleanup(root.removeHandler, console_handler)
+        stderr = StringIO()
+        argv = ['ckc', '--url', 'http://localhost', '--user', 'user', '--api-key', 'key'] + list(args)
+        with mock.patch('sys.argv', argv), mock.patch('py_crypt_keeper_client.command.stderr', stderr), \
+                mock.patch('py_crypt_keeper_client.command.CONFIGURATION_FILE_NAME', '/nonexistent/.ckc_config.json'):
+            try:
+                main()
+                code = 0
+            except SystemExit as e:
+                code = e.code
+        return code, stderr.getvalue()
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.upload_files')
+    def test_upload_stdin_with_files(self, upload_files_mock):
+        with mock.patch('sys.stderr', StringIO()) as stderr:
+            code, _ = self.run_main('upload', 'a.txt', '-', 'b.txt')
+        self.assertEqual(code, 2)
+        self.assertIn('- cannot be combined with other files', stderr.getvalue())
+        self.assertFalse(upload_files_mock.called)
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.upload_files')
+    def test_jobs_must_be_positive(self, upload_files_mock):
+        for args in [('upload', 'a', 'b', '--jobs', '0'), ('upload', 'a', '--cipher-jobs', '-1'),
+                     ('download', 'd1', '--range-jobs', '0'), ('share', '--batch', '-', '--jobs', '0')]:
+            with self.subTest(args=args):
+                with mock.patch('sys.stderr', StringIO()) as stderr:
+                    code, _ = self.run_main(*args)
+                self.assertEqual(code, 2)
+                self.assertIn('must be a positive integer', stderr.getvalue())
+                self.assertNotIn('Traceback', stderr.getvalue())
+        self.assertFalse(upload_files_mock.called)
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.download_files')
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.download_file')
+    def test_download_stdin_with_filename(self, download_file_mock, download_files_mock):
+        download_file_mock.return_value = True
+        with mock.patch('py_crypt_keeper_client.command.stdin', StringIO('{"documentId": "d1"}\n')), \
+                mock.patch('sys.stdout', StringIO()):
+            code, _ = self.run_main('download', '-', '-f', 'out.bin')
+        self.assertEqual(code, 0)
+        download_file_mock.assert_called_once_with('d1', 'out.bin', None, 1)
+        for document_ids, stdin in [(['d1', 'd2'], ''), (['-'], '{"documentId": "d1"}\n{"documentId": "d2"}\n')]:
+            with self.subTest(document_ids=document_ids):
+                with mock.patch('py_crypt_keeper_client.command.stdin', StringIO(stdin)), \
+                        mock.patch('sys.stderr', StringIO()) as stderr:
+                    code, _ = self.run_main('download', *document_ids, '-f', 'out.bin')
+                self.assertEqual(code, 2)
+                self.assertIn('-f/--filename can only be used with a single document id', stderr.getvalue())
+        self.assertFalse(download_files_mock.called)
+        self.assertEqual(download_file_mock.call_count, 1)
+
+    def post_shares(self, shares, jobs):
+        self.shares = list(shares)
+        return [ShareResult(document_id, username, '/share/1/', None) for document_id, username in self.shares]
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.post_shares')
+    def test_share_stdin_with_users(self, post_shares_mock):
+        post_shares_mock.side_effect = self.post_shares
+        stdout = StringIO()
+        with mock.patch('py_crypt_keeper_client.command.stdin', StringIO('{"documentId": "d1"}\n')), \
+                mock.patch('sys.stdout', stdout):
+            code, errors = self.run_main('share', '-', '--add', 'alice', 'bob')
+        self.assertEqual(code, 0)
+        self.assertEqual(self.shares, [('d1', 'alice'), ('d1', 'bob')])
+        self.assertEqual(stdout.getvalue(), 'Added alice to d1.\nAdded bob to d1.\n')
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.post_shares')
+    def test_share_batch_file(self, post_shares_mock):
+        post_shares_mock.side_effect = self.post_shares
+        descriptor, filename = mkstemp()
+        close(descriptor)
+        self.addCleanup(remove, filename)
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write('d1 alice\nd2\n')
+        opened = []
+
+        def tracking_open(*args, **kwargs):
+            opened.append(open(*args, **kwargs))
+            return opened[-1]
+
+        with mock.patch('py_crypt_keeper_client.command.open', tracking_open, create=True), \
+                mock.patch('sys.stdout', StringIO()):
+            code, _ = self.run_main('share', '--batch', filename, '--add', 'bob')
+        self.assertEqual(code, 0)
+        self.assertEqual(self.shares, [('d1', 'alice'), ('d2', 'bob')])
+        self.assertTrue(all(file.closed for file in opened))
+
+    def test_share_stdin_twice(self):
+        with mock.patch('sys.stderr', StringIO()) as stderr:
+            code, _ = self.run_main('share', '-', '--batch', '-', '--add', 'alice')
+        self.assertEqual(code, 2)
+        self.assertIn('- cannot be both the document id and the --batch file', stderr.getvalue())
+
+    @mock.patch('py_crypt_keeper_client.client.SimpleClient.read_document')
+    def test_read_compressed_document(self, read_document_mock):
+        read_document_mock.side_effect = ValueError('Document d1 is compressed and does not support byte range reads.')
+        code, errors = self.run_main('read', 'd1')
+        self.assertEqual(code, 1)
+        self.assertIn('ERROR: Document d1 is compressed', errors)
+        self.assertNotIn('Traceback', errors)
+
+
+class StartupTest(TestCase):
+    # ckc is run many times from shell pipelines, so parsing arguments must not load requests or the cipher libraries.
+    HEAVY = ('requests', 'urllib3', 'Crypto', 'cryptography', 'zstandard', 'lz4')
+
+    def loaded(self, code):
+        script = code + '\nprint(sorted(m for m in sys.modules if m.split(".")[0] in {heavy}))'.format(
+            heavy=self.HEAVY)
+        result = run([sys.executable, '-c', 'import sys\n' + script], stdout=PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0)
+        return result.stdout.splitlines()[-1]
+
+    def test_import_package(self):
+        self.assertEqual(self.loaded('import py_crypt_keeper_client'), '[]')
+
+    def test_help(self):
+        code = '\n'.join([
+            'from py_crypt_keeper_client.command import main',
+            'sys.argv = ["ckc", "--help"]',
+            'try:',
+            '    main()',
+            'except SystemExit:',
+            '    pass',
+        ])
+        self.assertEqual(self.loaded(code), '[]')
+
+    def test_engines_load_on_use(self):
+        code = 'from py_crypt_keeper_client.engines import available_engines, AES_CBC'
+        self.assertEqual(self.loaded(code), '[]')
+        self.assertNotEqual(self.loaded(code + '\navailable_engines(AES_CBC)'), '[]')
+
+    def test_lazy_client(self):
+        self.assertNotEqual(self.loaded('from py_crypt_keeper_client import SimpleClient'), '[]')
+        import py_crypt_keeper_client
+        with self.assertRaises(AttributeError):
+            getattr(py_crypt_keeper_client, 'Missing')
@@ -0,0 +1,92 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock
+from io import BytesIO
+from os import urandom
+import zlib
+from py_crypt_keeper_client.compression import (
+    available_compressions,
+    compress_file,
+    CompressingReader,
+    detect_compression,
+    get_compressor,
+    DecompressingFileWriter,
+    GZIP,
+    ZLIB,
+)
+from py_crypt_keeper_client.utility import DEFAULT_CHUNK_SIZE
+
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        self.data = b'some very compressible text\n' * 10000 + urandom(1000)
+
+    def test_round_trip(self):
+        for compression in available_compressions():
+            for write_size in [1, 3, 1000, 1 << 20]:
+                with self.subTest(compression=compression, write_size=write_size):
+                    spool, size = compress_file(BytesIO(self.data), compression, chunk_size=4096)
+                    compressed = spool.read()
+                    self.assertEqual(len(compressed), size)
+                    self.assertLess(size, len(self.data) / 5)
+                    self.assertEqual(detect_compression(compressed[:4]), compression)
+                    out = BytesIO()
+                    writer = DecompressingFileWriter(out)
+                    for i in range(0, size, write_size):
+                        writer.write(compressed[i:i + write_size])
+                    writer.close()
+                    self.assertEqual(out.getvalue(), self.data)
+
+    def test_empty_file(self):
+        for compression in available_compressions():
+            with self.subTest(compression=compression):
+                spool, size = compress_file(BytesIO(b''), compression)
+                out = BytesIO()
+                writer = DecompressingFileWriter(out)
+                writer.write(spool.read())
+                writer.close()
+                self.assertEqual(out.getvalue(), b'')
+
+    def test_output_is_bounded(self):
+        for compression in available_compressions():
+            with self.subTest(compression=compression):
+                spool, size = compress_file(BytesIO(b'\0' * (8 << 20)), compression)
+                out = mock.MagicMock()
+                writer = DecompressingFileWriter(out)
+                writer.write(spool.read())
+                writer.close()
+                sizes = [len(c[0][0]) for c in out.write.call_args_list]
+                self.assertLessEqual(max(sizes), DEFAULT_CHUNK_SIZE)
+                self.assertEqual(sum(sizes), 8 << 20)
+
+    def test_spills_to_disk(self):
+        spool, size = compress_file(BytesIO(urandom(10000)), ZLIB, max_memory=1000)
+        self.assertTrue(spool._rolled)
+
+    def test_compressing_reader(self):
+        reader = CompressingReader(BytesIO(self.data), ZLIB, chunk_size=1000)
+        compressed = b''
+        while True:
+            read = reader.read(100)
+            if not read:
+                break
+            self.assertLessEqual(len(read), 100)
+            compressed += read
+        self.assertEqual(zlib.decompress(compressed), self.data)
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            get_compressor('rar')
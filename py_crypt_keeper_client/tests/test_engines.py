@@ -0,0 +1,140 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock, skipIf
+from concurrent.futures import ThreadPoolExecutor
+from os import urandom
+from time import sleep
+from py_crypt_keeper_client import engines
+from py_crypt_keeper_client.engines import (
+    available_engines,
+    get_engine,
+    register_engine,
+    select_engine,
+    AES_CBC,
+    ENGINE_ENVIRONMENT_VARIABLE,
+)
+
+
+class EnginesTest(TestCase):
+    def setUp(self):
+        self.key = urandom(16)
+        self.iv = urandom(16)
+        self.data = urandom(16 * 1000)
+
+    def tearDown(self):
+        engines.selected_engines.clear()
+
+    def test_engines_agree(self):
+        results = set()
+        for name in available_engines(AES_CBC):
+            with self.subTest(engine=name):
+                factory = get_engine(AES_CBC, name)
+                cipher_text = factory(self.key, self.iv).encrypt(self.data)
+                decryptor = factory(self.key, self.iv)
+                # decrypting in pieces keeps the chain between calls.
+                plain_text = decryptor.decrypt(cipher_text[:160]) + decryptor.decrypt(cipher_text[160:])
+                self.assertEqual(plain_text, self.data)
+                results.add(bytes(cipher_text))
+        self.assertEqual(len(results), 1)
+
+    def test_output_buffer(self):
+        for name in available_engines(AES_CBC):
+            with self.subTest(engine=name):
+                factory = get_engine(AES_CBC, name)
+                expected = factory(self.key, self.iv).encrypt(self.data)
+                output = bytearray(len(self.data))
+                self.assertIsNone(factory(self.key, self.iv).encrypt(self.data, output=output))
+                self.assertEqual(output, expected)
+                # in place.
+                factory(self.key, self.iv).decrypt(output, output=output)
+                self.assertEqual(output, self.data)
+
+    @skipIf(len(available_engines(AES_CBC)) < 2, 'needs two engines')
+    def test_environment_override(self):
+        name = available_engines(AES_CBC)[-1]
+        with mock.patch.dict('os.environ', {ENGINE_ENVIRONMENT_VARIABLE: name}):
+            self.assertIs(get_engine(AES_CBC), engines.ENGINES[AES_CBC][name])
+
+    def test_explicit_engine_wins(self):
+        name = available_engines(AES_CBC)[0]
+        with mock.patch.dict('os.environ', {ENGINE_ENVIRONMENT_VARIABLE: 'rot13'}):
+            self.assertIs(get_engine(AES_CBC, name), engines.ENGINES[AES_CBC][name])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            get_engine(AES_CBC, 'rot13')
+        with self.assertRaises(ValueError):
+            get_engine('DES|ECB')
+
+    @mock.patch('py_crypt_keeper_client.engines.benchmark_engine')
+    def test_select_fastest_once(self, mock_benchmark):
+        timings = {name: index + 1 for index, name in enumerate(reversed(available_engines(AES_CBC)))}
+        mock_benchmark.side_effect = lambda factory, block_size: next(
+            timings[name] for name, f in engines.ENGINES[AES_CBC].items() if f is factory)
+        self.assertEqual(select_engine(AES_CBC), available_engines(AES_CBC)[-1])
+        calls = mock_benchmark.call_count
+        select_engine(AES_CBC)
+        self.assertEqual(mock_benchmark.call_count, calls)
+
+    def test_register_engine_resets_selection(self):
+        factory = get_engine(AES_CBC, available_engines(AES_CBC)[0])
+        select_engine(AES_CBC)
+        try:
+            register_engine(AES_CBC, 'test', factory)
+            self.assertNotIn(AES_CBC, engines.selected_engines)
+        finally:
+            del engines.ENGINES[AES_CBC]['test']
+
+    def test_old_pycryptodome_is_skipped(self):
+        # before 3.7 pycryptodome has no output argument.
+        import Crypto
+        saved = {cipher_type: dict(factories) for cipher_type, factories in engines.ENGINES.items()}
+        try:
+            for factories in engines.ENGINES.values():
+                factories.clear()
+            with mock.patch.object(Crypto, 'version_info', (3, 6, 6)), \
+                    mock.patch.object(engines, 'engines_loaded', False):
+                engines.load_engines()
+                self.assertNotIn('pycryptodome', engines.ENGINES[AES_CBC])
+            with mock.patch.object(Crypto, 'version_info', (3, 7, 0)), \
+                    mock.patch.object(engines, 'engines_loaded', False):
+                engines.load_engines()
+                self.assertIn('pycryptodome', engines.ENGINES[AES_CBC])
+        finally:
+            for cipher_type, factories in saved.items():
+                engines.ENGINES[cipher_type].clear()
+                engines.ENGINES[cipher_type].update(factories)
+
+    def test_concurrent_first_lookup(self):
+        # threads arriving while the engines are being registered must wait for them.
+        register = engines.register_engine
+
+        def slow_register(*args):
+            sleep(0.01)
+            register(*args)
+        saved = {cipher_type: dict(factories) for cipher_type, factories in engines.ENGINES.items()}
+        try:
+            for factories in engines.ENGINES.values():
+                factories.clear()
+            with mock.patch.object(engines, 'register_engine', slow_register), \
+                    mock.patch.object(engines, 'engines_loaded', False):
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    found = list(executor.map(lambda _: available_engines(AES_CBC), range(8)))
+            self.assertTrue(all(found))
+        finally:
+            for cipher_type, factories in saved.items():
+                engines.ENGINES[cipher_type].clear()
+                engines.ENGINES[cipher_type].update(factories)
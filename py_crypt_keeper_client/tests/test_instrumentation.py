@@ -0,0 +1,176 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock
+from os import urandom
+from os.path import join
+from tempfile import mkdtemp
+from time import sleep
+from py_crypt_keeper_client.client import SimpleClient
+from py_crypt_keeper_client.engines import AES_GCM
+from py_crypt_keeper_client.instrumentation import (
+    CallbackInstrumentation,
+    CipherTimer,
+    Instrumentation,
+    Measurement,
+    OpenTelemetryInstrumentation,
+    NO_INSTRUMENTATION,
+)
+from py_crypt_keeper_client.mock_server import MockServer, DEFAULT_USER, DEFAULT_API_KEY
+from py_crypt_keeper_client.retry import RetryPolicy
+
+
+class TestOperation(TestCase):
+    def setUp(self):
+        self.measurements = []
+        self.instrumentation = CallbackInstrumentation(self.measurements.append)
+
+    def test_measurement(self):
+        with self.instrumentation.operation('test', document_id='a') as operation:
+            sleep(0.01)
+            operation.mark('first')
+            operation.mark('first')
+            operation.add('bytes', 3)
+            operation.add('bytes', 4)
+            operation.set(status_code=200)
+        measurement, = self.measurements
+        self.assertEqual(measurement.operation, 'test')
+        self.assertGreaterEqual(measurement.duration, 0.01)
+        self.assertGreaterEqual(measurement.duration, measurement.attributes['first'])
+        self.assertGreaterEqual(measurement.attributes['first'], 0.01)
+        self.assertEqual(measurement.attributes['bytes'], 7)
+        self.assertEqual(measurement.attributes['document_id'], 'a')
+        self.assertEqual(measurement.attributes['status_code'], 200)
+
+    def test_error(self):
+        with self.assertRaises(IOError):
+            with self.instrumentation.operation('test'):
+                raise IOError('failed')
+        self.assertEqual(self.measurements[0].attributes['error'], 'OSError')
+
+    def test_cipher_time(self):
+        timer = self.instrumentation.cipher_timer()
+        cipher = mock.MagicMock()
+        cipher.encrypt.side_effect = lambda data: sum(range(200000))
+        timer.instrument(cipher, 'encrypt')
+        with self.instrumentation.operation('test', timer):
+            cipher.encrypt(b'data')
+        self.assertGreater(self.measurements[0].attributes['cipher_time'], 0)
+        self.assertGreater(timer.total, 0)
+
+    def test_callback_errors_are_logged(self):
+        instrumentation = CallbackInstrumentation(mock.MagicMock(side_effect=ValueError('broken')))
+        with instrumentation.operation('test'):
+            pass
+        instrumentation.callback.assert_called_once()
+
+    def test_disabled(self):
+        self.assertIsNone(NO_INSTRUMENTATION.cipher_timer())
+        self.assertIsInstance(CallbackInstrumentation(None).cipher_timer(), CipherTimer)
+        with mock.patch.object(Instrumentation, 'record') as record_mock:
+            with NO_INSTRUMENTATION.operation('test'):
+                pass
+        record_mock.assert_not_called()
+
+
+class TestOpenTelemetryInstrumentation(TestCase):
+    def test_record(self):
+        tracer = mock.MagicMock()
+        meter = mock.MagicMock()
+        # a new instrument for every create call.
+        meter.create_histogram.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        meter.create_counter.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        instrumentation = OpenTelemetryInstrumentation(tracer, meter)
+        instrumentation.record(Measurement('s3.download', 1.5, 0.25, {
+            'document_id': 'a',
+            'status_code': 200,
+            'bytes': 100,
+            'cipher_time': 0.1,
+            'time_to_first_byte': 0.05,
+            'retries': 0,
+            'metadata': {'ignored': True},
+        }))
+        tracer.start_span.assert_called_once_with('s3.download', start_time=1500000000, attributes={
+            'document_id': 'a',
+            'status_code': 200,
+            'bytes': 100,
+            'cipher_time': 0.1,
+            'time_to_first_byte': 0.05,
+            'retries': 0,
+        })
+        tracer.start_span.return_value.end.assert_called_once_with(end_time=1750000000)
+        labels = {'operation': 's3.download', 'status_code': 200}
+        instrumentation.durations.record.assert_called_once_with(0.25, labels)
+        instrumentation.transferred.add.assert_called_once_with(100, labels)
+        instrumentation.cipher_times.record.assert_called_once_with(0.1, labels)
+        instrumentation.first_bytes.record.assert_called_once_with(0.05, labels)
+        instrumentation.retries.add.assert_not_called()
+
+    @mock.patch('py_crypt_keeper_client.instrumentation.otel_trace', None)
+    def test_unavailable(self):
+        with self.assertRaises(ValueError):
+            OpenTelemetryInstrumentation()
+
+
+class TestClientInstrumentation(TestCase):
+    def setUp(self):
+        self.server = MockServer().start()
+        self.measurements = []
+        self.client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096,
+            retry_policy=RetryPolicy(retries=2, backoff=0.01),
+            instrumentation=CallbackInstrumentation(self.measurements.append))
+        self.path = mkdtemp()
+        self.filename = join(self.path, 'upload.bin')
+        self.data = urandom(50000)
+        with open(self.filename, 'wb') as file:
+            file.write(self.data)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def operations(self, name):
+        return [measurement for measurement in self.measurements if measurement.operation == name]
+
+    def test_upload_and_download(self):
+        for encryption_type in [self.client.encryption_type, AES_GCM]:
+            with self.subTest(encryption_type=encryption_type):
+                del self.measurements[:]
+                self.client.encryption_type = encryption_type
+                self.server.fail(route='upload_url')
+                document_id = self.client.upload_file(self.filename)
+                self.assertTrue(self.client.download_file(document_id, 'download.bin', self.path))
+                requests = self.operations('crypt_keeper.request')
+                request, = [m for m in requests if m.attributes['endpoint'] == 'upload_url']
+                self.assertEqual(request.attributes['retries'], 1)
+                self.assertEqual(request.attributes['status_code'], 201)
+                self.assertEqual(request.attributes['document_id'], document_id)
+                upload, = self.operations('s3.upload')
+                download, = self.operations('s3.download')
+                for measurement in [upload, download]:
+                    self.assertEqual(measurement.attributes['document_id'], document_id)
+                    self.assertEqual(measurement.attributes['bytes'], len(self.server.objects[document_id]))
+                    self.assertGreater(measurement.attributes['cipher_time'], 0)
+                self.assertLessEqual(download.attributes['time_to_first_byte'], download.duration)
+
+    def test_download_ranges(self):
+        document_id = self.client.upload_file(self.filename)
+        del self.measurements[:]
+        self.assertTrue(self.client.download_file(document_id, 'download.bin', self.path, range_jobs=2))
+        ranges = self.operations('s3.get_range')
+        self.assertEqual(sum(m.attributes['bytes'] for m in ranges), len(self.server.objects[document_id]))
+        download, = self.operations('s3.download_ranges')
+        self.assertEqual(download.attributes['ranges'], len(ranges))
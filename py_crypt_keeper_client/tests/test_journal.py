@@ -0,0 +1,60 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase
+from os import listdir
+from os.path import dirname, exists, join
+from tempfile import mkdtemp
+from py_crypt_keeper_client.journal import Checkpoint, checkpoint_path
+
+
+class CheckpointTest(TestCase):
+    def setUp(self):
+        self.path = join(mkdtemp(), 'checkpoints', 'upload.json')
+
+    def test_save_and_load(self):
+        checkpoint = Checkpoint(self.path, filename='a', file_size=10)
+        self.assertEqual(checkpoint.state, {'filename': 'a', 'file_size': 10})
+        checkpoint.state['parts'] = {'1': {'iv': 'aXY=', 'etag': 'e'}}
+        checkpoint.save()
+        self.assertEqual(Checkpoint(self.path, filename='a', file_size=10).state['parts'], checkpoint.state['parts'])
+        self.assertEqual(listdir(dirname(self.path)), ['upload.json'])
+
+    def test_changed_identity_is_ignored(self):
+        checkpoint = Checkpoint(self.path, filename='a', file_size=10)
+        checkpoint.state['document_id'] = 'd'
+        checkpoint.save()
+        self.assertNotIn('document_id', Checkpoint(self.path, filename='a', file_size=11).state)
+
+    def test_unreadable_checkpoint_is_ignored(self):
+        Checkpoint(self.path).save()
+        with open(self.path, 'w') as file:
+            file.write('{"truncated')
+        self.assertEqual(Checkpoint(self.path, filename='a').state, {'filename': 'a'})
+
+    def test_reset_and_delete(self):
+        checkpoint = Checkpoint(self.path, filename='a')
+        checkpoint.state['document_id'] = 'd'
+        checkpoint.reset()
+        self.assertEqual(checkpoint.state, {'filename': 'a'})
+        checkpoint.save()
+        checkpoint.delete()
+        self.assertFalse(exists(self.path))
+        checkpoint.delete()
+
+    def test_checkpoint_path(self):
+        self.assertEqual(checkpoint_path('dir', 'upload', 'a'), checkpoint_path('dir', 'upload', './a'))
+        self.assertNotEqual(checkpoint_path('dir', 'upload', 'a'), checkpoint_path('dir', 'download', 'a'))
+        self.assertNotEqual(checkpoint_path('dir', 'upload', 'a'), checkpoint_path('dir', 'upload', 'b'))
@@ -0,0 +1,222 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase
+from os import urandom
+from os.path import join
+from tempfile import mkdtemp
+from time import monotonic
+import requests
+from py_crypt_keeper_client.client import SimpleClient
+from py_crypt_keeper_client.engines import AES_GCM
+from py_crypt_keeper_client.journal import Checkpoint
+from py_crypt_keeper_client.mock_server import MockServer, parse_range, DEFAULT_USER, DEFAULT_API_KEY
+from py_crypt_keeper_client.retry import RetryPolicy
+from py_crypt_keeper_client.utility import calculate_encrypted_file_size, url_expiry
+
+
+class MockServerTest(TestCase):
+    def setUp(self):
+        self.server = MockServer().start()
+        self.client = SimpleClient.create(self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096)
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def write_file(self, data, name='upload.bin'):
+        with open(join(self.path, name), 'wb') as file:
+            file.write(data)
+        return join(self.path, name)
+
+    def read_file(self, name):
+        with open(join(self.path, name), 'rb') as file:
+            return file.read()
+
+    def test_upload_and_download(self):
+        data = urandom(100000)
+        for encryption_type in [self.client.encryption_type, AES_GCM]:
+            with self.subTest(encryption_type=encryption_type):
+                self.client.encryption_type = encryption_type
+                document_id = self.client.upload_file(self.write_file(data))
+                self.assertIsNotNone(document_id)
+                self.assertNotIn(data[:100], self.server.objects[document_id])
+                self.assertTrue(self.client.download_file(document_id, 'download.bin', self.path))
+                self.assertEqual(self.read_file('download.bin'), data)
+
+    def test_unauthorized(self):
+        client = SimpleClient.create(self.server.url, DEFAULT_USER, 'wrong')
+        self.assertIsNone(client.upload_file(self.write_file(b'data')))
+        client.close()
+
+    def test_unknown_document(self):
+        self.assertFalse(self.client.download_file('unknown', 'download.bin', self.path))
+        # object urls are only valid as handed out by the service.
+        response = requests.get('%s/s3/unknown' % self.server.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_share(self):
+        document_id = self.client.upload_file(self.write_file(b'data'))
+        self.assertEqual(self.client.get_share(document_id), [DEFAULT_USER])
+        self.assertIsNotNone(self.client.post_share(document_id, 'other-user'))
+        self.assertEqual(self.client.get_share(document_id), [DEFAULT_USER, 'other-user'])
+        self.assertFalse(self.client.post_share('unknown', 'other-user'))
+
+    def test_post_shares(self):
+        document_id = self.client.upload_file(self.write_file(b'data'))
+        results = list(self.client.post_shares([(document_id, 'a'), ('unknown', 'b'), (document_id, 'c')]))
+        self.assertEqual([result.resource_uri is not None for result in results], [True, False, True])
+        self.assertEqual(self.server.requests['post_shares'], 1)
+        self.assertEqual(self.client.get_share(document_id), [DEFAULT_USER, 'a', 'c'])
+
+    def test_post_shares_rejects_non_objects(self):
+        document_id = self.client.upload_file(self.write_file(b'data'))
+        url = '%s/api/v1/secure_document_service/share/batch/' % self.server.url
+        headers = {'Authorization': 'ApiKey %s:%s' % (DEFAULT_USER, DEFAULT_API_KEY)}
+        for shares in [[1], [{'document_id': document_id, 'username': 'a'}, 'b'], [None]]:
+            with self.subTest(shares=shares):
+                response = requests.post(url, json={'shares': shares}, headers=headers, timeout=5)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get_share(document_id), [DEFAULT_USER])
+
+    def test_multipart_upload(self):
+        data = urandom(300000)
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, multipart_threshold=1,
+            part_size=64 * 1024)
+        for encryption_type in [client.encryption_type, AES_GCM]:
+            with self.subTest(encryption_type=encryption_type):
+                client.encryption_type = encryption_type
+                document_id = client.upload_file(self.write_file(data))
+                self.assertIsNotNone(document_id)
+                self.assertNotIn(document_id, self.server.uploads)
+                self.assertTrue(client.download_file(document_id, 'download.bin', self.path, range_jobs=3))
+                self.assertEqual(self.read_file('download.bin'), data)
+                self.assertEqual(client.read_document(document_id, 100000, 50), data[100000:100050])
+        self.assertGreaterEqual(self.server.requests['part_upload_url'], 10)
+        client.close()
+
+    def test_multipart_upload_unavailable(self):
+        class SinglePutServer(MockServer):
+            def start_multipart_upload(self, request):
+                return 404, {'error': 'Not found.'}, {}
+
+        server = SinglePutServer().start()
+        self.addCleanup(server.stop)
+        client = SimpleClient.create(
+            server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, multipart_threshold=1, part_size=64 * 1024,
+            raise_errors=True)
+        self.addCleanup(client.close)
+        data = urandom(200000)
+        document_id = client.upload_stream(iter([data]), 'stream')
+        self.assertIsNotNone(document_id)
+        self.assertTrue(client.download_file(document_id, 'download.bin', self.path))
+        self.assertEqual(self.read_file('download.bin'), data)
+
+    def test_multipart_upload_gone(self):
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, part_size=64 * 1024, raise_errors=True)
+        self.addCleanup(client.close)
+        checkpoint = Checkpoint(join(self.path, 'checkpoint.json'))
+        checkpoint.state['document_id'] = 'gone'
+        checkpoint.save()
+        data = urandom(200000)
+        with open(self.write_file(data), 'rb') as file:
+            document_id = client.upload_fileobj_multipart(file, len(data), 'upload.bin', checkpoint=checkpoint)
+        self.assertNotEqual(document_id, 'gone')
+        self.assertTrue(client.download_file(document_id, 'download.bin', self.path))
+        self.assertEqual(self.read_file('download.bin'), data)
+
+    def test_object_urls(self):
+        document_id = self.client.upload_file(self.write_file(b'0123456789'))
+        url = self.client.crypt_keeper_client.get_download_url(document_id)['single_use_url']
+        self.assertIsNotNone(url_expiry(url))
+        response = requests.get(url, headers={'Range': 'bytes=16-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 16-19/32')
+        self.assertEqual(response.content, self.server.objects[document_id][16:20])
+        self.assertEqual(requests.get(url, headers={'Range': 'bytes=32-'}).status_code, 416)
+        self.assertEqual(requests.get(url).content, self.server.objects[document_id])
+        # a whole object has been sent, the url is used up.
+        self.assertEqual(requests.get(url).status_code, 403)
+        self.assertEqual(requests.put(url, data=b'data').status_code, 403)
+
+    def test_url_ttl(self):
+        self.server.url_ttl = 0
+        self.assertIsNone(self.client.upload_file(self.write_file(b'data')))
+
+    def test_fail(self):
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, retry_policy=RetryPolicy(retries=2, backoff=0.01))
+        self.server.fail(2, route='upload_url')
+        self.assertIsNotNone(client.upload_file(self.write_file(b'data')))
+        self.assertEqual(self.server.requests['upload_url'], 3)
+        self.server.fail(3, route='upload_url', retry_after=None)
+        self.assertIsNone(client.upload_file(self.write_file(b'data')))
+        self.server.fail(route='put_object')
+        self.assertIsNone(client.upload_file(self.write_file(b'data')))
+        client.close()
+
+    def test_error_rate(self):
+        self.server.error_rate = 1.0
+        self.server.error_status = 500
+        response = requests.post('%s/s3/unknown' % self.server.url)
+        self.assertEqual(response.status_code, 404)
+        response = requests.put('%s/s3/unknown' % self.server.url, data=b'data')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.headers['Retry-After'], '0')
+
+    def test_latency_and_bandwidth(self):
+        self.server.latency = 0.05
+        started = monotonic()
+        document_id = self.client.upload_file(self.write_file(b'data'))
+        self.assertGreaterEqual(monotonic() - started, 0.1)
+        self.server.latency = 0.0
+        self.server.bandwidth = 1024 * 1024
+        started = monotonic()
+        self.client.upload_file(self.write_file(urandom(200 * 1024)))
+        self.assertGreaterEqual(monotonic() - started, 0.15)
+        self.assertIsNotNone(document_id)
+
+    def test_concurrent_load(self):
+        server = MockServer(latency=0.005, error_rate=0.05, seed=1).start()
+        client = SimpleClient.create(
+            server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096,
+            retry_policy=RetryPolicy(retries=5, backoff=0.01, failure_threshold=100))
+        data = [urandom(10000 + i) for i in range(20)]
+        filenames = [self.write_file(content, 'load%d.bin' % i) for i, content in enumerate(data)]
+        results = list(client.upload_files(filenames, jobs=8))
+        uploaded = {result.filename: result.document_id for result in results if result.document_id}
+        self.assertGreater(len(uploaded), 10)
+        for filename, document_id in uploaded.items():
+            file_size = len(data[filenames.index(filename)])
+            self.assertEqual(len(server.objects[document_id]), calculate_encrypted_file_size(file_size, 16))
+        client.close()
+        server.stop()
+
+
+class TestParseRange(TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertIsNone(parse_range(None, 100))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=100-', 100)
+        with self.assertRaises(ValueError):
+            parse_range('bytes=5-3', 100)
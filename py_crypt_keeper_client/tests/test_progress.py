@@ -0,0 +1,177 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock
+from io import StringIO
+from json import loads
+from os import urandom
+from os.path import join
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep
+from py_crypt_keeper_client.client import SimpleClient
+from py_crypt_keeper_client.engines import AES_GCM
+from py_crypt_keeper_client.mock_server import MockServer, DEFAULT_USER, DEFAULT_API_KEY
+from py_crypt_keeper_client.progress import (
+    format_bytes,
+    format_duration,
+    JsonProgress,
+    ProgressBar,
+    ProgressEvent,
+    ProgressMeter,
+)
+
+
+class TestProgressMeter(TestCase):
+    def setUp(self):
+        self.events = []
+
+    def test_events(self):
+        meter = ProgressMeter(self.events.append, 'upload', 'file.bin', 'a', interval=0.01)
+        with meter.begin(100):
+            for chunk in meter.counted([b'x' * 10] * 5):
+                sleep(0.005)
+        self.assertGreater(len(self.events), 1)
+        self.assertFalse(any(event.finished for event in self.events[:-1]))
+        final = self.events[-1]
+        self.assertEqual(final[:5], ('upload', 'file.bin', 'a', 50, 100))
+        self.assertTrue(final.finished)
+        self.assertGreater(final.average_rate, 0)
+        count = len(self.events)
+        meter.finish()
+        self.assertEqual(len(self.events), count)
+
+    def test_stalled(self):
+        # events keep coming while no bytes move, with a zero rate and an unknown eta.
+        meter = ProgressMeter(self.events.append, 'download', 'file.bin', interval=0.01).begin(100, 20)
+        sleep(0.05)
+        meter.finish()
+        self.assertGreater(len(self.events), 2)
+        self.assertEqual(self.events[-2].rate, 0)
+        self.assertIsNone(self.events[-2].eta)
+        self.assertEqual(self.events[-1].average_rate, 0)
+
+    def test_eta(self):
+        meter = ProgressMeter(self.events.append, 'upload', 'file.bin', interval=60).begin(1000)
+        meter.update(250)
+        meter.report(False)
+        meter.update(750)
+        meter.finish()
+        self.assertEqual(self.events[0].eta, 750 / self.events[0].rate)
+        self.assertEqual(self.events[1].eta, 0)
+
+    def test_callback_errors_are_logged(self):
+        callback = mock.MagicMock(side_effect=ValueError('broken'))
+        ProgressMeter(callback, 'upload', 'file.bin').begin().finish()
+        callback.assert_called_once()
+
+
+class TestProgressDisplay(TestCase):
+    def event(self, name, done, total, rate=1024.0, finished=False):
+        return ProgressEvent('upload', name, None, done, total, rate, rate, None, 1.0, finished)
+
+    def test_format(self):
+        self.assertEqual(format_bytes(10), '10 B')
+        self.assertEqual(format_bytes(1536), '1.5 KiB')
+        self.assertEqual(format_bytes(3 * 1024 ** 3), '3.0 GiB')
+        self.assertEqual(format_bytes(2 * 1024 ** 5), '2048.0 TiB')
+        self.assertEqual(format_duration(3725.5), '1:02:05')
+
+    def test_progress_bar(self):
+        file = StringIO()
+        bar = ProgressBar(file, width=10)
+        bar(self.event('a.bin', 512, 1024))
+        self.assertIn('a.bin [#####-----]  50% 512 B/1.0 KiB 1.0 KiB/s ETA 0:00:00', file.getvalue())
+        bar(self.event('a.bin', 1024, 1024, rate=0.0))
+        self.assertIn('100% 1.0 KiB/1.0 KiB 0 B/s ETA 0:00:00', file.getvalue())
+        bar(self.event('a.bin', 1000, 1024, rate=0.0))
+        self.assertIn('ETA --:--:--', file.getvalue())
+        bar(self.event('a.bin', 512, 1024))
+        bar(self.event('b.bin', 0, None))
+        self.assertIn('2 transfers 512 B 2.0 KiB/s', file.getvalue())
+        bar(self.event('a.bin', 1024, 1024, finished=True))
+        self.assertTrue(file.getvalue().endswith('\r'))
+        self.assertEqual(bar.transfers.keys(), {('upload', 'b.bin', None)})
+
+    def test_json_progress(self):
+        file = StringIO()
+        JsonProgress(file)(self.event('a.bin', 512, 1024))
+        event = loads(file.getvalue())
+        self.assertEqual(event['event'], 'progress')
+        self.assertEqual((event['name'], event['done'], event['total']), ('a.bin', 512, 1024))
+
+
+class TestClientProgress(TestCase):
+    def setUp(self):
+        self.server = MockServer().start()
+        self.events = []
+        self.lock = Lock()
+        self.path = mkdtemp()
+        self.filename = join(self.path, 'upload.bin')
+        with open(self.filename, 'wb') as file:
+            file.write(urandom(100000))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def final(self, operation):
+        finals = [event for event in self.events if event.finished and event.operation == operation]
+        self.assertEqual(len(finals), 1)
+        return finals[0]
+
+    def check(self, client, download_jobs=(1, 3)):
+        for encryption_type in [client.encryption_type, AES_GCM]:
+            client.encryption_type = encryption_type
+            for range_jobs in download_jobs:
+                with self.subTest(encryption_type=encryption_type, range_jobs=range_jobs):
+                    del self.events[:]
+                    document_id = client.upload_file(self.filename)
+                    upload = self.final('upload')
+                    self.assertEqual((upload.name, upload.document_id), ('upload.bin', document_id))
+                    size = len(self.server.objects[document_id])
+                    self.assertEqual((upload.done, upload.total), (size, size))
+                    self.assertTrue(client.download_file(document_id, 'download.bin', self.path, range_jobs))
+                    download = self.final('download')
+                    self.assertEqual((download.name, download.document_id), ('download.bin', document_id))
+                    self.assertEqual((download.done, download.total), (size, size))
+
+    def test_progress(self):
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, progress_callback=self.record,
+            progress_interval=0.01)
+        self.check(client)
+        client.close()
+
+    def test_multipart_progress(self):
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, multipart_threshold=1,
+            part_size=16 * 1024, progress_callback=self.record)
+        self.check(client, (1,))
+        client.close()
+
+    def test_periodic_events(self):
+        self.server.bandwidth = 1024 * 1024
+        client = SimpleClient.create(
+            self.server.url, DEFAULT_USER, DEFAULT_API_KEY, chunk_size=4096, progress_callback=self.record,
+            progress_interval=0.01)
+        client.upload_file(self.filename)
+        client.close()
+        running = [event for event in self.events if not event.finished]
+        self.assertGreater(len(running), 2)
+        self.assertEqual(running, sorted(running, key=lambda event: event.done))
@@ -0,0 +1,103 @@
+#   Copyright 2017 Maurice Carey
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+from unittest import TestCase, mock
+from py_crypt_keeper_client.exceptions import CircuitOpenError
+from py_crypt_keeper_client.retry import CircuitBreaker, RetryPolicy, parse_retry_after
+
+
+class RetryPolicyTest(TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertEqual(parse_retry_after('-1'), 0.0)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+    def test_should_retry(self):
+        policy = RetryPolicy(retries=2, max_retry_after=10)
+        self.assertTrue(policy.should_retry('get', 0))
+        self.assertFalse(policy.should_retry('post', 0))
+        self.assertTrue(policy.should_retry('get', 1, 502))
+        self.assertFalse(policy.should_retry('get', 2, 502))
+        self.assertFalse(policy.should_retry('post', 0, 502))
+        self.assertTrue(policy.should_retry('POST', 0, 503))
+        self.assertTrue(policy.should_retry('post', 0, 429, retry_after=10))
+        self.assertFalse(policy.should_retry('post', 0, 429, retry_after=11))
+        self.assertFalse(policy.should_retry('get', 0, 500))
+        self.assertFalse(policy.should_retry('get', 0, 404))
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1, max_delay=4)
+        self.assertEqual(policy.delay(0, retry_after=7), 7)
+        self.assertTrue(all(0 <= policy.delay(attempt) <= 4 for attempt in range(10)))
+
+
+@mock.patch('py_crypt_keeper_client.retry.monotonic')
+class CircuitBreakerTest(TestCase):
+    def test_opens_after_threshold(self, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        breaker = CircuitBreaker('share', failure_threshold=2, reset_timeout=10)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError) as context:
+            breaker.before_call()
+        self.assertEqual(context.exception.endpoint, 'share')
+        self.assertEqual(context.exception.retry_after, 10)
+
+    def test_half_open_trial(self, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        breaker = CircuitBreaker('share', failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        monotonic_mock.return_value = 111.0
+        breaker.before_call()
+        # only one trial call is let through while the circuit is half open.
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        monotonic_mock.return_value = 122.0
+        breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+        breaker.before_call()
+
+    def test_end_trial(self, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        breaker = CircuitBreaker('share', failure_threshold=1, reset_timeout=10)
+        self.assertFalse(breaker.before_call())
+        breaker.record_failure()
+        monotonic_mock.return_value = 111.0
+        self.assertTrue(breaker.before_call())
+        # a trial without an outcome keeps the circuit open rather than half open forever.
+        breaker.end_trial()
+        with self.assertRaises(CircuitOpenError) as context:
+            breaker.before_call()
+        self.assertEqual(context.exception.retry_after, 10)
+        monotonic_mock.return_value = 122.0
+        self.assertTrue(breaker.before_call())
+        breaker.record_success()
+        breaker.end_trial()
+        self.assertFalse(breaker.before_call())
+
+    def test_success_resets_failures(self, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        breaker = CircuitBreaker('share', failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.before_call()
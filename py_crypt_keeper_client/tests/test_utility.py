@@ -15,12 +15,29 @@
 
 from unittest import TestCase, mock
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from io import BytesIO
+from os import urandom
 from py_crypt_keeper_client.utility import (
+    buffered_chunks,
+    calculate_block_range,
     calculate_encrypted_file_size,
+    calculate_ranges,
     decode_key,
+    DecryptingFileWriter,
     encode_key,
     EncryptingFileIterator,
     FileIterator,
+    IteratorReader,
+    pipeline,
+    prefetch,
+    read_fully,
+    readinto_fully,
+    run_concurrently,
+    spool_file,
+    url_expiry,
 )
 from py_crypt_keeper_client.cipher import Cipher, AES_CBC
 
@@ -41,6 +58,168 @@ class UtilityTest(TestCase):
     def test_decode_key(self):
         self.assertEqual(decode_key(self.key_text), self.bytes)
 
+    def test_calculate_block_range(self):
+        self.assertEqual(calculate_block_range(0, 1, 16), (0, 31))
+        self.assertEqual(calculate_block_range(15, 2, 16), (0, 47))
+        self.assertEqual(calculate_block_range(32, 16, 16), (32, 63))
+
+    def test_calculate_ranges(self):
+        self.assertEqual(calculate_ranges(0, 16, 32), [])
+        self.assertEqual(calculate_ranges(10, 16, 32), [(0, 31)])
+        self.assertEqual(calculate_ranges(64, 16, 32), [(0, 47), (32, 79)])
+        self.assertEqual(calculate_ranges(70, 16, 32), [(0, 47), (32, 79), (64, 95)])
+        with self.assertRaises(ValueError):
+            calculate_ranges(70, 16, 20)
+
+    def test_url_expiry(self):
+        url = 'https://s3.amazonaws.com/bucket/key?X-Amz-Expires=600&X-Amz-Date=20170201T200757Z&X-Amz-Signature=a'
+        self.assertEqual(url_expiry(url), 1485979677 + 600)
+        self.assertIsNone(url_expiry('https://s3.amazonaws.com/bucket/key?X-Amz-Date=20170201T200757Z'))
+        self.assertIsNone(url_expiry('https://s3.amazonaws.com/bucket/key?X-Amz-Expires=soon&X-Amz-Date=x'))
+        self.assertIsNone(url_expiry(None))
+
+
+class TestRunConcurrently(TestCase):
+    def test_results_and_errors(self):
+        def square(x):
+            if x == 3:
+                raise ValueError('three')
+            return x * x
+        results = {item: (result, error) for item, result, error in run_concurrently(square, range(10), 3)}
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results[4], (16, None))
+        self.assertIsNone(results[3][0])
+        self.assertIsInstance(results[3][1], ValueError)
+
+    def test_items_are_pulled_lazily(self):
+        pulled = []
+
+        def items():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+        results = run_concurrently(lambda x: x, items(), 2)
+        next(results)
+        self.assertLessEqual(len(pulled), 5)
+        results.close()
+
+
+class TestPrefetch(TestCase):
+    def test_results_in_order(self):
+        def square(x):
+            if x == 3:
+                raise ValueError('three')
+            return x * x
+        results = list(prefetch(square, range(10), 3))
+        self.assertEqual([item for item, _, _ in results], list(range(10)))
+        self.assertEqual(results[4][1:], (16, None))
+        self.assertIsInstance(results[3][2], ValueError)
+
+    def test_lookahead(self):
+        pulled = []
+
+        def items():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+        results = prefetch(lambda x: x, items(), 4)
+        self.assertEqual(next(results), (0, 0, None))
+        self.assertEqual(len(pulled), 4)
+        next(results)
+        self.assertEqual(len(pulled), 5)
+        results.close()
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_results_in_order(self):
+        def slow_square(x):
+            sleep(0.001 * (x % 3))
+            return x * x
+        self.assertEqual(list(pipeline(range(50), slow_square, self.executor, 4)), [x * x for x in range(50)])
+
+    def test_serial(self):
+        lock = Lock()
+        calls = []
+
+        def transform(x):
+            self.assertTrue(lock.acquire(blocking=False))
+            calls.append(x)
+            sleep(0.001)
+            lock.release()
+            return x
+        self.assertEqual(list(pipeline(range(20), transform, self.executor, 4, serial=True)), list(range(20)))
+        self.assertEqual(calls, list(range(20)))
+
+    def test_errors(self):
+        def items():
+            yield 1
+            raise IOError('read')
+        with self.assertRaises(IOError):
+            list(pipeline(items(), lambda x: x, self.executor))
+
+        def transform(x):
+            if x == 5:
+                raise ValueError('five')
+            return x
+        with self.assertRaises(ValueError):
+            list(pipeline(range(10), transform, self.executor))
+
+    def test_bounded(self):
+        pulled = []
+
+        def items():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+        results = pipeline(items(), lambda x: x, self.executor, 2)
+        next(results)
+        sleep(0.2)
+        # two in flight, two queued and one waiting to be queued.
+        self.assertLessEqual(len(pulled), 6)
+        results.close()
+        sleep(0.2)
+        stopped = len(pulled)
+        sleep(0.2)
+        self.assertEqual(len(pulled), stopped)
+
+
+    def test_buffered_chunks(self):
+        data = urandom(5000)
+        # a slow transform lets the reader run as far ahead as the pipeline allows.
+        def transform(chunk):
+            sleep(0.001)
+            return bytes(chunk)
+        for depth in [1, 3]:
+            with self.subTest(depth=depth):
+                chunks = buffered_chunks(BytesIO(data), 64, depth + 2)
+                self.assertEqual(b''.join(pipeline(chunks, transform, self.executor, depth, serial=True)), data)
+        chunks = list(buffered_chunks(BytesIO(data), 1024, 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [1024] * 4 + [904])
+        self.assertIs(chunks[0].obj, chunks[2].obj)
+        self.assertIsNot(chunks[0].obj, chunks[1].obj)
+        self.assertEqual(b''.join(buffered_chunks(IteratorReader([data[:100], data[100:]]), 64, 2)), data)
+
+
+class TestIteratorReader(TestCase):
+    def test_read(self):
+        reader = IteratorReader(iter([b'ab', b'', b'cde', b'f']))
+        self.assertEqual(reader.read(1), b'a')
+        self.assertEqual(reader.read(3), b'bcd')
+        self.assertEqual(reader.read(), b'ef')
+        self.assertEqual(reader.read(3), b'')
+
+    def test_spool_file(self):
+        data = urandom(5000)
+        spool, size = spool_file(IteratorReader(data[i:i + 7] for i in range(0, 5000, 7)), 512, 1024)
+        self.assertEqual(size, 5000)
+        self.assertEqual(spool.read(), data)
+
 
 class TestFileIterator(TestCase):
     def setUp(self):
@@ -77,3 +256,77 @@ class TestEncryptingFileIterator(TestCase):
         self.assertIs(out[0], 'iv')
         self.assertIs(out[1], 'cipher')
 
+
+    def test_chunked_output_matches_block_output(self):
+        key = encode_key(b'keykeykeykeykeyk')
+        for file_size in [0, 1, 16, 100, 4096, 5000]:
+            with self.subTest(file_size=file_size):
+                data = urandom(file_size)
+                iv = urandom(16)
+                outputs = []
+                for chunk_size in [16, 64, 4096]:
+                    cipher = Cipher(AES_CBC, key, file_size, iter([iv]))
+                    efi = EncryptingFileIterator(BytesIO(data), cipher, chunk_size)
+                    outputs.append(b''.join(efi))
+                self.assertEqual(len(outputs[0]), calculate_encrypted_file_size(file_size, 16))
+                self.assertEqual(outputs[0], outputs[1])
+                self.assertEqual(outputs[0], outputs[2])
+
+    def test_chunk_size_must_be_block_aligned(self):
+        cipher = Cipher(AES_CBC, encode_key(b'keykeykeykeykeyk'))
+        for chunk_size in [0, 15, 100]:
+            with self.subTest(chunk_size=chunk_size):
+                with self.assertRaises(ValueError):
+                    EncryptingFileIterator(BytesIO(b''), cipher, chunk_size)
+
+    def test_readinto_fully(self):
+        file = mock.MagicMock()
+        chunks = [b'ab', b'c', b'']
+
+        def readinto(view):
+            chunk = chunks.pop(0)
+            view[:len(chunk)] = chunk
+            return len(chunk)
+        file.readinto.side_effect = readinto
+        buffer = bytearray(4)
+        self.assertEqual(readinto_fully(file, buffer), 3)
+        self.assertEqual(buffer[:3], b'abc')
+        self.assertEqual(readinto_fully(BytesIO(b'abcdef'), buffer), 4)
+        self.assertEqual(buffer, b'abcd')
+
+    def test_read_fully(self):
+        file = mock.MagicMock()
+        file.read = mock.MagicMock(side_effect=[b'ab', b'c', b'd', b'', b''])
+        self.assertEqual(read_fully(file, 3), b'abc')
+        self.assertEqual(read_fully(file, 3), b'd')
+        self.assertEqual(read_fully(file, 3), b'')
+
+
+class TestDecryptingFileWriter(TestCase):
+    def setUp(self):
+        self.key = encode_key(b'keykeykeykeykeyk')
+
+    def encrypt(self, data):
+        cipher = Cipher(AES_CBC, self.key, len(data))
+        return b''.join(EncryptingFileIterator(BytesIO(data), cipher, 64))
+
+    def decrypt(self, encrypted, file_size, network_chunk_size):
+        out = BytesIO()
+        writer = DecryptingFileWriter(out, lambda iv: Cipher(AES_CBC, self.key, file_size, iv=iv), 16)
+        for i in range(0, len(encrypted), network_chunk_size):
+            writer.write(encrypted[i:i + network_chunk_size])
+        writer.close()
+        return out.getvalue()
+
+    def test_round_trip(self):
+        for file_size in [0, 1, 15, 16, 17, 1000, 4096]:
+            data = urandom(file_size)
+            encrypted = self.encrypt(data)
+            for network_chunk_size in [1, 7, 16, 33, 4096]:
+                with self.subTest(file_size=file_size, network_chunk_size=network_chunk_size):
+                    self.assertEqual(self.decrypt(encrypted, file_size, network_chunk_size), data)
+
+    def test_partial_block_raises(self):
+        encrypted = self.encrypt(urandom(100))
+        with self.assertRaises(ValueError):
+            self.decrypt(encrypted[:-3], 100, 16)
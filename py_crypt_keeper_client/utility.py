@@ -13,13 +13,33 @@
 #    limitations under the License.
 #
 
+import io
+import os
+from random import uniform
 from base64 import b64decode, b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from itertools import cycle, islice
+from queue import Queue, Full
+from urllib.parse import parse_qs, urlsplit
+from tempfile import SpooledTemporaryFile
+from threading import Event, Lock, Thread
 from logging import getLogger, StreamHandler, Formatter, DEBUG, WARN
 
 
 log = getLogger(__name__)
 log.setLevel(WARN)
 
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_JOBS = 4
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+DEFAULT_SPOOL_SIZE = 64 * 1024 * 1024
+# S3 requires every part but the last to be at least 5 MiB.
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+__write_lock = Lock()
+
 
 def encode_key(key_bytes):
     return b64encode(key_bytes).decode('utf-8', 'backslashreplace')
@@ -38,6 +58,209 @@ def calculate_encrypted_file_size(file_size, block_size):
     return block_size * base_multiplier
 
 
+def calculate_ranges(file_size, block_size, range_size=DEFAULT_RANGE_SIZE):
+    # inclusive ciphertext byte ranges that each start one block early, so a range's first block is its iv
+    # and its plain text belongs at the range's start offset in the decrypted file.
+    if range_size <= 0 or range_size % block_size != 0:
+        raise ValueError('range_size must be a positive multiple of the cipher block size %d (got %s).' % (
+            block_size, range_size))
+    encrypted_size = calculate_encrypted_file_size(file_size, block_size)
+    return [
+        (start, min(start + block_size + range_size, encrypted_size) - 1)
+        for start in range(0, encrypted_size - block_size, range_size)
+    ]
+
+
+def calculate_block_range(offset, length, block_size):
+    # the inclusive cipher text range holding plain text bytes [offset, offset + length) preceded by the block
+    # that serves as its iv. Plain text block i is stored at cipher text block i + 1, after the file iv.
+    first_block = offset // block_size
+    last_block = (offset + length - 1) // block_size
+    return first_block * block_size, (last_block + 2) * block_size - 1
+
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            with __write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def backoff_delay(attempt, base=0.5, maximum=30.0):
+    # exponential backoff with full jitter.
+    return uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def run_concurrently(func, items, jobs=DEFAULT_JOBS):
+    # yields (item, result, exception) as each call finishes, items are pulled lazily so at most 2 * jobs are queued.
+    # Closing the generator early cancels calls that have not started yet.
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while True:
+                while not exhausted and len(pending) < 2 * jobs:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(func, item)] = item
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    error = future.exception()
+                    yield item, None if error else future.result(), error
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def prefetch(func, items, lookahead=DEFAULT_JOBS):
+    # yields (item, result, exception) in the order of items, calling func up to lookahead items ahead of the
+    # consumer. Closing the generator early cancels calls that have not started yet.
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=lookahead) as executor:
+        try:
+            while True:
+                for item in islice(items, lookahead - len(pending)):
+                    pending.append((item, executor.submit(func, item)))
+                if not pending:
+                    return
+                item, future = pending.popleft()
+                error = future.exception()
+                yield item, None if error else future.result(), error
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def pipeline(items, transform, executor, depth=DEFAULT_JOBS, serial=False):
+    # yields transform(item) for each item in order. Items are pulled on a reader thread into a queue of at most depth
+    # items and transform runs on executor, which may be shared by many pipelines, with up to depth calls in flight,
+    # or one at a time when serial, e.g. to keep a CBC chain. The next call starts before a result is handed over, so
+    # reading, transforming and consuming overlap. Closing the generator early stops the reader.
+    queue = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(entry):
+        # gives up once the consumer has gone.
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((item, None, False)):
+                    return
+        except BaseException as e:
+            put((None, e, False))
+            return
+        put((None, None, True))
+
+    pending = deque()
+    limit = 1 if serial else depth
+    exhausted = False
+
+    def fill():
+        nonlocal exhausted
+        while not exhausted and len(pending) < limit:
+            item, error, done = queue.get()
+            if error is not None:
+                raise error
+            if done:
+                exhausted = True
+                return
+            pending.append(executor.submit(transform, item))
+    Thread(target=read, daemon=True).start()
+    try:
+        fill()
+        while pending:
+            result = pending.popleft().result()
+            fill()
+            yield result
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+
+
+def url_expiry(url):
+    # the epoch time a presigned S3 url stops working, or None when the url does not say.
+    query = parse_qs(urlsplit(url or '').query)
+    try:
+        signed_at = datetime.strptime(query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+        return signed_at.timestamp() + int(query['X-Amz-Expires'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def spool_file(file, chunk_size=DEFAULT_CHUNK_SIZE, max_memory=DEFAULT_SPOOL_SIZE):
+    # measures a stream of unknown length, only spilling to a temporary file past max_memory.
+    # Returns the spool rewound to the start and its size.
+    spool = SpooledTemporaryFile(max_size=max_memory)
+    while True:
+        read = file.read(chunk_size)
+        if not read:
+            break
+        spool.write(read)
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size
+
+
+class IteratorReader(object):
+    # file-like read() over an iterable of byte strings, e.g. a generator.
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                chunk = next(self.iterator)
+            except StopIteration:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        if size < 0:
+            size = length
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class SizedIterable(object):
+    # an upload body of known length, requests sends it with a Content-Length header and writes each chunk to the
+    # connection as it is produced, so nothing is buffered.
+    def __init__(self, size, iterable):
+        self.size = size
+        self.iterable = iterable
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+
 class FileIterator(object):
     def __init__(self, file):
         self.file = file
@@ -53,11 +276,62 @@ class FileIterator(object):
             return byte
 
 
+def read_fully(file, size):
+    # pipes and sockets may return short reads before the end of the stream.
+    read = file.read(size)
+    if not read or len(read) == size:
+        return read
+    chunks = [read]
+    remaining = size - len(read)
+    while remaining > 0:
+        read = file.read(remaining)
+        if not read:
+            break
+        chunks.append(read)
+        remaining -= len(read)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+def readinto_fully(file, buffer):
+    # fills buffer from file and returns the number of bytes read, which is only short at the end of the file.
+    total = 0
+    with memoryview(buffer) as view:
+        while total < len(view):
+            read = file.readinto(view[total:])
+            if not read:
+                break
+            total += read
+    return total
+
+
+def buffered_chunks(file, chunk_size, count):
+    # plain text chunks of file read into count reused buffers in turn, so each chunk must be finished with before
+    # count more are read. Files that are not io objects get a new bytes object per chunk.
+    if not isinstance(file, (io.RawIOBase, io.BufferedIOBase)):
+        while True:
+            read = read_fully(file, chunk_size)
+            if not read:
+                return
+            yield read
+    for buffer in cycle([bytearray(chunk_size) for _ in range(count)]):
+        read = readinto_fully(file, buffer)
+        if not read:
+            return
+        yield memoryview(buffer)[:read]
+
+
 class EncryptingFileIterator(object):
-    def __init__(self, file, cipher):
+    def __init__(self, file, cipher, chunk_size=DEFAULT_CHUNK_SIZE):
         self.file = file
         self.cipher = cipher
         self.block_size = cipher.block_size
+        if chunk_size <= 0 or chunk_size % self.block_size != 0:
+            raise ValueError('chunk_size must be a positive multiple of the cipher block size %d (got %s).' % (
+                self.block_size, chunk_size))
+        self.chunk_size = chunk_size
+        # plain text from io objects is read into one reused buffer, each chunk of cipher text is a new bytes object
+        # the consumer may keep.
+        self.buffer = bytearray(chunk_size) if isinstance(file, (io.RawIOBase, io.BufferedIOBase)) else None
         self.iv = cipher.get_iv()
         self.first = True
 
@@ -68,10 +342,64 @@ class EncryptingFileIterator(object):
         if self.first:
             self.first = False
             return self.iv
-        read = self.file.read(self.block_size)
+        # short reads are only allowed at the end of the file, otherwise padding would land mid stream.
+        if self.buffer is None:
+            read = read_fully(self.file, self.chunk_size)
+            if not read:
+                raise StopIteration
+            return self.cipher.encrypt(read)
+        read = readinto_fully(self.file, self.buffer)
         if not read:
             raise StopIteration
-        else:
-            return self.cipher.encrypt(read)
+        with memoryview(self.buffer) as view:
+            return self.cipher.encrypt(view[:read])
+
+
+class DecryptingFileWriter(object):
+    def __init__(self, file, cipher_factory, block_size):
+        # cipher_factory is called with the iv once the first block of the stream has arrived.
+        self.file = file
+        self.cipher_factory = cipher_factory
+        self.block_size = block_size
+        self.cipher = None
+        self.buffer = bytearray()
+        # plain text is decrypted into one reused buffer, file.write must not keep the view it is given.
+        self.output = bytearray()
+        # cipher text bytes decrypted after the iv and the last cipher text block decrypted, which is the iv that
+        # continues the chain when a download is resumed from this point.
+        self.decrypted = 0
+        self.last_block = None
+
+    def write(self, data):
+        if not self.buffer and self.cipher is not None:
+            # fast path, decrypt the aligned part of data directly and only carry the remainder.
+            aligned = len(data) - len(data) % self.block_size
+            if aligned:
+                self.file.write(self.decrypt(data if aligned == len(data) else memoryview(data)[:aligned]))
+                self.decrypted += aligned
+                self.last_block = bytes(data[aligned - self.block_size:aligned])
+            self.buffer += data[aligned:]
+            return
+        self.buffer += data
+        if self.cipher is None:
+            if len(self.buffer) < self.block_size:
+                return
+            self.last_block = bytes(self.buffer[:self.block_size])
+            self.cipher = self.cipher_factory(self.last_block)
+            del self.buffer[:self.block_size]
+        aligned = len(self.buffer) - len(self.buffer) % self.block_size
+        if aligned:
+            with memoryview(self.buffer) as view:
+                self.file.write(self.decrypt(view[:aligned]))
+                self.last_block = bytes(view[aligned - self.block_size:aligned])
+            self.decrypted += aligned
+            del self.buffer[:aligned]
 
+    def decrypt(self, cipher_text):
+        if len(self.output) < len(cipher_text):
+            self.output = bytearray(len(cipher_text))
+        return self.cipher.decrypt(cipher_text, output=self.output)
 
+    def close(self):
+        if self.buffer:
+            raise ValueError('Encrypted stream ended with %d bytes of a partial block.' % len(self.buffer))
@@ -25,10 +25,16 @@ setup(
     license='Apache License, Version 2.0',
     packages=['py_crypt_keeper_client'],
     install_requires=[
-        'pycrypto==2.6.1',
+        'pycryptodome>=3.7',
         'requests==2.11.1',
-        'requests-toolbelt==0.7.0',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.6'],
+        'cryptography': ['cryptography'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'opentelemetry': ['opentelemetry-api'],
+    },
     zip_safe=False,
     entry_points={
         'console_scripts': ['ckc=py_crypt_keeper_client.command:main'],